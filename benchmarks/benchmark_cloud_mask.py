@@ -0,0 +1,38 @@
+#!/usr/bin/env python3.9
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the cloud mask at the detection resolutions of User_Inputs masking_options ("cloud_mask_resolution"),
+runtime and agreement with the 10m cloud mask, with the threshold, average and dilation of masking_options.
+Run from the repository folder: python -m benchmarks.benchmark_cloud_mask --product path/to/ACOLITE_product_folder
+
+@author: AIR Centre
+"""
+
+### Import Libraries ###################################################################################################################
+import argparse
+import time
+import numpy as np
+
+### Import Defined Functions ###########################################################################################################
+from configs.User_Inputs import masking_options
+from modules.Masking import cloud_mask
+
+########################################################################################################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cloud mask resolution benchmark.")
+    parser.add_argument("--product", type=str, required=True, help="ACOLITE product folder (with Top_Atmosphere_Bands or L2W NetCDF).")
+    parser.add_argument("--resolutions", type=int, nargs="+", default=[10, 20, 60, 120], help="Cloud detection resolutions in meters.")
+    args = parser.parse_args()
+
+    reference = None
+    for resolution in sorted(set(args.resolutions) | {10}):
+        time0 = time.perf_counter()
+        mask = cloud_mask(args.product, masking_options["cloud_mask_threshold"], masking_options["cloud_mask_average"],
+                          masking_options["cloud_mask_dilation"], resolution)
+        runtime = time.perf_counter()-time0
+        if reference is None:
+            reference, reference_time = mask, runtime
+        union = np.count_nonzero(mask | reference)
+        iou = np.count_nonzero(mask & reference)/union if union > 0 else 1.0
+        print(str(resolution) + "m: " + str(round(runtime, 1)) + " s (" + str(round(reference_time/runtime, 1)) + "x), clouds " +
+              str(round(mask.mean()*100, 2)) + "%, agreement " + str(round(np.mean(mask == reference)*100, 2)) + "%, IoU " + str(round(iou, 3)))
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3.9
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the spectral indices kernels (numexpr vs NumPy) on a 10 m Sentinel-2 tile.
+The tile is processed in blocks, as done when writing the features stack.
+Run from the repository folder: python -m benchmarks.benchmark_indices
+
+@author: AIR Centre
+"""
+
+### Import Libraries ###################################################################################################################
+import argparse
+import time
+import numpy as np
+
+### Import Defined Functions ###########################################################################################################
+from modules.SpectralIndices import calculate_indices, index_plan, INDEX_EXPRESSIONS, ne
+
+########################################################################################################################################
+def time_tile(bands, s2platform, backend, n_blocks, repeats):
+    """
+    This function measures the time to calculate all indices over a full tile.
+    Input: bands - Dictionary with band arrays of one block.
+           s2platform - String with S2A or S2B platforms.
+           backend - "numexpr" or "numpy".
+           n_blocks - Number of blocks in a tile.
+           repeats - Number of repetitions, the best is kept.
+    Output: best - Best time in seconds.
+    """
+    best = float("inf")
+    for _ in range(repeats):
+        time0 = time.perf_counter()
+        for _ in range(n_blocks):
+            calculate_indices(bands, s2platform, backend)
+        best = min(best, time.perf_counter()-time0)
+
+    return best
+
+########################################################################################################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Spectral indices kernels benchmark.")
+    parser.add_argument("--tile_size", type=int, default=10980, help="Tile size in pixels (10980 for 10 m tiles).")
+    parser.add_argument("--block_size", type=int, default=1024, help="Block size in pixels.")
+    parser.add_argument("--repeats", type=int, default=3, help="Number of repetitions.")
+    args = parser.parse_args()
+
+    # Random reflectances of one block, including zeros to exercise division by zero
+    rng = np.random.default_rng(0)
+    bands = {band:rng.uniform(-0.05, 0.6, (args.block_size, args.block_size)).astype(np.float32)
+             for band in ("B02", "B03", "B04", "B06", "B08", "B11")}
+    bands["B08"][0, :] = 0
+    bands["B04"][0, :] = 0
+    n_blocks = int(np.ceil(args.tile_size/args.block_size))**2
+
+    print("Tile: " + str(args.tile_size) + "x" + str(args.tile_size) + ", blocks: " + str(n_blocks) + " of " +
+          str(args.block_size) + "x" + str(args.block_size))
+    plan = index_plan(list(INDEX_EXPRESSIONS))
+    print("Plan: " + str(len(INDEX_EXPRESSIONS)) + " indices in " + str(len(plan["steps"])) + " steps")
+    for name, expression in plan["steps"]:
+        print("  " + name + " = " + expression)
+    numpy_time = time_tile(bands, "S2A", "numpy", n_blocks, args.repeats)
+    print("numpy: " + str(round(numpy_time, 2)) + " s")
+    if ne is not None:
+        numexpr_time = time_tile(bands, "S2A", "numexpr", n_blocks, args.repeats)
+        print("numexpr (" + str(ne.detect_number_of_threads()) + " threads): " + str(round(numexpr_time, 2)) + " s")
+        print("Speedup: " + str(round(numpy_time/numexpr_time, 2)) + "x")
+    else:
+        print("numexpr is not installed")
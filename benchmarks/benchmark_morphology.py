@@ -0,0 +1,86 @@
+#!/usr/bin/env python3.9
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the mask morphology functions against the previous implementations, at the sizes configured in
+User_Inputs masking_options ("dilation_values", "land_buffer" and "cloud_mask_dilation") and at larger sizes.
+Results must be identical. Run from the repository folder: python -m benchmarks.benchmark_morphology
+
+@author: AIR Centre
+"""
+
+### Import Libraries ###################################################################################################################
+import argparse
+import time
+import numpy as np
+from scipy import ndimage
+try:
+    from skimage.morphology import dilation as skimage_dilation
+except ImportError:
+    skimage_dilation = None
+
+### Import Defined Functions ###########################################################################################################
+from configs.User_Inputs import masking_options
+from modules.Morphology import dilate_cross, dilate_disk, erode_square, disk
+
+########################################################################################################################################
+def synthetic_mask(size, fraction):
+    """
+    This function creates a synthetic binary mask with blobs of different sizes.
+    Input: size - Mask size in pixels.
+           fraction - Approximate fraction of mask pixels.
+    Output: mask - Array (size, size) as uint8.
+    """
+    rng = np.random.default_rng(0)
+    smooth = ndimage.gaussian_filter(rng.random((size, size)).astype(np.float32), 3)
+    return (smooth > np.quantile(smooth, 1-fraction)).astype(np.uint8)
+
+########################################################################################################################################
+def compare(name, previous, new, repeats):
+    """
+    This function times the previous and the new implementations and checks that the results are identical.
+    Input: name - Name of the operation.
+           previous, new - Functions without arguments.
+           repeats - Number of repetitions, the best is kept.
+    Output: Printed times, speedup and check.
+    """
+    times = []
+    for function in (previous, new):
+        best = float("inf")
+        for _ in range(repeats):
+            time0 = time.perf_counter()
+            result = function()
+            best = min(best, time.perf_counter()-time0)
+        times.append((best, result))
+    identical = np.array_equal(np.asarray(times[0][1]).astype(np.uint8), times[1][1])
+    print(name + ": previous " + str(round(times[0][0], 2)) + " s, new " + str(round(times[1][0], 2)) + " s (" +
+          str(round(times[0][0]/times[1][0], 1)) + "x), identical: " + str(identical))
+
+########################################################################################################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mask morphology benchmark.")
+    parser.add_argument("--size", type=int, default=5490, help="Mask size in pixels (10980 for 10 m tiles).")
+    parser.add_argument("--repeats", type=int, default=1, help="Number of repetitions.")
+    args = parser.parse_args()
+
+    mask = synthetic_mask(args.size, 0.15)
+    print("Mask: " + str(args.size) + "x" + str(args.size) + ", " + str(round(mask.mean()*100, 1)) + "% mask pixels")
+
+    # NDWI and Band 8 masks dilation (previously ndimage.binary_dilation with iterations)
+    for iterations in sorted(set(masking_options["dilation_values"]+[20])):
+        compare("Features mask dilation, " + str(iterations) + " iterations",
+                lambda: ndimage.binary_dilation(mask, iterations=iterations), lambda: dilate_cross(mask, iterations), args.repeats)
+
+    # Land buffer (previously minimum_filter over the int64 array of np.where)
+    water = 1-mask
+    for buffer_size in sorted(set([masking_options["land_buffer"], 50]) - {0}):
+        compare("Land buffer, " + str(buffer_size) + " pixels",
+                lambda: ndimage.minimum_filter(water.astype(np.int64), size=2*buffer_size+1, mode='constant', cval=1),
+                lambda: erode_square(water, buffer_size, border_value=1), args.repeats)
+
+    # Cloud mask dilation (previously done inside s2cloudless by skimage dilation with a disk)
+    for radius in sorted(set([masking_options["cloud_mask_dilation"], 25]) - {0}):
+        if skimage_dilation is not None:
+            previous = lambda: skimage_dilation(mask, disk(radius))
+        else:
+            previous = lambda: ndimage.grey_dilation(mask, footprint=disk(radius).astype(bool))
+        compare("Cloud mask dilation, disk of " + str(radius) + " pixels", previous, lambda: dilate_disk(mask, radius), args.repeats)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3.9
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the storage profiles (size, write and read throughput, precision) for a features stack.
+Uses an existing stack (e.g. from 1_Atmospheric_Corrected_Products) or a synthetic one.
+Run from the repository folder: python -m benchmarks.benchmark_storage --stack path/to/name_stack.tif
+
+@author: AIR Centre
+"""
+
+### Import Libraries ###################################################################################################################
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+from osgeo import gdal
+from scipy import ndimage
+
+### Import Defined Functions ###########################################################################################################
+from modules.Auxiliar import set_storage_profile, creation_options
+
+########################################################################################################################################
+def synthetic_stack(size, n_bands):
+    """
+    This function creates a synthetic stack with smooth spatial structure, noise and a NaN border.
+    Input: size - Stack size in pixels.
+           n_bands - Number of bands.
+    Output: stack - Array (bands, rows, columns) as float32.
+    """
+    rng = np.random.default_rng(0)
+    base = ndimage.gaussian_filter(rng.random((size, size)).astype(np.float32), 20)
+    stack = np.stack([base*0.2*(1+0.1*i) + rng.normal(0, 0.003, (size, size)).astype(np.float32) for i in range(n_bands)])
+    stack[:, :size//10, :] = np.nan
+
+    return stack.astype(np.float32)
+
+########################################################################################################################################
+def write_and_read(stack, path, options):
+    """
+    This function writes a stack with creation options and reads it back.
+    Input: stack - Array (bands, rows, columns) as float32.
+           path - Path of the TIF file. String.
+           options - List of GDAL creation options.
+    Output: write_time, read_time - Times in seconds.
+            file_size - Size of the file in bytes.
+            data - Array read back.
+    """
+    time0 = time.perf_counter()
+    raster = gdal.GetDriverByName("GTiff").Create(path, stack.shape[2], stack.shape[1], stack.shape[0], gdal.GDT_Float32, options=options)
+    for i in range(stack.shape[0]):
+        raster.GetRasterBand(i+1).WriteArray(stack[i])
+    raster = None
+    write_time = time.perf_counter()-time0
+
+    time0 = time.perf_counter()
+    raster = gdal.Open(path)
+    data = raster.ReadAsArray()
+    raster = None
+    read_time = time.perf_counter()-time0
+
+    return write_time, read_time, os.path.getsize(path), data
+
+########################################################################################################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Storage profiles benchmark.")
+    parser.add_argument("--stack", type=str, default=None, help="Path to an existing stack TIF. Default uses a synthetic stack.")
+    parser.add_argument("--size", type=int, default=2048, help="Synthetic stack size in pixels.")
+    args = parser.parse_args()
+
+    if args.stack is not None:
+        stack = gdal.Open(args.stack).ReadAsArray().astype(np.float32)
+    else:
+        stack = synthetic_stack(args.size, 19)
+    stack_mb = stack.nbytes/1e6
+    print("Stack: " + str(stack.shape) + ", " + str(round(stack_mb, 1)) + " MB in memory")
+
+    # Previous default (striped, uncompressed) and storage profiles
+    profiles = {"striped, uncompressed": None,
+                "ZSTD float32": {"compression": "ZSTD", "features_encoding": "float32"},
+                "ZSTD float32, band interleaved": {"compression": "ZSTD", "features_encoding": "float32", "stack_interleave": "band"},
+                "DEFLATE float32": {"compression": "DEFLATE", "features_encoding": "float32"},
+                "ZSTD float16": {"compression": "ZSTD", "features_encoding": "float16"},
+                "DEFLATE float16": {"compression": "DEFLATE", "features_encoding": "float16"}}
+
+    with tempfile.TemporaryDirectory() as temp_folder:
+        for i, (name, profile) in enumerate(profiles.items()):
+            if profile is None:
+                options = []
+            else:
+                set_storage_profile(profile)
+                options = creation_options(gdal.GDT_Float32, features_raster=True)
+            write_time, read_time, file_size, data = write_and_read(stack, os.path.join(temp_folder, str(i)+".tif"), options)
+            if i == 0:
+                reference_size = file_size
+            valid = np.isfinite(stack) & (np.abs(stack) >= 6.1e-5)
+            max_error = np.max(np.abs(data[valid]-stack[valid])/np.abs(stack[valid]))
+            print(name + ": " + str(round(file_size/1e6, 1)) + " MB (" + str(round(reference_size/file_size, 2)) + "x smaller), write " +
+                  str(round(stack_mb/write_time)) + " MB/s, read " + str(round(stack_mb/read_time)) + " MB/s, max relative error " +
+                  "{:.1e}".format(max_error))
@@ -74,6 +74,30 @@ download = True
 # Other inputs besides bool will stop the pré-start.
 atmospheric_correction = True
 
+# Atmospheric correction options.
+# Other inputs besides dictionary with correct values will stop the pré-start.
+                                  # Write the features stack directly from the ACOLITE L2W NetCDF in one pass (opt-in).
+                                  # ACOLITE then exports no TIFs and the L2W NetCDF (all requested bands of the ROI)
+                                  # is kept in each product and read by masking. It is only deleted with the 
+                                  # some_intermediate or all_intermediate options, otherwise it stays on disk.
+                                  # If False, ACOLITE exports per-band TIFs that are stacked afterwards.
+atmospheric_correction_options = {"direct_stack": False,
+                                  # Size in pixels of the blocks used to write the features stack, multiple of 256.
+                                  # Memory used depends on it, see Auxiliar.process_blocks.
+                                  "block_size": 1024,
+                                  # Number of threads used to compute the features stack blocks. 0 to use all cores.
+                                  "n_threads": 0,
+                                  # Backend of the spectral indices kernels, "numexpr" (fused and multi-threaded, requires numexpr), 
+                                  # "numpy" or "auto" (numexpr if installed). See benchmarks/benchmark_indices.py.
+                                  "index_backend": "auto",
+                                  # Store only the reflectance bands and a virtual stack (.vrt) where indices are evaluated on read.
+                                  # Saves disk and write time. If False, bands and indices are stored in a stack TIF.
+                                  # POS2IDON enables the VRT Python pixel functions when reading, to open the VRT outside
+                                  # (QGIS, gdal CLI) set GDAL_VRT_ENABLE_PYTHON=TRUSTED_MODULES and 
+                                  # GDAL_VRT_PYTHON_TRUSTED_MODULES=modules.SpectralIndices,modules.Masking, with the 
+                                  # POS2IDON folder in PYTHONPATH.
+                                  "virtual_stack": False}
+
 
 # Apply masks to the atmospheric corrected product.
 # True - Creates masks that are applied or will be applied (UNet) to AC products inside ac_products_folder.
@@ -105,7 +129,35 @@ masking_options = {"use_existing_ESAwc": False,
                    # Size of the disk in pixels to performe convolution (averaging probability over pixels).
                    "cloud_mask_average": 10, #10
                    # Size of the disk in pixels to performe dilation.
-                   "cloud_mask_dilation": 10 #50
+                   "cloud_mask_dilation": 10, #50
+                   # Resolution (meters) of the cloud detection: 10, 20, 60 or 120. Coarser resolutions are faster, the bands 
+                   # are averaged, the average and dilation sizes (pixels at 10m) are scaled and the mask is upsampled to 10m.
+                   # The cloud probabilities are saved in the ACOLITE product (_CLOUD_Probability.tif), quantized in steps of 1/250.
+                   "cloud_mask_resolution": 10,
+                   # Re-mask clouds of an existing masked product (QA mask) from the saved cloud probabilities of the same resolution,
+                   # to change threshold, average and dilation without running s2cloudless and the other masks again. Only the CLOUD
+                   # and FINAL layers of the QA mask are updated. The mask can differ from s2cloudless where the averaged probability is
+                   # within the quantization step of the threshold. False always runs s2cloudless.
+                   "cloud_remask": False,
+                   # Masks are combined in memory and saved as layers of a single QA mask (_QA_Mask.tif, one bit per mask: 
+                   # WATER 1, NDWI 2, BAND8 4, CLOUD 8, NAN 16, FINAL 32). True to also save each mask as a TIF (debugging).
+                   "save_intermediate_masks": False,
+                   # Expression combining the masks into the final mask, with mask names WATER, NDWI, BAND8, CLOUD and NAN and 
+                   # operators & (and), | (or), ~ (not), e.g. "WATER & NDWI & ~CLOUD". None to use water pixels with 
+                   # features (NDWI or BAND8 mask, if used) and without clouds (if cloud mask is used).
+                   "final_mask_expression": None,
+                   # Output of masking for RF and XGB: "tif" writes the masked stack, "indices" only saves the indices of valid 
+                   # pixels (features are read from the stack during classification) and "features" also saves the features of 
+                   # valid pixels (_masked_stack.npz). With "indices" and "features" only valid pixels are classified, split 
+                   # and mosaic are not used. "vrt" writes a masked virtual stack (VRT) over the atmospheric corrected stack, 
+                   # the final mask (QA mask) is applied on read and the stack is not duplicated (also for Unet, instead of 
+                   # copying the stack). Unet uses the stack with "tif", "indices" and "features". The "vrt" stack can only be 
+                   # read outside POS2IDON (QGIS, gdal CLI) with the GDAL configuration of virtual_stack (see above).
+                   "masked_stack_format": "tif",
+                   # Minimum percentage of valid pixels (final mask) to classify a product. Products below it (and products 
+                   # without valid pixels) are not split or classified, placeholder maps are saved and the coverage of each 
+                   # mask is saved in Triage.txt of the masked product. 0 to only skip products without valid pixels.
+                   "min_valid_coverage": 0
                    }
 
 
@@ -120,6 +172,14 @@ classification = True
                           # Split full image into 256x256 patches and consider each one during classification.
                           # Mosaic all patches into single image after classification.
 classification_options = {"split_and_mosaic": False,
+                          # Only used with split_and_mosaic. Saves the patches of the masked stack as TIF files (Patches folder) before
+                          # classification. False predicts the patches in memory, read from the masked stack, without patch files.
+                          "patch_files": False,
+                          # Only used with split_and_mosaic. Tiling of the patches:
+                          # "default" - 256x256 patches with overlap of 50%.
+                          # "auto" - Patch size (multiple of 16), overlap and batch size planned from the image size, the memory and
+                          # a timing probe of the model (without probe for patch files). The plan and its cost are logged.
+                          "tiling": "default",
                           # Outputs TIF file with the class probability for each pixel.
                           "classification_probabilities": False,
                           # Machine Learning algorithm:
@@ -157,18 +217,33 @@ classification_options = {"split_and_mosaic": False,
           # Deletes original product after each processing.
 delete = {"original_products": False, # True
           # Delete some intermediate after each processing - Recommended:
-          # Deletes Surface_Reflectance_Bands, Top_Atmosphere_Bands, masked Patches,
+          # Deletes Surface_Reflectance_Bands, Top_Atmosphere_Bands, L2W NetCDF, masked Patches,
           # Mosaics and single intermediate files in both sc_maps and proba_maps.
           # But DOESN'T, delete atmospheric correction stack, Masks, masked stack.
           "some_intermediate": False, # True
           # Delete all intermediate after each processing - Not Recommended:
           # Only final results available.
-          # Deletes Surface_Reflectance_Bands, Top_Atmosphere_Bands, masked Patches,
+          # Deletes Surface_Reflectance_Bands, Top_Atmosphere_Bands, L2W NetCDF, masked Patches,
           # Mosaics and single intermediate files in both sc_maps and proba_maps.
           # BUT ALSO, deletes atmospheric correction stack, Masks, masked stack.
           "all_intermediate": False
           }
 
+# Storage of rasters created by the pipeline (stacks, masks, patches and maps), all with 256x256 internal tiles.
+# Other inputs besides dictionary with correct values will stop the pré-start.
+                  # Compression: "ZSTD", "DEFLATE", "LZW" or "NONE". Lossless, with predictor.
+storage_options = {"compression": "ZSTD",
+                   # Encoding of features (bands and indices) in stacks and patches:
+                   # "float32" - Lossless.
+                   # "float16" - Half precision, approx. 2x smaller. Relative error below 0.05% (absolute below 6e-8 
+                   #             for values under 6.1e-5), values above 65504 become inf.
+                   "features_encoding": "float32",
+                   # Layout of stacks and patches:
+                   # "pixel" - Features of a pixel stored together (INTERLEAVE=PIXEL), best for RF and XGB.
+                   # "band" - Each feature stored as a full band (INTERLEAVE=BAND), best for UNET.
+                   # "auto" - "pixel" for RF and XGB, "band" for UNET, following classification_options "ml_algorithm".
+                   "stack_interleave": "auto"}
+
 
 # FOLDERS NAMES ############################################################################
 
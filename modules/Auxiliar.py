@@ -15,6 +15,11 @@ from osgeo import gdal
 import pandas as pd
 import requests
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+
+# Storage profile of the rasters created by the pipeline, updated from User_Inputs storage_options with set_storage_profile
+STORAGE_PROFILE = {"compression": "ZSTD", "features_encoding": "float32", "interleave": "PIXEL"}
 
 #################################################################################################
 def input_checker():
@@ -30,11 +35,12 @@ def input_checker():
     from configs.User_Inputs import search, service, service_options, roi, nrt_sensing_period, sensing_period
     from configs.User_Inputs import processing
     from configs.User_Inputs import download
-    from configs.User_Inputs import atmospheric_correction
+    from configs.User_Inputs import atmospheric_correction, atmospheric_correction_options
     from configs.User_Inputs import masking, masking_options
     from configs.User_Inputs import classification, classification_options
-    from configs.User_Inputs import delete
+    from configs.User_Inputs import delete, storage_options
     from configs.User_Inputs import s2l1c_products_folder, ac_products_folder, masked_products_folder, classification_products_folder
+    from modules import SpectralIndices
     
     inputs_flag = 1
     if isinstance(search, bool):
@@ -115,6 +121,29 @@ def input_checker():
         inputs_flag = inputs_flag*0
         log_list.append("'atmospheric_correction' is not boolean.")
 
+    if isinstance(atmospheric_correction_options, dict):
+        if len(atmospheric_correction_options) == 5:
+            if (isinstance(atmospheric_correction_options["direct_stack"], bool)) and \
+                (isinstance(atmospheric_correction_options["block_size"], int)) and \
+                (atmospheric_correction_options["block_size"] >= 256) and (atmospheric_correction_options["block_size"]%256 == 0) and \
+                (isinstance(atmospheric_correction_options["n_threads"], int)) and (atmospheric_correction_options["n_threads"] >= 0) and \
+                (atmospheric_correction_options["index_backend"] in ["auto", "numexpr", "numpy"]) and \
+                (isinstance(atmospheric_correction_options["virtual_stack"], bool)):
+                inputs_flag = inputs_flag*1
+            else:
+                inputs_flag = inputs_flag*0
+                log_list.append("'atmospheric_correction_options' has incorrect values.")
+            # numexpr backend needs numexpr installed
+            if (atmospheric_correction_options["index_backend"] == "numexpr") and (SpectralIndices.ne is None):
+                inputs_flag = inputs_flag*0
+                log_list.append("'atmospheric_correction_options' index_backend is numexpr, but numexpr is not installed.")
+        else:
+            inputs_flag = inputs_flag*0
+            log_list.append("'atmospheric_correction_options' does not have dimension 5.")
+    else:
+        inputs_flag = inputs_flag*0
+        log_list.append("'atmospheric_correction_options' is not dictionary.")
+
     if isinstance(masking, bool):
         inputs_flag = inputs_flag*1
     else:
@@ -122,18 +151,24 @@ def input_checker():
         log_list.append("'masking' is not boolean.")
 
     if isinstance(masking_options, dict):
-        if len(masking_options) == 9:
+        if len(masking_options) == 15:
             if isinstance(masking_options["use_existing_ESAwc"], bool) and isinstance(masking_options["land_buffer"], int) and\
                 isinstance(masking_options["threshold_values"], list) and isinstance(masking_options["dilation_values"], list) and\
                 isinstance(masking_options["cloud_mask"], bool) and isinstance(masking_options["cloud_mask_threshold"], float) and\
-                isinstance(masking_options["cloud_mask_average"], int) and isinstance(masking_options["cloud_mask_dilation"], int):
+                isinstance(masking_options["cloud_mask_average"], int) and isinstance(masking_options["cloud_mask_dilation"], int) and\
+                masking_options["cloud_mask_resolution"] in [10, 20, 60, 120] and\
+                isinstance(masking_options["cloud_remask"], bool) and\
+                isinstance(masking_options["save_intermediate_masks"], bool) and\
+                (isinstance(masking_options["final_mask_expression"], str) or masking_options["final_mask_expression"] is None) and\
+                masking_options["masked_stack_format"] in ["tif", "indices", "features", "vrt"] and\
+                isinstance(masking_options["min_valid_coverage"], (int, float)) and (0 <= masking_options["min_valid_coverage"] <= 100):
                 inputs_flag = inputs_flag*1
             else:
                 inputs_flag = inputs_flag*0
                 log_list.append("'masking_options' has incorrect values.")
         else:
             inputs_flag = inputs_flag*0
-            log_list.append("'masking_options' does not have dimension 9.")
+            log_list.append("'masking_options' does not have dimension 15.")
     else:
         inputs_flag = inputs_flag*0
         log_list.append("'masking_options' is not dictionary.")
@@ -145,8 +180,9 @@ def input_checker():
         log_list.append("'classification' is not boolean.")
 
     if isinstance(classification_options, dict):
-        if len(classification_options) == 10:
+        if len(classification_options) == 12:
             if isinstance(classification_options["split_and_mosaic"], bool) and isinstance(classification_options["classification_probabilities"], bool) and\
+                isinstance(classification_options["patch_files"], bool) and classification_options["tiling"] in ["default", "auto"] and\
                 isinstance(classification_options["ml_algorithm"], str) and isinstance(classification_options["model_path"], str) and\
                 isinstance(classification_options["n_classes"], int) and isinstance(classification_options["features"], tuple) and\
                 isinstance(classification_options["n_hchannels"], int) and isinstance(classification_options["features_mean"], list) and\
@@ -157,7 +193,7 @@ def input_checker():
                 log_list.append("'classification_options' has incorrect values.")
         else:
             inputs_flag = inputs_flag*0
-            log_list.append("'classification_options' does not have dimension 10.")
+            log_list.append("'classification_options' does not have dimension 12.")
     else:
         inputs_flag = inputs_flag*0
         log_list.append("'classification_options' is not dictionary.")
@@ -177,6 +213,22 @@ def input_checker():
         inputs_flag = inputs_flag*0
         log_list.append("'delete' is not dictionary.")
 
+    if isinstance(storage_options, dict):
+        if len(storage_options) == 3:
+            if (storage_options["compression"] in ["ZSTD", "DEFLATE", "LZW", "NONE"]) and \
+                (storage_options["features_encoding"] in ["float32", "float16"]) and \
+                (storage_options["stack_interleave"] in ["auto", "pixel", "band"]):
+                inputs_flag = inputs_flag*1
+            else:
+                inputs_flag = inputs_flag*0
+                log_list.append("'storage_options' has incorrect values.")
+        else:
+            inputs_flag = inputs_flag*0
+            log_list.append("'storage_options' does not have dimension 3.")
+    else:
+        inputs_flag = inputs_flag*0
+        log_list.append("'storage_options' is not dictionary.")
+
     if isinstance(s2l1c_products_folder, str):
         inputs_flag = inputs_flag*1
     else:
@@ -317,6 +369,125 @@ def delete_file(file_path):
     if os.path.exists(file_path):
         os.remove(file_path)
 
+#################################################################################################
+def folder_size(folder_path):
+    """
+    This function calculates the size of all files inside a folder and sub-folders.
+    Input: folder_path - Path to the folder.
+    Output: size - Size in bytes. 0 if folder does not exist.
+    """
+    size = 0
+    for root, _, files in os.walk(folder_path):
+        for file in files:
+            size += os.path.getsize(os.path.join(root, file))
+    
+    return size
+
+#################################################################################################
+def set_storage_profile(storage_options, ml_algorithm=None):
+    """
+    This function sets the storage profile used to create all pipeline rasters.
+    With "auto" stack interleave, stacks and patches are pixel interleaved for pixel-vector models (RF and XGB), 
+    which read all features of a pixel together, and band interleaved for UNET, which reads full bands.
+    Input: storage_options - Storage options dictionary from User_Inputs.
+           ml_algorithm - Configured model, 'rf', 'xgb' or 'unet'. Only used with "auto" stack interleave.
+    Output: log_list - Logging messages.
+    """
+    # Logging list
+    log_list = []
+
+    STORAGE_PROFILE.update({key:value for key, value in storage_options.items() if key != "stack_interleave"})
+    interleave = storage_options.get("stack_interleave", "auto")
+    if interleave == "auto":
+        interleave = "band" if ml_algorithm == "unet" else "pixel"
+    STORAGE_PROFILE["interleave"] = interleave.upper()
+    log_list.append("Storage profile: 256x256 tiles, " + STORAGE_PROFILE["compression"] + " compression, features encoded as " + 
+                    STORAGE_PROFILE["features_encoding"] + ", stacks " + STORAGE_PROFILE["interleave"].lower() + " interleaved")
+
+    return log_list
+
+#################################################################################################
+def creation_options(data_type, features_raster=False):
+    """
+    This function provides the GeoTIFF creation options of the storage profile: 256x256 internal tiles and 
+    compression with predictor (floating point predictor for floats, horizontal differencing for integers, none for bytes).
+    Features (reflectances and indices) with "float16" encoding are stored as half precision floats, read back as 
+    float32 by GDAL and rasterio. Precision loss: relative error below 2^-11 (0.05%) for absolute values above 6.1e-5 
+    and absolute error below 6e-8 under it. Values above 65504 become inf. NaN is kept.
+    Features rasters use the stack interleave of the storage profile (INTERLEAVE=PIXEL or BAND).
+    Input: data_type - GDAL data type, e.g. gdal.GDT_Float32.
+           features_raster - True for rasters with features (stacks and patches). Bool.
+    Output: options - List of GDAL creation options.
+    """
+    options = ["TILED=YES", "BLOCKXSIZE=256", "BLOCKYSIZE=256", "BIGTIFF=IF_SAFER"]
+    if STORAGE_PROFILE["compression"] != "NONE":
+        options.append("COMPRESS=" + STORAGE_PROFILE["compression"])
+        if data_type in [gdal.GDT_Float32, gdal.GDT_Float64]:
+            options.append("PREDICTOR=3")
+        elif data_type != gdal.GDT_Byte:
+            options.append("PREDICTOR=2")
+    if (features_raster == True) and (data_type == gdal.GDT_Float32) and (STORAGE_PROFILE["features_encoding"] == "float16"):
+        options.append("NBITS=16")
+    if features_raster == True:
+        options.append("INTERLEAVE=" + STORAGE_PROFILE["interleave"])
+
+    return options
+
+#################################################################################################
+def rasterio_creation_options(dtype, features_raster=False):
+    """
+    This function provides the creation options of the storage profile as rasterio keyword arguments.
+    Input: dtype - Data type as string, e.g. "float32".
+           features_raster - True for rasters with features (stacks and patches). Bool.
+    Output: Dictionary of creation options, to use as rio.open(path, "w", **options).
+    """
+    gdal_types = {"uint8": gdal.GDT_Byte, "float32": gdal.GDT_Float32, "float64": gdal.GDT_Float64}
+    options = creation_options(gdal_types.get(str(dtype), gdal.GDT_Int32), features_raster)
+
+    return {option.split("=")[0].lower():option.split("=")[1] for option in options}
+
+#################################################################################################
+def block_windows(x_size, y_size, block_size):
+    """
+    This function splits a raster into square block windows. Use a multiple of the GeoTIFF tile size
+    to align the windows with the internal tiling.
+    Input: x_size, y_size - Raster size in pixels.
+           block_size - Size of the block in pixels.
+    Output: windows - List of windows as (xoff, yoff, xsize, ysize).
+    """
+    windows = []
+    for yoff in range(0, y_size, block_size):
+        for xoff in range(0, x_size, block_size):
+            windows.append((xoff, yoff, min(block_size, x_size-xoff), min(block_size, y_size-yoff)))
+    
+    return windows
+
+#################################################################################################
+def process_blocks(windows, process_block, write_block, n_threads=0):
+    """
+    This function processes block windows with a thread pool and writes the results in the main thread, 
+    in the windows order. Only 2*n_threads blocks are kept in memory, so peak memory depends on the block
+    size and not on the raster size.
+    Input: windows - List of windows as (xoff, yoff, xsize, ysize).
+           process_block - Function called as process_block(window), runs inside the thread pool.
+           write_block - Function called as write_block(window, result), runs in the main thread.
+           n_threads - Number of threads, 0 to use all cores.
+    Output: Results written by write_block.
+    """
+    if n_threads <= 0:
+        n_threads = os.cpu_count() or 1
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        pending = deque()
+        for window in windows:
+            pending.append((window, executor.submit(process_block, window)))
+            if len(pending) >= 2*n_threads:
+                done_window, future = pending.popleft()
+                write_block(done_window, future.result())
+        while len(pending) != 0:
+            done_window, future = pending.popleft()
+            write_block(done_window, future.result())
+
 #################################################################################################
 def NearRealTimeSensingDate():
     """
@@ -365,9 +536,16 @@ def delete_intermediate(ac_product, masked_product, classification_product, mode
         # Top_Atmosphere_Bands
         top_atmosphere_bands = os.path.join(ac_product, "Top_Atmosphere_Bands")
         delete_folder(top_atmosphere_bands)
-        # AC Stack
-        ac_stack = glob.glob(os.path.join(ac_product, "*stack.tif"))[0]
-        delete_file(ac_stack)
+        # ACOLITE L2W NetCDF (direct stack)
+        for l2w in glob.glob(os.path.join(ac_product, "*_L2W.nc")):
+            delete_file(l2w)
+        # AC Stack (and bands of virtual stack)
+        for ac_stack in glob.glob(os.path.join(ac_product, "*stack.tif")) + glob.glob(os.path.join(ac_product, "*stack.vrt")) + \
+                        glob.glob(os.path.join(ac_product, "*_bands.tif")):
+            delete_file(ac_stack)
+        # Cloud probabilities
+        for cloud_probability in glob.glob(os.path.join(ac_product, "*_CLOUD_Probability.tif")):
+            delete_file(cloud_probability)
         
         # -> Masking
         # Masks 
@@ -376,9 +554,10 @@ def delete_intermediate(ac_product, masked_product, classification_product, mode
         # Masked Patches
         masked_patches = os.path.join(masked_product, "Patches")
         delete_folder(masked_patches)
-        # Masked Stack
-        masked_stack = glob.glob(os.path.join(masked_product, "*stack.tif"))[0]
-        delete_file(masked_stack)
+        # Masked Stack (and bands of virtual stack, valid pixels)
+        for masked_stack in glob.glob(os.path.join(masked_product, "*stack.tif")) + glob.glob(os.path.join(masked_product, "*stack.vrt")) + \
+                            glob.glob(os.path.join(masked_product, "*_bands.tif")) + glob.glob(os.path.join(masked_product, "*stack.npz")):
+            delete_file(masked_stack)
 
         # -> Classification
         # sc_maps
@@ -409,6 +588,9 @@ def delete_intermediate(ac_product, masked_product, classification_product, mode
         # Top_Atmosphere_Bands
         top_atmosphere_bands = os.path.join(ac_product, "Top_Atmosphere_Bands")
         delete_folder(top_atmosphere_bands)
+        # ACOLITE L2W NetCDF (direct stack)
+        for l2w in glob.glob(os.path.join(ac_product, "*_L2W.nc")):
+            delete_file(l2w)
         
         # -> Masking
         # Masked Patches
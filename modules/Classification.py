@@ -23,7 +23,11 @@ import time
 
 ### Import Defined Functions ###########################################################################################
 from modules.unet import UNet
-from modules.Auxiliar import CreateBrandNewFolder
+from modules.Auxiliar import CreateBrandNewFolder, creation_options, rasterio_creation_options
+from modules.S2L2Processing import stack_band_numbers, read_pixel_vectors, vrt_python_options, enable_vrt_python
+from modules.Tiling import generate_patches, read_final_mask, save_patch_index, plan_tiling, patch_windows, mosaic_regions, TILING_MAX_BATCH_SIZE, \
+                           DEFAULT_PATCH_SIZE, DEFAULT_OVERLAP
+from modules.Masking import qa_mask_path
 
 ########################################################################################################################
 def load_ml_model(model_folder, classification_options):
@@ -89,32 +93,19 @@ def convert_stack_rfxgb(image, classification_options):
     """
     This function only reads the features of interest from a stack TIF file.
     Then it converts to dataframe (RF and XGB) or a short version of the stack raster (UNET).
-    ATTENTION: If you decide to include more features than the default 'all_features', you 
-               will need to change the dictionary.
+    Features are selected by name, using the stack band descriptions.
     """
+    # Select features of interest from the stack
+    features_n = stack_band_numbers(image, classification_options["features"])
+
     # Read stack
     stack_raster = gdal.Open(image)
 
-    # Select features of interest from the stack
-    all_features = {'B01':1, 'B02':2, 'B03':3, 'B04':4, 'B05':5, 'B06':6, 'B07':7, 'B08':8, 'B8A':9, 'B11':10, 
-                    'B12':11, 'NDVI':12, 'FAI':13, 'FDI':14, 'SI':15, 'NDWI':16, 'NRD':17, 'NDMI':18, 'BSI':19}
-    features_n = [all_features[i] for i in classification_options["features"]]
-
-        
-    # Create dataframe with only the data from the features of interest
-    # Init
-    init_stack_data = stack_raster.GetRasterBand(features_n[0]).ReadAsArray()
-    # Reshape as single column
-    stack_data = init_stack_data.reshape(-1,1)
-
-    for feature_n in features_n[1:]:
-        # Get data
-        feature_stack_data = stack_raster.GetRasterBand(feature_n).ReadAsArray()
-        feature_stack_reshaped = feature_stack_data.reshape(-1,1)
-        stack_data = np.concatenate([stack_data, feature_stack_reshaped], axis=1)
+    # Read the features of interest directly as (pixels x features), see read_pixel_vectors
+    stack_data = read_pixel_vectors(stack_raster, features_n)
 
     # Shape to use in reshape
-    stack_data_shape = init_stack_data.shape
+    stack_data_shape = (stack_raster.RasterYSize, stack_raster.RasterXSize)
     # Global dataframe to predict
     global_predict_df = pd.DataFrame(stack_data, columns=classification_options["features"])
 
@@ -123,6 +114,39 @@ def convert_stack_rfxgb(image, classification_options):
 
     return stack_raster, stack_data_shape, global_predict_df, no_nans_predict_df
 
+########################################################################################################################
+def convert_masked_pixels_rfxgb(masked_pixels, classification_options):
+    """
+    This function reads the valid pixels of a masked product (NPZ file, see mask_stack_pixels) to a dataframe indexed
+    by the flat pixel indices (RF and XGB). The features are taken from the NPZ file if saved with the same features,
+    otherwise only the valid pixels are read from the stack.
+    Input: masked_pixels - Path to the NPZ file. String.
+           classification_options - Classification options dictionary, see create_sc_proba_maps.
+    Output: stack_raster - Stack opened with GDAL (georeference of the maps).
+            stack_data_shape - Shape of the stack (rows, columns).
+            global_predict_df - None, the masked pixels are not read.
+            no_nans_predict_df - Dataframe of valid pixels without NaNs.
+    """
+    with np.load(masked_pixels) as masked_pixels_data:
+        indices = masked_pixels_data["indices"].astype(np.int64)
+        image = str(masked_pixels_data["stack"])
+        if ("features" in masked_pixels_data) and (tuple(masked_pixels_data["features"]) == tuple(classification_options["features"])):
+            stack_data = masked_pixels_data["pixels"]
+        else:
+            stack_data = None
+
+    # Read stack, only the features of interest of valid pixels if not saved
+    stack_raster = gdal.Open(image)
+    if stack_data is None:
+        stack_data = read_pixel_vectors(stack_raster, stack_band_numbers(image, classification_options["features"]), indices=indices)
+
+    # Shape to use in reshape
+    stack_data_shape = (stack_raster.RasterYSize, stack_raster.RasterXSize)
+    # Dataframe to predict, without NaNs
+    no_nans_predict_df = pd.DataFrame(stack_data, index=indices, columns=classification_options["features"]).dropna(axis=0, how='any')
+
+    return stack_raster, stack_data_shape, None, no_nans_predict_df
+
 ########################################################################################################################
 def save_maps(output_folder, image_name, img, predict_results_reshape, probability_results_reshape):
     """
@@ -131,7 +155,8 @@ def save_maps(output_folder, image_name, img, predict_results_reshape, probabili
     sc_output_folder = os.path.join(output_folder, "sc_maps")
     # Initiate raster and save scene classification results to folder
     driver = gdal.GetDriverByName("GTiff")
-    sc_raster = driver.Create(os.path.join(sc_output_folder, image_name+"-scmap.tif"), img.RasterXSize, img.RasterYSize, 1, gdal.GDT_Byte)
+    sc_raster = driver.Create(os.path.join(sc_output_folder, image_name+"-scmap.tif"), img.RasterXSize, img.RasterYSize, 1, gdal.GDT_Byte, 
+                              options=creation_options(gdal.GDT_Byte))
     sc_raster.SetProjection(img.GetProjectionRef())
     sc_raster.SetGeoTransform(img.GetGeoTransform())
     sc_raster_band = sc_raster.GetRasterBand(1)
@@ -143,13 +168,65 @@ def save_maps(output_folder, image_name, img, predict_results_reshape, probabili
         proba_output_folder = os.path.join(output_folder, "proba_maps")
         # Initiate raster and save probabilities results to folder
         driver = gdal.GetDriverByName("GTiff")
-        probability_raster = driver.Create(os.path.join(proba_output_folder, image_name+"-probamap.tif"), img.RasterXSize, img.RasterYSize, 1, gdal.GDT_Float32)
+        probability_raster = driver.Create(os.path.join(proba_output_folder, image_name+"-probamap.tif"), img.RasterXSize, img.RasterYSize, 1, gdal.GDT_Float32, 
+                                           options=creation_options(gdal.GDT_Float32))
         probability_raster.SetProjection(img.GetProjectionRef())
         probability_raster.SetGeoTransform(img.GetGeoTransform())
         probability_raster_band = probability_raster.GetRasterBand(1)
         probability_raster_band.WriteArray(probability_results_reshape)
         probability_raster = None
 
+########################################################################################################################
+def save_placeholder_maps(output_folder, image_name, reference_path, classification_options):
+    """
+    This function saves scene classification (and probability) maps filled with 0, the value of pixels that are not
+    classified, for products not classified (see Masking.triage_product). Blocks are not computed or written one 
+    by one, so the maps are cheap to create.
+    Input: output_folder - Path to the folder where the folders with scene classification (and probability) maps will be saved. String.
+           image_name - Name of the maps, e.g. masked stack name and ML algorithm. String.
+           reference_path - Path to a raster with the georeference of the maps (e.g. QA mask). String.
+           classification_options - Classification options dictionary, see create_sc_proba_maps.
+    Output: Scene Classification map as TIF.
+            Class probability map as TIF (optional).
+    """
+    reference = gdal.Open(reference_path)
+    maps = [("sc_maps", "-scmap.tif", gdal.GDT_Byte)]
+    if classification_options["classification_probabilities"] == True:
+        maps.append(("proba_maps", "-probamap.tif", gdal.GDT_Float32))
+    driver = gdal.GetDriverByName("GTiff")
+    for folder, suffix, data_type in maps:
+        CreateBrandNewFolder(os.path.join(output_folder, folder))
+        placeholder_raster = driver.Create(os.path.join(output_folder, folder, image_name+suffix), reference.RasterXSize, 
+                                           reference.RasterYSize, 1, data_type, options=creation_options(data_type))
+        placeholder_raster.SetProjection(reference.GetProjectionRef())
+        placeholder_raster.SetGeoTransform(reference.GetGeoTransform())
+        placeholder_raster = None
+    reference = None
+
+########################################################################################################################
+def rfxgb_predict(model, no_nans_predict_df, classification_options):
+    """
+    This function predicts the classes (and probabilities) of a dataframe without NaNs with RF or XGBoost.
+    Input: model - RF or XGBoost model, see load_ml_model.
+           no_nans_predict_df - Dataframe to predict, without NaNs.
+           classification_options - Classification options dictionary, see create_sc_proba_maps.
+    Output: predict_results - Array of classes.
+            probability_results - Probabilities, None without "classification_probabilities".
+    """
+    if classification_options["ml_algorithm"] == "xgb":
+        predict_results_0 = model.predict(no_nans_predict_df)
+        predict_results = predict_results_0 + 1
+    else:
+        predict_results = model.predict(no_nans_predict_df)
+
+    if classification_options["classification_probabilities"] == True:
+        probability_results_all = model.predict_proba(no_nans_predict_df)
+        probability_results = np.max(probability_results_all)
+    else:
+        probability_results = None
+
+    return predict_results, probability_results
+
 ########################################################################################################################
 def rfxgb_prediction(model, output_folder, image_name, img, img_shape, global_predict_df, no_nans_predict_df, ignore_log, classification_options):
     """
@@ -159,53 +236,38 @@ def rfxgb_prediction(model, output_folder, image_name, img, img_shape, global_pr
     # Logging list
     log_list = []
 
-    # Structure of zero dataframe to store results
+    # Zero arrays to store results, pixels without prediction are 0
+    # (global_predict_df is None for valid pixels, see convert_masked_pixels_rfxgb)
     # Classification
-    predict_results_struct_df = pd.DataFrame(0, index=range(0, len(global_predict_df.index)), columns=['ClassNum'])
+    predict_results_flat = np.zeros(img_shape[0]*img_shape[1], dtype=np.float32)
     # Classes probability
     if classification_options["classification_probabilities"] == True:
-        probability_results_struct_df = pd.DataFrame(0, index=range(0, len(global_predict_df.index)), columns=['Prob'])
+        probability_results_flat = np.zeros(img_shape[0]*img_shape[1], dtype=np.float32)
+    else:
+        probability_results_flat = None
 
     # If dataframe to predict without NaNs is empty, then the final classification is only 0 (the same for probabilities).
     # A calculation between available data for prediction (without NaNs) and total data can be done here to only consider a percentage of more than 80% 
     if len(no_nans_predict_df.index) == 0:
         if ignore_log == False:
             log_list.append("Classification ignored, no dataframe without NaNs to predict")
-        predict_results_flat = np.array(predict_results_struct_df).flatten()
-        predict_results_reshape = predict_results_flat.reshape(img_shape)
-        # Classes probability
-        if classification_options["classification_probabilities"] == True:
-            probability_results_flat = np.array(probability_results_struct_df).flatten()
-            probability_results_reshape = probability_results_flat.reshape(img_shape)
-        else:
-            probability_results_reshape = None
-
     else:
         if ignore_log == False:
             log_list.append("Dataframe with no NaNs of shape " + str(no_nans_predict_df.shape))
         # Prediction
-        if classification_options["ml_algorithm"] == "xgb":
-            predict_results_0 = model.predict(no_nans_predict_df)
-            predict_results = predict_results_0 + 1
-        else:
-            predict_results = model.predict(no_nans_predict_df)
-
-        if classification_options["classification_probabilities"] == True:
-            probability_results_all = model.predict_proba(no_nans_predict_df)
-            probability_results = np.max(probability_results_all)
+        predict_results, probability_results = rfxgb_predict(model, no_nans_predict_df, classification_options)
          
-        # Index results, construct final dataframe and reshape
-        predict_results_indexed = pd.DataFrame(predict_results, index=no_nans_predict_df.index, columns=['ClassNum'])
-        predict_results_df = predict_results_indexed.combine_first(predict_results_struct_df)
-        predict_results_flat = np.array(predict_results_df).flatten()
-        predict_results_reshape = predict_results_flat.reshape(img_shape)
-        if classification_options["classification_probabilities"] == True:
-            probability_results_indexed = pd.DataFrame(probability_results, index=no_nans_predict_df.index, columns=['Prob'])
-            probability_results_df = probability_results_indexed.combine_first(probability_results_struct_df)
-            probability_results_flat = np.array(probability_results_df).flatten()
-            probability_results_reshape = probability_results_flat.reshape(img_shape)
-        else:
-            probability_results_reshape = None
+        # Scatter results to the flat pixel indices
+        predict_results_flat[no_nans_predict_df.index] = predict_results
+        if probability_results_flat is not None:
+            probability_results_flat[no_nans_predict_df.index] = probability_results
+
+    # Reshape
+    predict_results_reshape = predict_results_flat.reshape(img_shape)
+    if probability_results_flat is not None:
+        probability_results_reshape = probability_results_flat.reshape(img_shape)
+    else:
+        probability_results_reshape = None
 
     # Save maps
     save_maps(output_folder, image_name, img, predict_results_reshape, probability_results_reshape)
@@ -217,16 +279,13 @@ def convert_stack_unet(image, classification_options):
     """
     This function only reads the features of interest from a stack TIF file.
     Then it converts to a short version of the stack raster (UNET).
-    ATTENTION: If you decide to include more features than the default 'all_features', you 
-               will need to change the dictionary.
+    Features are selected by name, using the stack band descriptions.
     """
     # Select features of interest from the stack
-    all_features = {'B01':1, 'B02':2, 'B03':3, 'B04':4, 'B05':5, 'B06':6, 'B07':7, 'B08':8, 'B8A':9, 'B11':10, 
-                    'B12':11, 'NDVI':12, 'FAI':13, 'FDI':14, 'SI':15, 'NDWI':16, 'NRD':17, 'NDMI':18, 'BSI':19}
-    features_n = [all_features[i] for i in classification_options["features"]]
+    features_n = stack_band_numbers(image, classification_options["features"])
 
-    # Read image
-    with rio.open(image, mode ='r') as src:
+    # Read image (virtual stacks need the GDAL options of their Python pixel functions)
+    with rio.Env(**vrt_python_options()), rio.open(image, mode ='r') as src:
         tags = src.tags().copy()
         meta = src.meta
         img = src.read(features_n)
@@ -250,28 +309,12 @@ def unet_prediction(device, model, output_folder, image_name, img, meta, tags, d
         probamaps_folder = os.path.join(output_folder, "proba_maps") 
         probamap_path = os.path.join(probamaps_folder, image_name+"_unet-probamap.tif")
     
-    impute_nan = np.tile(classification_options["features_mean"], (256,256,1))
-    transform_test = transforms.Compose([transforms.ToTensor()])
-    standardization = transforms.Normalize(classification_options["features_mean"], classification_options["features_std"])
-
-    # Update meta to reflect the number of layers
-    meta.update(count = 1)
-
-    # Preprocessing before prediction
-    nan_mask = np.isnan(img)
-    img[nan_mask] = impute_nan[nan_mask]
-    img = transform_test(img)
-    img = standardization(img) 
-
-    # Image to Cuda if exist
-    img = img.to(device)
+    # Update meta to reflect the number of layers and storage profile
+    meta.update(count = 1, **rasterio_creation_options(meta["dtype"]))
 
     # Predictions
-    logits = model(img.unsqueeze(0))
-    probs = torch.nn.functional.softmax(logits.detach(), dim=1).cpu().numpy()
+    probs, probs_i = unet_predict(device, model, img, classification_options)
     if classification_options["classification_probabilities"] == True:
-        probs_i = probs.max(axis=1).squeeze()
-        probs = probs.argmax(1).squeeze()+1
         # Write TIFs
         with rio.open(scmap_path, 'w', **meta) as dst:
             dst.write_band(1, probs.astype(dtype).copy())
@@ -280,7 +323,6 @@ def unet_prediction(device, model, output_folder, image_name, img, meta, tags, d
             dst.write_band(1, probs_i.copy())
             dst.update_tags(**tags)
     else:
-        probs = probs.argmax(1).squeeze()+1
         # Write TIF
         with rio.open(scmap_path, 'w', **meta) as dst:
             dst.write_band(1, probs.astype(dtype).copy())
@@ -302,23 +344,12 @@ def unet_prediction_julia(device, model, mean_bands, std_bands, output_folder, i
         probamaps_folder = os.path.join(output_folder, "proba_maps") 
         probamap_path = os.path.join(probamaps_folder, image_name+"_unet-probamap.tif")
     
-    # Preprocessing before prediction
-    impute_nan = np.tile(classification_options["features_mean"], (256,256,1))
-    nan_mask = np.isnan(img)
-    img[nan_mask] = impute_nan[nan_mask]
-
-    # Update meta to reflect the number of layers
-    meta.update(count = 1)
-    from juliacall import Main as jl
-    logits = jl.Classification_Julia(device, img, model, mean_bands, std_bands)
-    logits = np.asarray(logits)
-    # Convert the array to a PyTorch tensor
-    logits = torch.tensor(logits)
-    probs = torch.nn.functional.softmax(logits.detach(), dim=1).cpu().numpy()
+    # Update meta to reflect the number of layers and storage profile
+    meta.update(count = 1, **rasterio_creation_options(meta["dtype"]))
 
+    # Predictions
+    probs, probs_i = unet_predict_julia(device, model, mean_bands, std_bands, img, classification_options)
     if classification_options["classification_probabilities"] == True:
-        probs_i = probs.max(axis=1).squeeze()
-        probs = probs.argmax(1).squeeze()+1
         # Write TIFs
         with rio.open(scmap_path, 'w', **meta) as dst:
             dst.write_band(1, probs.astype(dtype).copy())
@@ -327,11 +358,83 @@ def unet_prediction_julia(device, model, mean_bands, std_bands, output_folder, i
             dst.write_band(1, probs_i.copy())
             dst.update_tags(**tags)
     else:
-        probs = probs.argmax(1).squeeze()+1
         # Write TIF
         with rio.open(scmap_path, 'w', **meta) as dst:
             dst.write_band(1, probs.astype(dtype).copy())
             dst.update_tags(**tags)
+
+########################################################################################################################
+def unet_predict(device, model, img, classification_options):
+    """
+    This function predicts the classes (and probabilities) of an image with Unet. NaNs are imputed with the features mean.
+    Input: device, model - Unet model and device, see load_ml_model.
+           img - Image array (height, width, features) as float32, changed in place by the NaN imputation.
+           classification_options - Classification options dictionary, see create_sc_proba_maps.
+    Output: probs - Array of classes (height, width).
+            probs_i - Array of probabilities (height, width), None without "classification_probabilities".
+    """
+    probs, probs_i = unet_predict_batch(device, model, [img], classification_options)
+
+    return probs[0], None if probs_i is None else probs_i[0]
+
+########################################################################################################################
+def unet_predict_batch(device, model, imgs, classification_options):
+    """
+    This function predicts the classes (and probabilities) of a batch of images with the same size with Unet, in a
+    single forward pass. NaNs are imputed with the features mean.
+    Input: device, model - Unet model and device, see load_ml_model.
+           imgs - List of image arrays (height, width, features) as float32, changed in place by the NaN imputation.
+           classification_options - Classification options dictionary, see create_sc_proba_maps.
+    Output: probs - Array of classes (images, height, width).
+            probs_i - Array of probabilities (images, height, width), None without "classification_probabilities".
+    """
+    impute_nan = np.tile(classification_options["features_mean"], (imgs[0].shape[0],imgs[0].shape[1],1))
+    transform_test = transforms.Compose([transforms.ToTensor()])
+    standardization = transforms.Normalize(classification_options["features_mean"], classification_options["features_std"])
+
+    # Preprocessing before prediction
+    batch = []
+    for img in imgs:
+        nan_mask = np.isnan(img)
+        img[nan_mask] = impute_nan[nan_mask]
+        img = transform_test(img)
+        batch.append(standardization(img))
+
+    # Images to Cuda if exist
+    batch = torch.stack(batch).to(device)
+
+    # Predictions
+    logits = model(batch)
+    probs = torch.nn.functional.softmax(logits.detach(), dim=1).cpu().numpy()
+    probs_i = probs.max(axis=1) if classification_options["classification_probabilities"] == True else None
+
+    return probs.argmax(1)+1, probs_i
+
+########################################################################################################################
+def unet_predict_julia(device, model, mean_bands, std_bands, img, classification_options):
+    """
+    This function predicts the classes (and probabilities) of an image with Julia Unet. NaNs are imputed with the features mean.
+    Input: device, model, mean_bands, std_bands - Julia Unet model, see load_ml_model.
+           img - Image array (height, width, features) as float32, changed in place by the NaN imputation.
+           classification_options - Classification options dictionary, see create_sc_proba_maps.
+    Output: probs - Array of classes (height, width).
+            probs_i - Array of probabilities (height, width), None without "classification_probabilities".
+    """
+    # Preprocessing before prediction
+    impute_nan = np.tile(classification_options["features_mean"], (img.shape[0],img.shape[1],1))
+    nan_mask = np.isnan(img)
+    img[nan_mask] = impute_nan[nan_mask]
+
+    from juliacall import Main as jl
+    logits = jl.Classification_Julia(device, img, model, mean_bands, std_bands)
+    logits = np.asarray(logits)
+    # Convert the array to a PyTorch tensor
+    logits = torch.tensor(logits)
+    probs = torch.nn.functional.softmax(logits.detach(), dim=1).cpu().numpy()
+    probs_i = probs.max(axis=1).squeeze() if classification_options["classification_probabilities"] == True else None
+
+    return probs.argmax(1).squeeze()+1, probs_i
+
 ########################################################################################################################
 def create_sc_proba_maps(input_folder, output_folder, classification_options):
     """
@@ -373,8 +476,14 @@ def create_sc_proba_maps(input_folder, output_folder, classification_options):
     model, device, mean_bands, std_bands = load_ml_model(classification_options["model_path"], classification_options)
     log_list.append("Model loaded")
 
-    # Check folder TIFs
-    tifs_list = glob.glob(os.path.join(input_folder, "*.tif"))
+    # Check folder TIFs (and virtual stacks, the TIFs with their bands are not images to classify)
+    tifs_list = [image for image in glob.glob(os.path.join(input_folder, "*.tif")) + glob.glob(os.path.join(input_folder, "*.vrt")) 
+                 if not image.endswith("_bands.tif")]
+    # Valid pixels of masked products (RF and XGB), see mask_stack_pixels
+    if classification_options["ml_algorithm"] in ["rf", "xgb"]:
+        tifs_list = tifs_list + glob.glob(os.path.join(input_folder, "*_masked_stack.npz"))
+    if any(image.endswith(".vrt") for image in tifs_list):
+        enable_vrt_python()
     log_list.append("Classification of " + str(len(tifs_list)) + " images")
     if len(tifs_list) > 0:
         ignore_log = True
@@ -385,8 +494,11 @@ def create_sc_proba_maps(input_folder, output_folder, classification_options):
         # Cycle each TIF
         for image in tifs_list:
             image_name = os.path.basename(image)[:-4]+"_rf"
-            # Convert full stack to desired DF
-            img, img_data_shape, global_predict_df, no_nans_predict_df = convert_stack_rfxgb(image, classification_options)
+            # Convert full stack (or valid pixels) to desired DF
+            if image.endswith(".npz"):
+                img, img_data_shape, global_predict_df, no_nans_predict_df = convert_masked_pixels_rfxgb(image, classification_options)
+            else:
+                img, img_data_shape, global_predict_df, no_nans_predict_df = convert_stack_rfxgb(image, classification_options)
             # Prepare data even more and prediction
             log_list0 = rfxgb_prediction(model, output_folder, image_name, img, img_data_shape, global_predict_df, no_nans_predict_df, ignore_log, classification_options)
             log_list = log_list + log_list0
@@ -397,8 +509,11 @@ def create_sc_proba_maps(input_folder, output_folder, classification_options):
         # Cycle each TIF
         for image in tifs_list:
             image_name = os.path.basename(image)[:-4]+"_xgb"
-            # Convert full stack to desired DF
-            img, img_data_shape, global_predict_df, no_nans_predict_df = convert_stack_rfxgb(image, classification_options)
+            # Convert full stack (or valid pixels) to desired DF
+            if image.endswith(".npz"):
+                img, img_data_shape, global_predict_df, no_nans_predict_df = convert_masked_pixels_rfxgb(image, classification_options)
+            else:
+                img, img_data_shape, global_predict_df, no_nans_predict_df = convert_stack_rfxgb(image, classification_options)
             # Prepare data even more and prediction
             log_list0 = rfxgb_prediction(model, output_folder, image_name, img, img_data_shape, global_predict_df, no_nans_predict_df, ignore_log, classification_options)
             log_list = log_list + log_list0
@@ -438,3 +553,217 @@ def create_sc_proba_maps(input_folder, output_folder, classification_options):
 
 
 
+
+########################################################################################################################
+def predict_patch(model, device, mean_bands, std_bands, patch, classification_options):
+    """
+    This function predicts the classes (and probabilities) of a patch array with RF, XGBoost or Unet, in memory.
+    Input: model, device, mean_bands, std_bands - Model, see load_ml_model.
+           patch - Patch array (features, height, width), see Tiling.generate_patches.
+           classification_options - Classification options dictionary, see create_sc_proba_maps.
+    Output: classes - Array of classes (height, width).
+            probabilities - Array of probabilities (height, width), None without "classification_probabilities".
+    """
+    n_features, height, width = patch.shape
+    if classification_options["ml_algorithm"] == "unet":
+        img = np.moveaxis(patch, 0, 2).astype(np.float32)
+        if len(glob.glob(os.path.join(classification_options["model_path"], "*.bson"))) != 0:
+            return unet_predict_julia(device, model, mean_bands, std_bands, img, classification_options)
+        return unet_predict(device, model, img, classification_options)
+
+    # RF or XGB, pixels without NaNs are predicted and the others are 0
+    no_nans_predict_df = pd.DataFrame(patch.reshape(n_features, -1).T, columns=classification_options["features"]).dropna(axis=0, how='any')
+    classes = np.zeros(height*width, dtype=np.float32)
+    probabilities = np.zeros(height*width, dtype=np.float32) if classification_options["classification_probabilities"] == True else None
+    if len(no_nans_predict_df.index) != 0:
+        predict_results, probability_results = rfxgb_predict(model, no_nans_predict_df, classification_options)
+        classes[no_nans_predict_df.index] = predict_results
+        if probabilities is not None:
+            probabilities[no_nans_predict_df.index] = probability_results
+
+    return classes.reshape(height, width), None if probabilities is None else probabilities.reshape(height, width)
+
+########################################################################################################################
+def predict_patches(model, device, mean_bands, std_bands, patches, classification_options):
+    """
+    This function predicts a batch of patch arrays with the same size. Python Unet predicts the batch in a single
+    forward pass (see unet_predict_batch), other models predict each patch (see predict_patch).
+    Input: model, device, mean_bands, std_bands - Model, see load_ml_model.
+           patches - List of patch arrays (features, height, width).
+           classification_options - Classification options dictionary, see create_sc_proba_maps.
+    Output: List of (classes, probabilities) of each patch, see predict_patch.
+    """
+    if classification_options["ml_algorithm"] == "unet" and len(glob.glob(os.path.join(classification_options["model_path"], "*.bson"))) == 0:
+        imgs = [np.moveaxis(patch, 0, 2).astype(np.float32) for patch in patches]
+        probs, probs_i = unet_predict_batch(device, model, imgs, classification_options)
+        return [(probs[i], None if probs_i is None else probs_i[i]) for i in range(len(patches))]
+
+    return [predict_patch(model, device, mean_bands, std_bands, patch, classification_options) for patch in patches]
+
+########################################################################################################################
+def map_profile(classification_options, map_folder):
+    """
+    This function provides the data type and nodata of the maps of patches, the same for maps of patch files (see 
+    create_sc_proba_maps) and of mosaics of patches in memory (see create_sc_proba_maps_from_patches). Unet maps keep the data type and nodata of 
+    the patches (float32, NaN).
+    Input: classification_options - Classification options dictionary, see create_sc_proba_maps.
+           map_folder - "sc_maps" or "proba_maps". String.
+    Output: dtype - Data type as string (e.g. "uint8").
+            nodata - Nodata value, None without nodata.
+    """
+    if classification_options["ml_algorithm"] == "unet":
+        return "float32", np.nan
+    if map_folder == "sc_maps":
+        return "uint8", None
+    return "float32", None
+
+########################################################################################################################
+def create_sc_proba_maps_from_patches(image, output_folder, classification_options, patch_size=DEFAULT_PATCH_SIZE, overlap=DEFAULT_OVERLAP, batch_size=1, tiling_plan=False,
+                                      qa_path=None, mosaic_names=None):
+    """
+    This function splits a stack into overlapping patches in memory (see Tiling.generate_patches) and predicts each patch
+    with a Machine Learning Algorithm (Random Forest, XGBoost or Unet), without patch files. Only the features of the
+    model are read. The scene classification and probability mosaics are created once, with the size and georeference 
+    of the stack, and the region kept from each prediction (half of the overlaps, see Tiling.mosaic_regions) is written
+    into place one row of patches at a time, so no map of a patch is written. The mosaics are the same as 
+    Tiling.mosaic_patches over the maps of the patch files of Tiling.split_image_with_overlap. Patches without valid 
+    pixels (final mask of the QA mask, see Tiling.patch_valid_pixels) are not read or predicted, their regions keep the 
+    nodata (or 0) of the maps (see map_profile), and are recorded in the patch index (see Tiling.save_patch_index).
+    With tiling_plan, the patch size, overlap and batch size are planned by Tiling.plan_tiling, with a timing probe of
+    the model on random patches.
+    Input: image - Path to the stack TIF (or VRT). String.
+           output_folder - Path to the folder where the folders with scene classification (and probability) maps will be saved. String.
+           classification_options - Classification options dictionary, see create_sc_proba_maps.
+           patch_size - Size of the patch in the format (width, height).
+           overlap - Percentage of overlap (0-1).
+           batch_size - Number of patches predicted at once (Python Unet).
+           tiling_plan - True to plan patch_size, overlap and batch_size. Bool.
+           qa_path - Path of the QA mask of the image. Default None uses the QA mask of the masked product of the image.
+           mosaic_names - Dictionary with the names of the mosaics (without extension) of "sc_maps" and "proba_maps".
+                          Default None uses the image name and the ML algorithm, e.g. image_rf-scmap.
+    Output: log_list - Logging messages.
+            Scene Classification mosaic as TIF, inside sc_maps.
+            Class probability mosaic as TIF, inside proba_maps (optional).
+            Patch index (Patches.csv) saved inside output_folder.
+    """
+    # Logging list
+    log_list = []
+
+    classiftime_0 = time.time()
+
+    # Create folders to save maps
+    CreateBrandNewFolder(os.path.join(output_folder, "sc_maps"))   
+    CreateBrandNewFolder(os.path.join(output_folder, "proba_maps")) 
+
+    # Load model, must be done outside loop to save time
+    model, device, mean_bands, std_bands = load_ml_model(classification_options["model_path"], classification_options)
+    log_list.append("Model loaded")
+
+    stack_raster = gdal.Open(image)
+    projection, geotransform = stack_raster.GetProjectionRef(), stack_raster.GetGeoTransform()
+    x_size, y_size = stack_raster.RasterXSize, stack_raster.RasterYSize
+    stack_raster = None
+    features_n = stack_band_numbers(image, classification_options["features"])
+
+    # Tiling plan from the image size, the memory and a timing probe of the model
+    expected_time = None
+    if tiling_plan == True:
+        def prediction_time(size, batch):
+            patches = [np.random.default_rng(i).random((len(features_n), size, size), dtype=np.float32) for i in range(batch)]
+            time0 = time.perf_counter()
+            predict_patches(model, device, mean_bands, std_bands, patches, classification_options)
+            return time.perf_counter()-time0
+        # Python Unet predicts batches, limited by the GPU memory when used
+        batch_unet = (classification_options["ml_algorithm"] == "unet") and isinstance(device, torch.device)
+        memory = torch.cuda.mem_get_info(device)[0] if batch_unet and device.type == "cuda" else None
+        plan, log_list0 = plan_tiling(image, classification_options, memory, prediction_time, TILING_MAX_BATCH_SIZE if batch_unet else 1)
+        log_list = log_list + log_list0
+        patch_size, overlap, batch_size, expected_time = plan["patch_size"], plan["overlap"], plan["batch_size"], plan["expected_time"]
+
+    # Mosaics, created once with the size and georeference of the stack
+    if mosaic_names is None:
+        image_name = os.path.basename(image)[:-4]+"_"+classification_options["ml_algorithm"]
+        mosaic_names = {"sc_maps": image_name+"-scmap", "proba_maps": image_name+"-probamap"}
+    map_folders = ["sc_maps"] + (["proba_maps"] if classification_options["classification_probabilities"] == True else [])
+    driver = gdal.GetDriverByName("GTiff")
+    mosaics, fill_values = {}, {}
+    for map_folder in map_folders:
+        dtype, nodata = map_profile(classification_options, map_folder)
+        data_type = gdal.GDT_Byte if dtype == "uint8" else gdal.GDT_Float32
+        mosaics[map_folder] = driver.Create(os.path.join(output_folder, map_folder, mosaic_names[map_folder]+".tif"), x_size, y_size, 1, 
+                                            data_type, options=creation_options(data_type))
+        mosaics[map_folder].SetProjection(projection)
+        mosaics[map_folder].SetGeoTransform(geotransform)
+        if nodata is not None:
+            mosaics[map_folder].GetRasterBand(1).SetNoDataValue(nodata)
+        fill_values[map_folder] = (nodata if nodata is not None else 0, dtype)
+
+    # Regions kept from each patch, rows of the mosaics are written when all patches of the row are placed
+    x_points = sorted(set(xoff for _, _, xoff, _ in patch_windows(x_size, y_size, patch_size, overlap)))
+    y_points = sorted(set(yoff for _, _, _, yoff in patch_windows(x_size, y_size, patch_size, overlap)))
+    x_regions, y_regions = mosaic_regions(x_points, y_points, x_size, y_size)
+    mosaic_rows, placed = {}, {}
+    def place(row, column, results):
+        y_start, y_end = y_regions[row]
+        x_start, x_end = x_regions[column]
+        if row not in mosaic_rows:
+            mosaic_rows[row] = {map_folder:np.full((y_end-y_start, x_size), fill_value, dtype=dtype) 
+                                for map_folder, (fill_value, dtype) in fill_values.items()}
+            placed[row] = 0
+        if results is not None:
+            for map_folder, data in zip(map_folders, results):
+                mosaic_rows[row][map_folder][:, x_start:x_end] = data[y_start-y_points[row]:y_end-y_points[row], 
+                                                                      x_start-x_points[column]:x_end-x_points[column]]
+        placed[row] = placed[row] + 1
+        if placed[row] == len(x_points):
+            for map_folder, mosaic_row in mosaic_rows.pop(row).items():
+                mosaics[map_folder].GetRasterBand(1).WriteArray(mosaic_row, 0, y_start)
+
+    # Predict batches of patches and place them in the mosaics
+    batch = []
+    predict_time = 0
+    def predict_batch(batch):
+        nonlocal predict_time
+        time0 = time.perf_counter()
+        results = predict_patches(model, device, mean_bands, std_bands, [patch for _, _, patch in batch], classification_options)
+        predict_time = predict_time + time.perf_counter()-time0
+        for (row, column, _), result in zip(batch, results):
+            place(row, column, result)
+
+    patch_index = []
+    final_mask = read_final_mask(qa_mask_path(os.path.dirname(image)) if qa_path is None else qa_path)
+    for row, column, xoff, yoff, _, patch, valid_pixels in generate_patches(image, patch_size, overlap, features_n, final_mask):
+        patch_index.append((row, column, xoff, yoff, valid_pixels))
+        # Skip patches without valid pixels, their region keeps the fill value
+        if valid_pixels == 0:
+            place(row, column, None)
+            continue
+        # Patches smaller than the patch size (images smaller than a patch) are filled with 0, same as patch files
+        if patch.shape[1:] != (patch_size[1], patch_size[0]):
+            full_patch = np.zeros((patch.shape[0], patch_size[1], patch_size[0]), dtype=patch.dtype)
+            full_patch[:, :patch.shape[1], :patch.shape[2]] = patch
+            patch = full_patch
+        batch.append((row, column, patch))
+        if len(batch) == batch_size:
+            predict_batch(batch)
+            batch = []
+    if len(batch) > 0:
+        predict_batch(batch)
+    final_mask = None
+    mosaics = None
+    save_patch_index(output_folder, patch_index)
+    skipped = sum(1 for patch in patch_index if patch[4] == 0)
+    log_list.append("Classification of " + str(len(patch_index)-skipped) + " patches in memory with " + classification_options["ml_algorithm"] + 
+                    ", " + str(skipped) + " patches without valid pixels skipped, mosaics written directly")
+
+    # Measured cost of the tiling
+    message = "Tiling measured cost: " + str(round(predict_time, 1)) + " s of prediction, " + str(len(patch_index)-skipped) + " " + \
+              str(patch_size[0]) + "x" + str(patch_size[1]) + " patches, overlap " + str(round(overlap, 3)) + ", batch size " + str(batch_size)
+    if expected_time is not None:
+        message = message + " (expected " + str(round(expected_time, 1)) + " s for " + str(len(patch_index)) + " patches)"
+    log_list.append(message)
+
+    classiftime = int(time.time() - classiftime_0)
+    log_list.append("Total classification time: " + str(classiftime) + " seconds")
+
+    return log_list
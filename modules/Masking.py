@@ -9,68 +9,65 @@ Functions related to masking.
 import glob
 import shutil
 import os
+import ast
+import threading
+import xml.etree.ElementTree as ET
 from osgeo import gdal, osr
 from scipy import ndimage
 from s2cloudless import S2PixelCloudDetector
+from netCDF4 import Dataset
 import numpy as np
-import rasterio
 #from xml.dom import minidom
 #from rasterio.warp import reproject, Resampling
-from scipy.ndimage import minimum_filter
 
 # Import other Functions ##########################################################################################################
-from modules.SpectralIndices import CalculateNormalizedIndexTif
-from modules.Auxiliar import GenerateTifPaths
+from modules.SpectralIndices import normalized_index
+from modules.Morphology import dilate_cross, dilate_disk, erode_square, disk
+from modules.Auxiliar import GenerateTifPaths, creation_options, block_windows, process_blocks
+from modules.S2L2Processing import stack_band_numbers, read_pixel_vectors, stack_path, virtual_stack_info, write_virtual_stack, \
+                                   l2w_path, l2w_georeference, l2w_band_variables, l2w_window_reader, enable_vrt_python
+
+# Bits of the QA mask, a single uint8 TIF per product with one bit for each mask layer (see write_qa_mask)
+QA_BITS = {"WATER": 1, "NDWI": 2, "BAND8": 4, "CLOUD": 8, "NAN": 16, "FINAL": 32}
+# Scale of the quantized cloud probabilities (uint8, 0 to CLOUD_PROBABILITY_SCALE), see quantize_probability
+CLOUD_PROBABILITY_SCALE = 250
+# Top of Atmosphere bands used by s2cloudless (ordered)
+CLOUD_BANDS = ['rhot_B01','rhot_B02','rhot_B04','rhot_B05','rhot_B08','rhot_B8A','rhot_B09','rhot_B10','rhot_B11','rhot_B12']
 
 #######################################################################################################################################
-def Create_Mask_fromWCMaps(MaskProduct, WorldCoverMapsFolder, DstEPSG, Bounds, SpatialRes, WCnonExistTile, BufferSize=0):
+def water_mask(WorldCoverMapsFolder, DstEPSG, Bounds, SpatialRes, WCnonExistTile, BufferSize=0):
     """
-    This function reads WorldCover maps (ESA*.tif files) from a folder and creates a Water mask. If exists more than one 
+    This function reads WorldCover maps (ESA*.tif files) from a folder and creates a Water mask array. If exists more than one 
     WorldCover tile, the function merges all tiles into one. After that, the single tile is reprojected according to the 
-    desired EPSG and clipped according to bounds.
-    Input: ProductToMask - Folder where the final mask will be saved.
-           WorldCoverMapsFolder - Path to the folder where the WorldCover maps are saved.
+    desired EPSG and clipped according to bounds. All steps are done in memory.
+    Input: WorldCoverMapsFolder - Path to the folder where the WorldCover maps are saved.
            DstEPSG - The desired EPSG as string.
            Bounds - Bounds with the same projection of DstEPSG. List as [ulx, uly, lrx, lry] or [xmin, ymax, xmax, ymin].
            SpatialRes - Spatial resolution (Square: SpatialRes x SpatialRes) based on desired EPSG.
-           
            WCnonExistTile - If Download_WorldCoverMaps function tries to download a non-existing tile, a True flag is outputed.
                             This True flag is used here to create a mask with value 1 (water).  
            BufferSize - Size of buffer applied to land, if 0 buffer step is ignored.
-    Output: In this mask the value 1 represents water and NaNs (since NaNs are used in WorldCover map as open ocean), the value 0 represents land.
-            log_list - Logging messages.
+    Output: log_list - Logging messages.
+            MaskData - Mask array as uint8. The value 1 represents water and NaNs (since NaNs are used in WorldCover map 
+                       as open ocean), the value 0 represents land.
+            GeoTransform, Projection - Georeference of the mask (GDAL geotransform and WKT).
     """
     # Logging list
     log_list = []
 
-    ProductToMaskName = os.path.basename(MaskProduct)
-    MaskFolder = os.path.join(MaskProduct, "Masks")
-
     if WCnonExistTile == True:
-        # Create mask filled with 1 representing a non-existing tile in the middle of the ocean
+        # Mask filled with 1 representing a non-existing tile in the middle of the ocean
         log_list.append("Generated mask of non-existing WorldCover tile in the middle of the ocean")
 
-        Driver = gdal.GetDriverByName("GTiff")
-        MaskPath = os.path.join(MaskFolder, ProductToMaskName + "_WATER_Mask.tif")
-        
         CRS = osr.SpatialReference()
         CRS.ImportFromEPSG(int(DstEPSG))
-        CRS_wkt = CRS.ExportToWkt()
+        Projection = CRS.ExportToWkt()
+        # [xmin, xres, 0, ymax, 0, -yres]
+        GeoTransform = [Bounds[0], SpatialRes, 0, Bounds[1], 0, -SpatialRes]
 
         RasterXSize = abs(int((Bounds[2] - Bounds[0]) / SpatialRes))
         RasterYSize = abs(int((Bounds[1] - Bounds[3]) / SpatialRes))
-
-        Mask = Driver.Create(MaskPath,
-                             RasterXSize,
-                             RasterYSize,
-                             1, #Number of bands to create in the output
-                             gdal.GDT_Byte)
-        Mask.SetProjection(CRS_wkt)
-        # [xmin, xres, 0, ymax, 0, -yres]
-        Mask.SetGeoTransform([Bounds[0], SpatialRes, 0, Bounds[1], 0, -SpatialRes]) 
-        MaskBand = Mask.GetRasterBand(1)
-        MaskBand.Fill(1)
-        MaskBand = None
+        MaskData = np.ones((RasterYSize, RasterXSize), dtype=np.uint8)
     else:
         # List ESA WorldCover maps inside folder
         WorldCoverMapsSaved_list = sorted(glob.glob(WorldCoverMapsFolder + "/ESA*.tif"))
@@ -83,8 +80,8 @@ def Create_Mask_fromWCMaps(MaskProduct, WorldCoverMapsFolder, DstEPSG, Bounds, S
         SingleWorldCoverMapClipped = gdal.Warp("/vsimem/ESA_WorldCover_10m_Map_Reprojected.tif", SingleWorldCoverMap, format='GTiff', outputBounds=[Bounds[0], Bounds[3], Bounds[2], Bounds[1]], xRes=SpatialRes, yRes=SpatialRes, dstSRS="EPSG:"+DstEPSG, resampleAlg=ResampleAlgorithm, options=['COMPRESS=DEFLATE'])
 
         # Close Original World Cover Map
-        #gdal.Unlink("/vsimem/ESA_WorldCover_10m_Map.vrt")
         SingleWorldCoverMap = None
+        gdal.Unlink("/vsimem/ESA_WorldCover_10m_Map.vrt")
 
         # Create the land/water mask by changing data values
     
@@ -93,184 +90,194 @@ def Create_Mask_fromWCMaps(MaskProduct, WorldCoverMapsFolder, DstEPSG, Bounds, S
         SingleWorldCoverMapData = SingleWorldCoverMapBand.ReadAsArray()
     
         # Change data to match land = 0 and water (nans included) = 1
-        MaskData = np.where(np.logical_or(SingleWorldCoverMapData==80, SingleWorldCoverMapData==0), 1, 0)
+        MaskData = np.logical_or(SingleWorldCoverMapData==80, SingleWorldCoverMapData==0).astype(np.uint8)
 
         # Apply buffer
         if BufferSize > 0:
-            MaskData = minimum_filter(MaskData, size=2*BufferSize+1, mode='constant', cval=1)
-    
-        # Save the mask
-        Driver = gdal.GetDriverByName("GTiff")
-        MaskPath = os.path.join(MaskFolder, ProductToMaskName + "_WATER_Mask.tif")
-        Mask = Driver.Create(MaskPath,
-                            SingleWorldCoverMapClipped.RasterXSize,
-                            SingleWorldCoverMapClipped.RasterYSize,
-                            1, #Number of bands to create in the output
-                            gdal.GDT_Byte)
-
-        Mask.SetProjection(SingleWorldCoverMapClipped.GetProjectionRef())
-        Mask.SetGeoTransform(SingleWorldCoverMapClipped.GetGeoTransform()) 
-        MaskBand = Mask.GetRasterBand(1)
-        MaskBand.WriteArray(MaskData)
-        MaskBand = None
+            MaskData = erode_square(MaskData, BufferSize, border_value=1)
+
+        GeoTransform = SingleWorldCoverMapClipped.GetGeoTransform()
+        Projection = SingleWorldCoverMapClipped.GetProjectionRef()
+        SingleWorldCoverMapBand = None
         SingleWorldCoverMapClipped = None
+        gdal.Unlink("/vsimem/ESA_WorldCover_10m_Map_Reprojected.tif")
 
-    return log_list
+    return log_list, MaskData, GeoTransform, Projection
 
 #################################################################################################################################
-def Create_Mask_fromNDWI(ProductToMask, MaskingProductFolder, NDWIthreshold,NDWIDilation_Size):
+def ndwi_mask(ProductToMask, NDWIthreshold, NDWIDilation_Size):
     """
-    This function creates a mask based on the NDWI from the ACOLITE corrected bands 3 and 8.
+    This function creates a mask array based on the NDWI from the ACOLITE corrected bands 3 and 8.
     The mask is created by thresholding the NDWI values by 0.5 to eliminate water-only pixels, and
     subsequently applying a morphological dilation on the binary mask, to create a safety buffer and be
     sure that the eventual floating material is not exlcuded.
+    With the direct stack option, the bands are read from the ACOLITE L2W NetCDF file (see l2w_path).
     Input: ProductToMask - Path to the ACOLITE product folder where the Bands (3 and 8) are saved. String.
-           MaskingProductFolder - Folder where the masks will be saved. String.
            NDWIthreshold - NDWI threshold value to create mask, default is 0.5. Float.
            NDWIDilation_Size - number of iteration to perform dilation (>= 1)
-    Output: Creation of several NDWI based masks.
+    Output: NDWI mask array as uint8.
     """
-
-    ProductToMaskName = os.path.basename(ProductToMask)
-    # List of band paths
-    SurfRef_BandFolder = (os.path.join(ProductToMask, 'Surface_Reflectance_Bands'))
-    ListOfMaskedBandPathsSorted = GenerateTifPaths(SurfRef_BandFolder, ["rhos_B01","rhos_B02","rhos_B03","rhos_B04","rhos_B05","rhos_B06","rhos_B07","rhos_B08","rhos_B8A","rhos_B11","rhos_B12"])
-
-    # NDWI Calculation
-    B3 = ListOfMaskedBandPathsSorted[2]
-    B8 = ListOfMaskedBandPathsSorted[7]
-    NDWIPathAndTifName = os.path.join(MaskingProductFolder, ProductToMaskName + "_NDWI.tif")
-    CalculateNormalizedIndexTif([B3,B8], NDWIPathAndTifName)
-        
-    # Apply a thresholding on the NDWI and get a binary mask
-    Open_NDWI = gdal.Open(NDWIPathAndTifName)
-    NDWI_Data = Open_NDWI.GetRasterBand(1).ReadAsArray()
+    L2WPath = l2w_path(ProductToMask)
+    if L2WPath is None:
+        # Band paths
+        SurfRef_BandFolder = (os.path.join(ProductToMask, 'Surface_Reflectance_Bands'))
+        B3, B8 = GenerateTifPaths(SurfRef_BandFolder, ["rhos_B03","rhos_B08"])
+
+        # NDWI Calculation
+        B3Raster = gdal.Open(B3)
+        B8Raster = gdal.Open(B8)
+        NDWI_Data = normalized_index(B3Raster.GetRasterBand(1).ReadAsArray(), B8Raster.GetRasterBand(1).ReadAsArray())
+        B3Raster = None
+        B8Raster = None
+    else:
+        # NDWI Calculation with surface reflectances of the L2W NetCDF
+        with Dataset(L2WPath) as L2W:
+            Variables = l2w_band_variables(L2W, "rhos")
+            y_size, x_size = L2W.variables[Variables["B03"]].shape
+            Bands = l2w_window_reader(L2W, {Band: Variables[Band] for Band in ["B03","B08"]}, threading.Lock())((0, 0, x_size, y_size))
+        NDWI_Data = normalized_index(Bands["B03"], Bands["B08"])
+        Bands = None
+
+    # Apply a thresholding on the NDWI and a dilation on the binary mask
     NDWI_Thresholding = NDWI_Data < NDWIthreshold
-    # Save thresholded NDWI
-    NDWI_Thr_PathAndTifName = os.path.join(MaskingProductFolder, ProductToMaskName + '_NDWI_Thr.tif')
-    Driver = gdal.GetDriverByName("GTiff")
-    NIraster = Driver.Create(NDWI_Thr_PathAndTifName, Open_NDWI.RasterXSize, Open_NDWI.RasterYSize, 1, gdal.GDT_Byte)
-    NIraster.SetProjection(Open_NDWI.GetProjectionRef())
-    NIraster.SetGeoTransform(Open_NDWI.GetGeoTransform())
-    NIrasterBand = NIraster.GetRasterBand(1)
-    NIrasterBand.WriteArray(NDWI_Thresholding)
-    NIraster = None
-    
-    # Apply a dilation on the thresholded NDWI mask 
-    Open_NDWI_Thr = gdal.Open(NDWI_Thr_PathAndTifName)
-    NDWI_Thr_Data = Open_NDWI_Thr.GetRasterBand(1).ReadAsArray()
-    NDWI_Dil_PathAndTifName = os.path.join(MaskingProductFolder, ProductToMaskName + '_NDWI_Thr_Dil_Mask.tif')
-    NDWI_Dilation = ndimage.binary_dilation(NDWI_Thr_Data, output = NDWI_Dil_PathAndTifName, iterations=NDWIDilation_Size).astype(NDWI_Thr_Data.dtype)
-    # Save dilated NDWI_Thr
-    Driver = gdal.GetDriverByName("GTiff")
-    NIraster = Driver.Create(NDWI_Dil_PathAndTifName, Open_NDWI_Thr.RasterXSize, Open_NDWI_Thr.RasterYSize, 1, gdal.GDT_Byte)
-    NIraster.SetProjection(Open_NDWI_Thr.GetProjectionRef())
-    NIraster.SetGeoTransform(Open_NDWI_Thr.GetGeoTransform())
-    NIrasterBand = NIraster.GetRasterBand(1)
-    NIrasterBand.WriteArray(NDWI_Dilation)
-    NIraster = None
-
-    # Delete _NDWI and _NDWI_Thr (Comment if needed)
-    # Close unwanted Tifs first
-    Open_NDWI = None
-    Open_NDWI_Thr = None
-    if os.path.exists(NDWIPathAndTifName):
-        os.remove(NDWIPathAndTifName)
-    if os.path.exists(NDWI_Thr_PathAndTifName):
-        os.remove(NDWI_Thr_PathAndTifName)
+    return dilate_cross(NDWI_Thresholding, NDWIDilation_Size)
 
 #################################################################################################################################
-def Create_Mask_fromBand8(ProductToMask, MaskingProductFolder, Band8threshold, Band8Dilation_Size):
+def band8_mask(ProductToMask, Band8threshold, Band8Dilation_Size):
     """
-    This function creates a mask based on the corrected band 8 from the ACOLITE.
+    This function creates a mask array based on the corrected band 8 from the ACOLITE.
     The mask is created by thresholding the band 8 values values by a threshold (i.e. 0.03) to eliminate water-only pixels, and
     subsequently applying a morphological dilation on the binary mask, to create a safety buffer and be
     sure that the eventual floating material is not exlcuded.
     Input: ProductToMask - Path to the ACOLITE product folder where the stack with Band8 is saved. String.
-           MaskingProductFolder - Folder where the masks will be saved. String.
            Band8threshold - Band 8 threshold value to create mask, default is 0.03. Float.
            Band8Dilation_Size - number of iteration to perform dilation (>= 1)
-    Output: Creation of band 8 based masks.
+    Output: Band 8 mask array as uint8.
     """
-    ProductToMaskName = os.path.basename(ProductToMask)
     # Get stack
-    StackPath = os.path.join(ProductToMask, ProductToMaskName+"_stack.tif") 
-    
-    
-    # Apply a thresholding on the band and get a binary mask
+    StackPath = stack_path(ProductToMask)
     Stack = gdal.Open(StackPath)
-    Band8_Data = Stack.GetRasterBand(8).ReadAsArray()
-    Band8_Thresholding = Band8_Data > Band8threshold
-    
-    # Save thresholded mask
-    MaskB8_Thr_PathAndTifName = os.path.join(MaskingProductFolder, ProductToMaskName + "_Band8_Thr.tif")
-    Driver = gdal.GetDriverByName("GTiff")        
-    NIraster = Driver.Create(MaskB8_Thr_PathAndTifName, Stack.RasterXSize, Stack.RasterYSize, 1, gdal.GDT_Byte)
-    NIraster.SetProjection(Stack.GetProjectionRef())
-    NIraster.SetGeoTransform(Stack.GetGeoTransform())
-    NIrasterBand = NIraster.GetRasterBand(1)
-    NIrasterBand.WriteArray(Band8_Thresholding)
-    NIraster = None
-
-    # Apply a dilation on the thresholded mask 
-    Open_MaskB8_Thr = gdal.Open(MaskB8_Thr_PathAndTifName)
-    MaskB8_Thr_Data = Open_MaskB8_Thr.GetRasterBand(1).ReadAsArray()
-    MaskB8_Dil_PathAndTifName = os.path.join(MaskingProductFolder, ProductToMaskName + "_Band8_Thr_Dil_Mask.tif")
-    MaskB8_Dilation = ndimage.binary_dilation(MaskB8_Thr_Data, output = MaskB8_Dil_PathAndTifName, iterations=Band8Dilation_Size).astype(MaskB8_Thr_Data.dtype)
-    
-    # Save dilated mask
-    Driver = gdal.GetDriverByName("GTiff")
-    NIraster = Driver.Create(MaskB8_Dil_PathAndTifName, Open_MaskB8_Thr.RasterXSize, Open_MaskB8_Thr.RasterYSize, 1, gdal.GDT_Byte)
-    NIraster.SetProjection(Open_MaskB8_Thr.GetProjectionRef())
-    NIraster.SetGeoTransform(Open_MaskB8_Thr.GetGeoTransform())
-    NIrasterBand = NIraster.GetRasterBand(1)
-    NIrasterBand.WriteArray(MaskB8_Dilation)
-    NIraster = None
-
-    # Close opened rasters
+    Band8_Data = Stack.GetRasterBand(stack_band_numbers(StackPath, ["B08"])[0]).ReadAsArray()
     Stack = None
-    Open_MaskB8_Thr = None
 
-    # Delete intermediate mask (Comment if needed)
-    if os.path.exists(MaskB8_Thr_PathAndTifName):
-        os.remove(MaskB8_Thr_PathAndTifName)
+    # Apply a thresholding on the band and a dilation on the binary mask
+    Band8_Thresholding = Band8_Data > Band8threshold
+    return dilate_cross(Band8_Thresholding, Band8Dilation_Size)
 
 #################################################################################################################################
-def Create_Nan_Mask(ProductToMask, MaskingProductFolder):
+def nan_mask(ProductToMask):
     """
-    This function creates a mask based on the position of Nan values from the ACOLITE-corrected raster.
-    Input: ProductToMask - Path to the ACOLITE product folder where the stack with Band8 is saved. String.
-           MaskingProductFolder - Folder where the masks will be saved. String.
-    Output: Creation of band Nan based mask.
+    This function creates a mask array based on the position of Nan values from the ACOLITE-corrected stack.
+    Input: ProductToMask - Path to the ACOLITE product folder where the stack with Band1 is saved. String.
+    Output: Nan mask array as uint8, 1 for Nan values.
     """
-    ProductToMaskName = os.path.basename(ProductToMask)
     # Get stack
-    StackPath = os.path.join(ProductToMask, ProductToMaskName+"_stack.tif") 
-    
-    # Apply a thresholding on the band and get a binary mask
+    StackPath = stack_path(ProductToMask)
     Stack = gdal.Open(StackPath)
-    Band1_Data = Stack.GetRasterBand(1).ReadAsArray()
-    Nan_mask = np.isnan(Band1_Data)
-    Band1_Data[Nan_mask] = 1
-    Band1_Data[~Nan_mask] = 0
-    
-    # Save thresholded mask
-    Mask_Nan_PathAndTifName = os.path.join(MaskingProductFolder, ProductToMaskName + "_NAN_Mask.tif")
-    Driver = gdal.GetDriverByName("GTiff")        
-    NIraster = Driver.Create(Mask_Nan_PathAndTifName, Stack.RasterXSize, Stack.RasterYSize, 1, gdal.GDT_Byte)
-    NIraster.SetProjection(Stack.GetProjectionRef())
-    NIraster.SetGeoTransform(Stack.GetGeoTransform())
-    NIrasterBand = NIraster.GetRasterBand(1)
-    NIrasterBand.WriteArray(Nan_mask)
-    NIraster = None
-
-    # Close opened rasters
+    Band1_Data = Stack.GetRasterBand(stack_band_numbers(StackPath, ["B01"])[0]).ReadAsArray()
     Stack = None
 
+    return np.isnan(Band1_Data).astype(np.uint8)
+
+########################################################################################################################################  
+def block_average(data, factor):
+    """
+    This function averages an array by blocks of factor x factor pixels, ignoring NaNs. Blocks at the right and bottom
+    edges only average the pixels inside the array.
+    Input: data - 2D array.
+           factor - Size of the blocks in pixels. Int.
+    Output: Array with ceil(shape/factor) size as float32, NaN where the block only has NaNs.
+    """
+    h, w = data.shape
+    hc, wc = -(-h//factor), -(-w//factor)
+    padded = np.full((hc*factor, wc*factor), np.nan, dtype=np.float32)
+    padded[:h, :w] = data
+    valid = ~np.isnan(padded)
+    total = np.where(valid, padded, 0).reshape(hc, factor, wc, factor).sum(axis=(1, 3))
+    count = valid.reshape(hc, factor, wc, factor).sum(axis=(1, 3))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (total/count).astype(np.float32)
+
+########################################################################################################################################  
+def upsample_mask(mask, factor, shape):
+    """
+    This function upsamples a mask computed by blocks of factor x factor pixels (see block_average) to the original grid.
+    Each block value is repeated over the pixels of the block, so the upsampled mask is aligned with the original grid.
+    Input: mask - 2D mask array.
+           factor - Size of the blocks in pixels. Int.
+           shape - Shape of the original grid (rows, columns).
+    Output: Upsampled mask array with the given shape.
+    """
+    return np.repeat(np.repeat(mask, factor, axis=0), factor, axis=1)[:shape[0], :shape[1]]
+
+########################################################################################################################################  
+def cloud_probability_to_mask(Cloud_Probs, S2CL_Threshold, S2CL_Average, S2CL_Dilation):
+    """
+    This function creates a cloud mask from s2cloudless cloud probabilities, with the same post-processing of 
+    s2cloudless: convolution with a disk (averaging), threshold and dilation with a disk (done by dilate_disk).
+    Input: Cloud_Probs - 2D cloud probability array.
+           S2CL_Threshold, S2CL_Average, S2CL_Dilation - Threshold, averaging disk size and dilation disk size, see cloud_mask.
+    Output: Cloud mask array as uint8, 1 for clouds.
+    """
+    if S2CL_Average > 0:
+        Mask = (ndimage.convolve(Cloud_Probs, disk(S2CL_Average)/np.sum(disk(S2CL_Average))) > S2CL_Threshold).astype(np.uint8)
+    else:
+        Mask = (Cloud_Probs > S2CL_Threshold).astype(np.uint8)
+    if S2CL_Dilation > 0:
+        Mask = dilate_disk(Mask, S2CL_Dilation)
+
+    return Mask
+
 ########################################################################################################################################  
-def CloudMasking_S2CloudLess_ROI_10m(ac_product_folder, MaskingProductFolder, S2CL_Threshold, S2CL_Average, S2CL_Dilation):
+def cloud_mask_by_windows(read_probabilities, x_cloud, y_cloud, factor, S2CL_Threshold, S2CL_Average, S2CL_Dilation, block_size=1024, 
+                          n_threads=0, Probabilities=None):
+    """
+    This function computes a cloud mask from cloud probabilities by windows processed in a thread pool (see process_blocks).
+    Each window is read with a halo of average+dilation pixels, so the result is the same as processing the whole image
+    at once (see cloud_probability_to_mask).
+    Input: read_probabilities - Function called as read_probabilities(x0, y0, x1, y1), returns the cloud probabilities 
+                                of the window as float32 array, in the cloud detection grid.
+           x_cloud, y_cloud - Size of the cloud detection grid in pixels.
+           factor - Cloud detection resolution divided by 10m. Int.
+           S2CL_Threshold, S2CL_Average, S2CL_Dilation - Threshold, averaging disk size and dilation disk size (pixels at 10m), 
+                                                         the sizes are scaled to the cloud detection grid.
+           block_size - Size of the windows in pixels at 10m.
+           n_threads - Number of threads, 0 to use all cores.
+           Probabilities - uint8 array (y_cloud, x_cloud) filled with the quantized probabilities (see quantize_probability). 
+                           Default None does not keep the probabilities.
+    Output: Cloud mask array in the cloud detection grid as uint8, 1 for clouds.
     """
-    This function create cloud masks on Sentinel-2 Level-1C products based on s2_cloudless algorithm.
+    average, dilation = int(round(S2CL_Average/factor)), -(-S2CL_Dilation//factor)
+    halo = average + dilation
+    Mask = np.empty((y_cloud, x_cloud), dtype=np.uint8)
+
+    def process_window(window):
+        xoff, yoff, xsize, ysize = window
+        # Window with halo
+        x0, y0 = max(0, xoff-halo), max(0, yoff-halo)
+        x1, y1 = min(x_cloud, xoff+xsize+halo), min(y_cloud, yoff+ysize+halo)
+        Cloud_Probs = read_probabilities(x0, y0, x1, y1)
+        WindowMask = cloud_probability_to_mask(Cloud_Probs, S2CL_Threshold, average, dilation)
+        core = (slice(yoff-y0, yoff-y0+ysize), slice(xoff-x0, xoff-x0+xsize))
+        if Probabilities is not None:
+            return WindowMask[core], quantize_probability(Cloud_Probs[core])
+        return WindowMask[core], None
+
+    def write_window(window, result):
+        xoff, yoff, xsize, ysize = window
+        Mask[yoff:yoff+ysize, xoff:xoff+xsize] = result[0]
+        if Probabilities is not None:
+            Probabilities[yoff:yoff+ysize, xoff:xoff+xsize] = result[1]
+
+    process_blocks(block_windows(x_cloud, y_cloud, max(1, block_size//factor)), process_window, write_window, n_threads)
+
+    return Mask
+
+########################################################################################################################################  
+def cloud_mask(ac_product_folder, S2CL_Threshold, S2CL_Average, S2CL_Dilation, S2CL_Resolution=10, block_size=1024, n_threads=0, 
+               ProbabilityPath=None):
+    """
+    This function create a cloud mask array on Sentinel-2 Level-1C products based on s2_cloudless algorithm.
     The function is set up to process 10 bands at 10m resolution Performance of cloud masking is controlled by the following
     parameters:
     - threshold=0.8 ; Specifies the cloud probability threshold. All pixels with cloud probability above this threshold are masked as cloudy pixels. Default value is 0.4.
@@ -278,265 +285,805 @@ def CloudMasking_S2CloudLess_ROI_10m(ac_product_folder, MaskingProductFolder, S2
     - dilation_size=1 ; Size of the disk in pixels for performing dilation (averaging probability over pixels). Default value is 2. Value 0 means do not perform this post-processing step.
     - average_over and dilation_size: these two parameters depend on the resolution. At 10m resolution the recommended values are 22 and 11, respectively.
       These two parameters have impact on size of the buffer region around the clouds.
-    Input:  ACOLITE Top of Atmosphere reflectances.
-            MaskingProductFolder - Folder where the masks will be saved. String.
-    Output: Cloud masked product file at 10m spatial resolution (as .tif).
-    """
-    # Get shape and reprojection info from reference band
-    ReferenceImage = os.path.join(ac_product_folder, 'Top_Atmosphere_Bands', 'rhot_B02.tif')
-    ac_product_name = os.path.basename(ac_product_folder)
-
-    with rasterio.open(ReferenceImage) as scl:
-        _ = scl.read()
-        aff = scl.transform
-        crs = scl.crs
-    
-    # List of images (rhot) to process (ordered): B01,B02,B04,B05,B08,B8A,B09,B10,B11,B12.
-    ListofImages_rhot = []
-    SortingPattern = ['rhot_B01','rhot_B02','rhot_B04','rhot_B05','rhot_B08','rhot_B8A','rhot_B09','rhot_B10','rhot_B11','rhot_B12']
-    for band_rhot in SortingPattern:
-        ListofImages_rhot.append(os.path.join(ac_product_folder, 'Top_Atmosphere_Bands', band_rhot  + '.tif'))
-
-    # Create an array for each band
-    ListofBandsArray = []
-    for band_rhot in ListofImages_rhot:
-        Band = gdal.Open(band_rhot)
-        BandArray = np.array(Band.GetRasterBand(1).ReadAsArray())
-        ListofBandsArray.append(BandArray) 
-    # Create a list of arrays
-    Bands = np.array([np.dstack(ListofBandsArray)])
-    # Apply s2cloudless algorithm
-    Cloud_Detector = S2PixelCloudDetector(threshold=S2CL_Threshold, average_over=S2CL_Average, dilation_size=S2CL_Dilation) # To process on all 13 bands add: all_bands=True
-    # Cloud_Probs = Cloud_Detector.get_cloud_probability_maps(Bands)
-    Mask = Cloud_Detector.get_cloud_masks(Bands).astype(rasterio.uint8)
-    # Write output cloud mask 
-    tif_out_image = os.path.join(MaskingProductFolder, ac_product_name+'_CLOUD_Mask_10m.tif')
-    with rasterio.open(tif_out_image, "w",  driver='GTiff', compress="lzw", height=Mask.shape[1], width=Mask.shape[2], count=1, dtype=rasterio.uint8, transform=aff, crs=crs) as dest:
-        dest.write(Mask)
-    # Write output cloud probability (Comment if needed)
-    #with rasterio.open(os.path.join(MaskingProductFolder, ac_product_name+'_CLOUD_Prob_10m.tif'), "w",  driver='GTiff',compress="lzw",height=Cloud_Probs.shape[1],width=Cloud_Probs.shape[2],count=1,dtype=Cloud_Probs.dtype,nodata=255, transform=aff, crs=crs) as dest:
-    #    dest.write(Cloud_Probs)
+    With a coarser resolution (e.g. 60m, the resolution used to train s2cloudless), the bands are averaged by blocks, the cloud
+    probabilities and mask are computed at that resolution and the mask is upsampled to 10m (see upsample_mask). The averaging
+    and dilation sizes, always given at 10m, are scaled to the coarser resolution (the dilation is rounded up, so the 
+    buffer around clouds is not smaller).
+    The mask is computed by windows processed in a thread pool, see cloud_mask_by_windows. With the direct stack option,
+    the Top of Atmosphere reflectances are read from the ACOLITE L2W NetCDF file (see l2w_path).
+    Input:  ac_product_folder - ACOLITE product folder with Top of Atmosphere reflectances. String.
+            S2CL_Threshold, S2CL_Average, S2CL_Dilation - Threshold, averaging disk size and dilation disk size (pixels at 10m).
+            S2CL_Resolution - Resolution of cloud detection in meters, 10, 20, 60 or 120.
+            block_size - Size of the windows in pixels at 10m.
+            n_threads - Number of threads, 0 to use all cores.
+            ProbabilityPath - Path of the cloud probability TIF to save the probabilities (see write_cloud_probability), 
+                              used by cloud_mask_from_probability. String. Default None does not save the probabilities.
+    Output: Cloud mask array at 10m spatial resolution as uint8, 1 for clouds.
+    """
+    factor = S2CL_Resolution//10
+    L2WPath = l2w_path(ac_product_folder)
+    if L2WPath is None:
+        BandPaths = [os.path.join(ac_product_folder, 'Top_Atmosphere_Bands', band_rhot + '.tif') for band_rhot in CLOUD_BANDS]
+
+        Band = gdal.Open(BandPaths[0])
+        x_size, y_size = Band.RasterXSize, Band.RasterYSize
+        GeoTransform, Projection = Band.GetGeoTransform(), Band.GetProjectionRef()
+        Band = None
+
+        def read_window(window):
+            Bands = {}
+            for band_rhot, BandPath in zip(CLOUD_BANDS, BandPaths):
+                Band = gdal.Open(BandPath)
+                Bands[band_rhot] = Band.GetRasterBand(1).ReadAsArray(*window)
+                Band = None
+            return Bands
+    else:
+        # Top of Atmosphere reflectances of the L2W NetCDF, read the same way as the features stack
+        L2W = Dataset(L2WPath)
+        GeoTransform, Projection = l2w_georeference(L2W)
+        Variables = l2w_band_variables(L2W, "rhot")
+        y_size, x_size = L2W.variables[Variables["B01"]].shape
+        read_window = l2w_window_reader(L2W, {band_rhot: Variables[band_rhot[5:]] for band_rhot in CLOUD_BANDS}, threading.Lock())
+
+    # Cloud detection grid (coarser than 10m with factor > 1)
+    x_cloud, y_cloud = -(-x_size//factor), -(-y_size//factor)
+
+    # Apply s2cloudless algorithm (cloud probabilities), post-processing is done by cloud_probability_to_mask
+    Cloud_Detector = S2PixelCloudDetector(threshold=S2CL_Threshold, average_over=0, dilation_size=0) # To process on all 13 bands add: all_bands=True
+    Cloud_Detector.classifier # Loads the model before the thread pool
+
+    def read_probabilities(x0, y0, x1, y1):
+        x0_10m, y0_10m = x0*factor, y0*factor
+        x1_10m, y1_10m = min(x_size, x1*factor), min(y_size, y1*factor)
+        # Bands (rhot) to process (ordered): B01,B02,B04,B05,B08,B8A,B09,B10,B11,B12, in a single array (1, rows, columns, 10)
+        WindowBands = read_window((x0_10m, y0_10m, x1_10m-x0_10m, y1_10m-y0_10m))
+        Bands = None
+        for i, band_rhot in enumerate(CLOUD_BANDS):
+            BandArray = WindowBands[band_rhot]
+            if factor > 1:
+                BandArray = block_average(BandArray, factor)
+            if Bands is None:
+                Bands = np.empty((1,) + BandArray.shape + (len(CLOUD_BANDS),), dtype=BandArray.dtype)
+            Bands[0, :, :, i] = BandArray
+
+        return Cloud_Detector.get_cloud_probability_maps(Bands)[0]
+
+    Probabilities = None if ProbabilityPath is None else np.empty((y_cloud, x_cloud), dtype=np.uint8)
+    Mask = cloud_mask_by_windows(read_probabilities, x_cloud, y_cloud, factor, S2CL_Threshold, S2CL_Average, S2CL_Dilation, 
+                                 block_size, n_threads, Probabilities)
+    if L2WPath is not None:
+        L2W.close()
+    if ProbabilityPath is not None:
+        write_cloud_probability(ProbabilityPath, Probabilities, S2CL_Resolution, (x_size, y_size), GeoTransform, Projection)
+
+    if factor > 1:
+        Mask = upsample_mask(Mask, factor, (y_size, x_size))
+
+    return Mask
+
+########################################################################################################################################  
+def quantize_probability(Cloud_Probs):
+    """
+    This function quantizes cloud probabilities to uint8 (0 to CLOUD_PROBABILITY_SCALE), see dequantize_probability.
+    Input: Cloud_Probs - Cloud probability array (0 to 1).
+    Output: Quantized cloud probability array as uint8.
+    """
+    return np.round(Cloud_Probs*CLOUD_PROBABILITY_SCALE).astype(np.uint8)
+
+########################################################################################################################################  
+def dequantize_probability(Quantized_Probs):
+    """
+    This function converts quantized cloud probabilities (see quantize_probability) back to probabilities, with an error
+    up to 0.5/CLOUD_PROBABILITY_SCALE.
+    Input: Quantized_Probs - Quantized cloud probability array as uint8.
+    Output: Cloud probability array as float32.
+    """
+    return Quantized_Probs.astype(np.float32)/np.float32(CLOUD_PROBABILITY_SCALE)
+
+########################################################################################################################################  
+def cloud_probability_path(ac_product_folder):
+    """
+    This function provides the path of the cloud probability TIF of an ACOLITE product (see write_cloud_probability).
+    Input: ac_product_folder - ACOLITE product folder. String.
+    Output: Path of the cloud probability TIF. String.
+    """
+    return os.path.join(ac_product_folder, os.path.basename(ac_product_folder)+"_CLOUD_Probability.tif")
+
+########################################################################################################################################  
+def write_cloud_probability(ProbabilityPath, Probabilities, S2CL_Resolution, Size, GeoTransform, Projection):
+    """
+    This function writes quantized cloud probabilities as a Byte TIF in the cloud detection grid, with the storage profile. 
+    The scale of the band converts the values to probabilities and the metadata keeps the detection resolution and the 
+    10m size, used by cloud_mask_from_probability.
+    Input: ProbabilityPath - Path of the cloud probability TIF. String.
+           Probabilities - Quantized cloud probability array as uint8 (see quantize_probability).
+           S2CL_Resolution - Resolution of cloud detection in meters.
+           Size - Size of the 10m grid in pixels as (x_size, y_size).
+           GeoTransform, Projection - Georeference of the 10m grid (GDAL geotransform and WKT).
+    Output: Cloud probability TIF.
+    """
+    factor = S2CL_Resolution//10
+    write_mask(ProbabilityPath, Probabilities, (GeoTransform[0], GeoTransform[1]*factor, GeoTransform[2], 
+                                                GeoTransform[3], GeoTransform[4], GeoTransform[5]*factor), Projection)
+    Raster = gdal.Open(ProbabilityPath, gdal.GA_Update)
+    Raster.SetMetadata({"CLOUD_MASK_RESOLUTION": str(S2CL_Resolution), "X_SIZE_10M": str(Size[0]), "Y_SIZE_10M": str(Size[1])})
+    Raster.GetRasterBand(1).SetScale(1/CLOUD_PROBABILITY_SCALE)
+    Raster.GetRasterBand(1).SetDescription("Cloud probability")
+    Raster = None
+
+########################################################################################################################################  
+def cloud_probability_resolution(ac_product_folder):
+    """
+    This function provides the resolution of the cloud probability TIF of an ACOLITE product, if it exists and is newer
+    than the Top of Atmosphere bands or the L2W NetCDF (probabilities of a previous atmospheric correction are not used).
+    Input: ac_product_folder - ACOLITE product folder. String.
+    Output: Resolution of cloud detection in meters, None if there are no valid cloud probabilities.
+    """
+    ProbabilityPath = cloud_probability_path(ac_product_folder)
+    if not os.path.exists(ProbabilityPath):
+        return None
+    BandPath = l2w_path(ac_product_folder)
+    if BandPath is None:
+        BandPath = os.path.join(ac_product_folder, 'Top_Atmosphere_Bands', CLOUD_BANDS[0] + '.tif')
+    if os.path.exists(BandPath) and os.path.getmtime(BandPath) > os.path.getmtime(ProbabilityPath):
+        return None
+    Raster = gdal.Open(ProbabilityPath)
+    Resolution = Raster.GetMetadataItem("CLOUD_MASK_RESOLUTION")
+    Raster = None
+
+    return None if Resolution is None else int(Resolution)
+
+########################################################################################################################################  
+def cloud_mask_from_probability(ProbabilityPath, S2CL_Threshold, S2CL_Average, S2CL_Dilation, block_size=1024, n_threads=0):
+    """
+    This function creates a cloud mask from saved cloud probabilities (see write_cloud_probability), without running the
+    s2cloudless classifier, to change the threshold, average and dilation of the cloud mask (see cloud_mask). Only the 
+    averaging, threshold and dilation are done, by windows (see cloud_mask_by_windows). With the same parameters, the 
+    mask can differ from cloud_mask only where the averaged probability is within the quantization error of the threshold.
+    Input: ProbabilityPath - Path of the cloud probability TIF. String.
+           S2CL_Threshold, S2CL_Average, S2CL_Dilation - Threshold, averaging disk size and dilation disk size (pixels at 10m).
+           block_size - Size of the windows in pixels at 10m.
+           n_threads - Number of threads, 0 to use all cores.
+    Output: Cloud mask array at 10m spatial resolution as uint8, 1 for clouds.
+    """
+    Raster = gdal.Open(ProbabilityPath)
+    factor = int(Raster.GetMetadataItem("CLOUD_MASK_RESOLUTION"))//10
+    x_size, y_size = int(Raster.GetMetadataItem("X_SIZE_10M")), int(Raster.GetMetadataItem("Y_SIZE_10M"))
+    x_cloud, y_cloud = Raster.RasterXSize, Raster.RasterYSize
+    Raster = None
+
+    def read_probabilities(x0, y0, x1, y1):
+        Raster = gdal.Open(ProbabilityPath)
+        Quantized_Probs = Raster.GetRasterBand(1).ReadAsArray(x0, y0, x1-x0, y1-y0)
+        Raster = None
+        return dequantize_probability(Quantized_Probs)
+
+    Mask = cloud_mask_by_windows(read_probabilities, x_cloud, y_cloud, factor, S2CL_Threshold, S2CL_Average, S2CL_Dilation, 
+                                 block_size, n_threads)
+    if factor > 1:
+        Mask = upsample_mask(Mask, factor, (y_size, x_size))
+
+    return Mask
+
+#######################################################################################################################################
+def mask_expression(expression):
+    """
+    This function parses a boolean mask expression over named masks, e.g. "WATER & NDWI & ~CLOUD". 
+    Supported operators: & (and), | (or), ^ (xor), ~ (not) and parentheses. Masks are true where their value is not 0.
+    Input: expression - Mask expression as string.
+    Output: names - List of mask names used by the expression.
+            evaluate - Function called as evaluate(masks), with masks a dictionary of boolean arrays, returns a boolean array.
+    """
+    names = []
+    operators = {ast.BitAnd: np.logical_and, ast.BitOr: np.logical_or, ast.BitXor: np.logical_xor}
+
+    def build(node):
+        if isinstance(node, ast.Name):
+            if node.id not in names:
+                names.append(node.id)
+            return lambda masks: masks[node.id]
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.Invert, ast.Not)):
+            operand = build(node.operand)
+            return lambda masks: np.logical_not(operand(masks))
+        if isinstance(node, ast.BinOp) and type(node.op) in operators:
+            operator, left, right = operators[type(node.op)], build(node.left), build(node.right)
+            return lambda masks: operator(left(masks), right(masks))
+        raise Exception("Not supported term in mask expression: " + ast.unparse(node))
+
+    evaluate = build(ast.parse(expression, mode="eval").body)
+
+    return names, evaluate
+
+#######################################################################################################################################
+def mask_source(source):
+    """
+    This function provides a window reader for a mask source.
+    Input: source - Mask array or path to a mask TIF (first band). 
+    Output: read_window - Function called as read_window((xoff, yoff, xsize, ysize)), returns the mask window values.
+            x_size, y_size - Mask size in pixels.
+            close - Function to close the source.
+    """
+    if isinstance(source, str):
+        raster = gdal.Open(source)
+        band = raster.GetRasterBand(1)
+        def read_window(window):
+            return band.ReadAsArray(window[0], window[1], window[2], window[3])
+        def close():
+            nonlocal raster, band
+            band, raster = None, None
+        return read_window, raster.RasterXSize, raster.RasterYSize, close
+
+    data = np.asarray(source)
+    def read_window(window):
+        return data[window[1]:window[1]+window[3], window[0]:window[0]+window[2]]
+
+    return read_window, data.shape[1], data.shape[0], lambda: None
+
+#######################################################################################################################################
+def combine_masks(expression, sources, MaskPath=None, GeoTransform=None, Projection=None, block_size=1024, qa_layers=None):
+    """
+    This function evaluates a mask expression over named mask sources in a single pass by blocks, so only blocks of
+    the masks are kept in memory as booleans, with no full size temporaries.
+    Input: expression - Mask expression as string, see mask_expression.
+           sources - Dictionary with mask names as keys and mask sources as values. A source is a mask array or path to
+                     a mask TIF (true where not 0), or a tuple (array or path, bit) for a layer of a QA mask (true where the
+                     bit is set, see QA_BITS). Each array or path is read once by block, even if used by several masks.
+                     Only the masks used are read. All masks must have the same size.
+           MaskPath - Path of the output mask TIF. String. Default None returns the mask as array.
+           GeoTransform, Projection - Georeference of the output mask TIF (GDAL geotransform and WKT).
+           block_size - Size of the blocks in pixels.
+           qa_layers - List of mask names written as QA mask instead of the expression result, with the result as 
+                       "FINAL" layer (see write_qa_mask). Default None writes the expression result (0 or 1).
+    Output: Mask as uint8 array or mask TIF written block by block.
+    """
+    names, evaluate = mask_expression(expression)
+    used = names if qa_layers is None else list(dict.fromkeys(names + [name for name in qa_layers if name != "FINAL"]))
+    missing = [name for name in used if name not in sources]
+    if len(missing) > 0:
+        raise Exception("Masks not available for expression '" + expression + "': " + ", ".join(missing))
+
+    # Readers of the sources, shared by masks from the same array or file (e.g. layers of a QA mask)
+    readers, layers, sizes = {}, {}, set()
+    for name in used:
+        source, bit = sources[name] if isinstance(sources[name], tuple) else (sources[name], None)
+        key = source if isinstance(source, str) else id(source)
+        if key not in readers:
+            read_window, x_size, y_size, close = mask_source(source)
+            readers[key] = (read_window, close)
+            sizes.add((x_size, y_size))
+        layers[name] = (key, bit)
+    if len(sizes) != 1:
+        raise Exception("Masks of expression '" + expression + "' do not have the same size")
+
+    if MaskPath is None:
+        output = np.empty((y_size, x_size), dtype=np.uint8)
+    else:
+        Driver = gdal.GetDriverByName("GTiff")
+        Mask = Driver.Create(MaskPath, x_size, y_size, 1, gdal.GDT_Byte, options=creation_options(gdal.GDT_Byte))
+        Mask.SetProjection(Projection)
+        Mask.SetGeoTransform(GeoTransform)
+        MaskBand = Mask.GetRasterBand(1)
+        if qa_layers is not None:
+            Mask.SetMetadataItem("QA_LAYERS", ",".join(qa_layers))
+            Mask.SetMetadataItem("QA_EXPRESSION", expression)
+            MaskBand.SetDescription("QA")
+
+    for window in block_windows(x_size, y_size, block_size):
+        values = {key: reader[0](window) for key, reader in readers.items()}
+        masks = {name: (values[key] != 0) if bit is None else ((values[key] & bit) != 0) for name, (key, bit) in layers.items()}
+        block = evaluate(masks).astype(np.uint8)
+        if qa_layers is not None:
+            masks["FINAL"] = block
+            block = np.zeros(block.shape, dtype=np.uint8)
+            for name in qa_layers:
+                block |= masks[name].astype(np.uint8)*np.uint8(QA_BITS[name])
+        if MaskPath is None:
+            output[window[1]:window[1]+window[3], window[0]:window[0]+window[2]] = block
+        else:
+            MaskBand.WriteArray(block, window[0], window[1])
+
+    for reader in readers.values():
+        reader[1]()
+    if MaskPath is None:
+        return output
+    MaskBand = None
+    Mask = None
+
+#######################################################################################################################################
+def write_qa_mask(QAPath, masks, expression, GeoTransform, Projection, block_size=1024):
+    """
+    This function writes the QA mask of a product: a single uint8 TIF with one bit for each mask layer (see QA_BITS),
+    including the final mask (FINAL layer) from the expression. The layers in the QA mask are saved in the "QA_LAYERS" 
+    metadata item and the expression in the "QA_EXPRESSION" metadata item. Any combination of layers can be decoded with a bitwise test, see qa_sources.
+    Input: QAPath - Path of the QA mask TIF. String.
+           masks - Dictionary with mask names (keys of QA_BITS) as keys and mask sources as values, see combine_masks.
+           expression - Mask expression of the final mask, see mask_expression.
+           GeoTransform, Projection - Georeference of the QA mask (GDAL geotransform and WKT).
+           block_size - Size of the blocks in pixels.
+    Output: QA mask TIF.
+    """
+    qa_layers = [name for name in QA_BITS if name in masks] + ["FINAL"]
+    combine_masks(expression, masks, QAPath, GeoTransform, Projection, block_size, qa_layers)
+
+#######################################################################################################################################
+def qa_sources(QAPath):
+    """
+    This function provides the layers of a QA mask as mask sources, to use with combine_masks, e.g. to apply other
+    combinations of the layers without creating them again: combine_masks("WATER & ~CLOUD", qa_sources(QAPath)).
+    Input: QAPath - Path of the QA mask TIF. String.
+    Output: sources - Dictionary with layer names as keys and (QAPath, bit) as values.
+    """
+    QA = gdal.Open(QAPath)
+    qa_layers = QA.GetMetadataItem("QA_LAYERS").split(",")
+    QA = None
+
+    return {name: (QAPath, QA_BITS[name]) for name in qa_layers}
+
+#######################################################################################################################################
+def update_qa_cloud_mask(QAPath, CloudMask, expression=None, block_size=1024):
+    """
+    This function replaces the CLOUD layer of a QA mask (e.g. a cloud mask from cloud_mask_from_probability with other 
+    threshold, average or dilation) and creates the FINAL layer again. The other layers are kept.
+    Input: QAPath - Path of the QA mask TIF. String.
+           CloudMask - Cloud mask array at 10m spatial resolution.
+           expression - Mask expression of the final mask. Default None uses the expression of the QA mask (or 
+                        final_mask_expression if the QA mask has no CLOUD layer or expression).
+           block_size - Size of the blocks in pixels.
+    Output: QA mask TIF updated.
+            log_list - Logging messages.
+    """
+    sources = qa_sources(QAPath)
+    QA = gdal.Open(QAPath)
+    GeoTransform, Projection = QA.GetGeoTransform(), QA.GetProjectionRef()
+    # Without a previous CLOUD layer, the expression of the QA mask does not use clouds and the default expression is used
+    if expression is None and "CLOUD" in sources:
+        expression = QA.GetMetadataItem("QA_EXPRESSION")
+    QA = None
+    sources["CLOUD"] = CloudMask
+    mask_names = [name for name in QA_BITS if name in sources and name != "FINAL"]
+    if expression is None:
+        expression, log_list = final_mask_expression(mask_names)
+    else:
+        log_list = ["Created FINAL Mask using expression: " + expression]
+
+    # The QA mask is read by blocks while the new one is written, then replaced
+    TempPath = QAPath[:-4] + "_temp.tif"
+    write_qa_mask(TempPath, {name: sources[name] for name in mask_names}, expression, GeoTransform, Projection, block_size)
+    os.replace(TempPath, QAPath)
+    log_list.append("QA mask CLOUD and FINAL layers updated")
+
+    return log_list
 
 #######################################################################################################################################
-def CreateFinalMask(masked_product, NDWI_or_Band8_andS2cloudlessUIn = ['BAND8', False]):
+def qa_mask_path(masked_product_folder):
     """
-    This function reads Water Mask, NDWI Mask or Band 8 Mask (if exists) and Cloud Mask (if exists) from MaskingProductFolder and creates a final binary Mask from the combination. 
-    Input: masked_product - Folder of the product where the Masks folder containing masks is saved. String.
-           NDWI_or_Band8_andS2cloudlessUIn - A List containing the User Inputs for NDWI/BAND8 and Cloud Mask options. Default is ['BAND8' for NDWI or BAND8 mask, False for Cloud mask]. List [string , bool].
-    Output: Final Mask resulting from available masks.
+    This function provides the path of the QA mask of a masked product.
+    Input: masked_product_folder - Folder of the masked product. String.
+    Output: Path of the QA mask TIF. String.
+    """
+    return os.path.join(masked_product_folder, "Masks", os.path.basename(masked_product_folder)+"_QA_Mask.tif")
+
+#######################################################################################################################################
+def final_mask_expression(mask_names):
+    """
+    This function provides the default final mask expression for the available masks: water pixels (WATER mask is 1), 
+    with features (NDWI or BAND8 mask is 1, if exists) and without clouds (CLOUD mask is 0, if exists).
+    Input: mask_names - List of available masks, "WATER" and optional "NDWI" or "BAND8" and "CLOUD".
+    Output: expression - Mask expression as string, e.g. "WATER & NDWI & ~CLOUD".
             log_list - Logging messages.
-            FinalMaskPath - Path to the final mask.
     """
     # Logging list
     log_list = []
 
+    features = "NDWI" if "NDWI" in mask_names else "BAND8" if "BAND8" in mask_names else None
+    names = {"NDWI": "NDWI", "BAND8": "BAND 8"}
+    if (features is not None) and ("CLOUD" in mask_names):
+        log_list.append("Created FINAL Mask using ALL (WATER, " + names[features] + " and CLOUD) masks")
+    elif "CLOUD" in mask_names:
+        log_list.append("Created FINAL Mask using WATER Mask and CLOUD Mask")
+    elif features is not None:
+        log_list.append("Created FINAL Mask using WATER Mask and " + names[features] + " Mask")
+    else:
+        log_list.append("FINAL Mask corresponds to the WATER Mask")
+
+    expression = "WATER"
+    if features is not None:
+        expression = expression + " & " + features
+    if "CLOUD" in mask_names:
+        expression = expression + " & ~CLOUD"
+
+    return expression, log_list
+
+#######################################################################################################################################
+def final_mask(masks, expression=None):
+    """
+    This function combines Water Mask, NDWI Mask or Band 8 Mask (if exists) and Cloud Mask (if exists) into a final binary mask.
+    Input: masks - Dictionary with mask arrays, "WATER" (always available) and optional "NDWI" or "BAND8" and "CLOUD".
+           expression - Mask expression (see mask_expression). Default None uses final_mask_expression.
+    Output: log_list - Logging messages.
+            FinalMaskData - Final mask array as uint8, 1 where the expression is true.
+    """
+    if expression is None:
+        expression, log_list = final_mask_expression(list(masks))
+    else:
+        log_list = ["Created FINAL Mask using expression: " + expression]
+
+    return log_list, combine_masks(expression, masks)
+
+#######################################################################################################################################
+def save_masks(masked_product, masks, GeoTransform, Projection, save_intermediate=False, expression=None):
+    """
+    This function combines the masks by blocks and writes the QA mask of the product, with the masks and the final mask
+    as layers (see write_qa_mask). Each mask is only written as a separate TIF with save_intermediate, for debugging.
+    Input: masked_product - Folder of the product where the Masks folder is located. String.
+           masks - Dictionary with mask arrays, see final_mask, and optional "NAN" mask.
+           GeoTransform, Projection - Georeference of the masks (GDAL geotransform and WKT).
+           save_intermediate - Also write each mask as TIF. Bool.
+           expression - Mask expression (see mask_expression). Default None uses final_mask_expression.
+    Output: log_list - Logging messages.
+            QAPath - Path to the QA mask.
+    """
     MaskingProductFolder = os.path.join(masked_product, "Masks")
     Name = os.path.basename(masked_product)
-     
-    # Pick WATER mask (always available)
-    WaterMask = ",".join(glob.glob(os.path.join(MaskingProductFolder, "*WATER_Mask.tif"))).replace("\\","/")
-    # Read data as array
-    WaterMaskOpen = gdal.Open(WaterMask)
-    WaterMaskData = WaterMaskOpen.GetRasterBand(1)
-    WaterMaskRead = WaterMaskData.ReadAsArray()
-    # Final Mask Path
-    FinalMaskPath = os.path.join(MaskingProductFolder, Name + "_FINAL_Mask.tif")
-     
-    if NDWI_or_Band8_andS2cloudlessUIn[0] == 'NDWI' and NDWI_or_Band8_andS2cloudlessUIn[1] == True:
-        
-        log_list.append("Created FINAL Mask using ALL (WATER, NDWI and CLOUD) masks")
 
-        # Pick NDWI mask
-        NDWIMask = ",".join(glob.glob(os.path.join(MaskingProductFolder, '*NDWI_Thr_Dil_Mask.tif'))).replace("\\","/")
-        NDWIMaskOpen = gdal.Open(NDWIMask)
-        NDWIMaskData = NDWIMaskOpen.GetRasterBand(1)
-        NDWIMaskRead = NDWIMaskData.ReadAsArray()
+    if expression is None:
+        expression, log_list = final_mask_expression(list(masks))
+    elif all(name in masks for name in mask_expression(expression)[0]):
+        log_list = ["Created FINAL Mask using expression: " + expression]
+    else:
+        expression, log_list = final_mask_expression(list(masks))
+        log_list.insert(0, "Masks of final mask expression not available, using default expression: " + expression)
+    QAPath = qa_mask_path(masked_product)
+    write_qa_mask(QAPath, masks, expression, GeoTransform, Projection)
+    log_list.append("QA mask layers: " + ", ".join([name for name in QA_BITS if name in masks] + ["FINAL"]))
 
-        # Pick CLOUD mask
-        CloudMask = ",".join(glob.glob(os.path.join(MaskingProductFolder, '*CLOUD_Mask_10m.tif'))).replace("\\","/")
-        CloudMaskOpen = gdal.Open(CloudMask)
-        CloudMaskData = CloudMaskOpen.GetRasterBand(1)
-        CloudMaskRead = CloudMaskData.ReadAsArray()
+    if save_intermediate == True:
+        suffixes = {"WATER": "_WATER_Mask.tif", "NDWI": "_NDWI_Thr_Dil_Mask.tif", "BAND8": "_Band8_Thr_Dil_Mask.tif", 
+                    "CLOUD": "_CLOUD_Mask_10m.tif", "NAN": "_NAN_Mask.tif"}
+        for mask_name, mask_data in masks.items():
+            write_mask(os.path.join(MaskingProductFolder, Name + suffixes[mask_name]), mask_data, GeoTransform, Projection)
+        log_list.append("Intermediate masks saved: " + ", ".join(masks))
 
-        # Set 1 where WATER mask is == 1, CLOUD mask == 0 , NDWI mask = 1, 0 in the rest
-        WaterCloudMask = np.where(np.logical_and(WaterMaskRead==1, CloudMaskRead==0), 1, 0)
-        FinalMaskData = np.where(np.logical_and(WaterCloudMask==1, NDWIMaskRead==1), 1, 0)
+    return log_list, QAPath
 
-        # Save the mask
-        Driver = gdal.GetDriverByName("GTiff")
-        FinalMask = Driver.Create(FinalMaskPath,CloudMaskOpen.RasterXSize,CloudMaskOpen.RasterYSize,1,gdal.GDT_Byte)
-        FinalMask.SetProjection(CloudMaskOpen.GetProjectionRef())
-        FinalMask.SetGeoTransform(CloudMaskOpen.GetGeoTransform()) 
-        FinalMaskBand = FinalMask.GetRasterBand(1)
-        FinalMaskBand.WriteArray(FinalMaskData)
-        FinalMaskBand = None
-
-    elif NDWI_or_Band8_andS2cloudlessUIn[0] == 'BAND8' and NDWI_or_Band8_andS2cloudlessUIn[1] == True:
-        
-        log_list.append("Created FINAL Mask using ALL (WATER, BAND 8 and CLOUD) masks")
-
-        # Pick BAND 8 mask
-        Band8Mask = ",".join(glob.glob(os.path.join(MaskingProductFolder, '*Band8_Thr_Dil_Mask.tif'))).replace("\\","/")
-        Band8MaskOpen = gdal.Open(Band8Mask)
-        Band8MaskData = Band8MaskOpen.GetRasterBand(1)
-        Band8MaskRead = Band8MaskData.ReadAsArray()
+#######################################################################################################################################
+def qa_statistics(QAPath, block_size=1024):
+    """
+    This function computes the coverage of each layer of a QA mask, from a histogram of the QA values read by blocks.
+    Input: QAPath - Path of the QA mask TIF. String.
+           block_size - Size of the blocks in pixels.
+    Output: statistics - Dictionary with the number of pixels ("PIXELS") and the percentage of pixels of each layer.
+    """
+    QA = gdal.Open(QAPath)
+    qa_layers = QA.GetMetadataItem("QA_LAYERS").split(",")
+    QABand = QA.GetRasterBand(1)
+    counts = np.zeros(256, dtype=np.int64)
+    for window in block_windows(QA.RasterXSize, QA.RasterYSize, block_size):
+        counts += np.bincount(QABand.ReadAsArray(*window).ravel(), minlength=256)
+    QABand = None
+    QA = None
+
+    values = np.arange(256)
+    statistics = {"PIXELS": int(counts.sum())}
+    for name in qa_layers:
+        statistics[name] = float(100*counts[(values & QA_BITS[name]) != 0].sum()/max(1, statistics["PIXELS"]))
+
+    return statistics
 
-        # Pick CLOUD mask
-        CloudMask = ",".join(glob.glob(os.path.join(MaskingProductFolder, '*CLOUD_Mask_10m.tif'))).replace("\\","/")
-        CloudMaskOpen = gdal.Open(CloudMask)
-        CloudMaskData = CloudMaskOpen.GetRasterBand(1)
-        CloudMaskRead = CloudMaskData.ReadAsArray()
+#######################################################################################################################################
+def triage_product(masked_product, min_valid_coverage):
+    """
+    This function decides if a masked product is classified, from the coverage of the final mask (valid pixels). Products
+    without valid pixels (e.g. land only ROI, full cloud or no data) or with a coverage below the minimum keep their QA
+    mask, but skip stack masking, split and classification. The decision is saved as the QA_CLASSIFY metadata item of
+    the QA mask ("1" or "0", see triage_skipped) and the coverage of each mask and the decision are reported in Triage.txt.
+    Input: masked_product - Folder of the product where the Masks folder is located. String.
+           min_valid_coverage - Minimum percentage of valid pixels (FINAL mask) to classify the product.
+    Output: log_list - Logging messages.
+            classify - True if the product is classified. Bool.
+    """
+    statistics = qa_statistics(qa_mask_path(masked_product))
+    valid_coverage = statistics["FINAL"]
+    log_list = ["Pixels: " + str(statistics["PIXELS"])]
+    for name in [name for name in statistics if name not in ["PIXELS", "FINAL"]] + ["FINAL"]:
+        log_list.append(name + " coverage: " + str(round(statistics[name], 2)) + "%")
+
+    classify = (valid_coverage > 0) and (valid_coverage >= min_valid_coverage)
+    if classify:
+        log_list.append("Classification: performed")
+    elif valid_coverage == 0:
+        log_list.append("Classification: skipped (no valid pixels)")
+    else:
+        log_list.append("Classification: skipped (valid coverage " + str(round(valid_coverage, 2)) + "% below minimum " + 
+                        str(min_valid_coverage) + "%)")
+    with open(os.path.join(masked_product, "Triage.txt"), "w") as text_file:
+        text_file.write("\n".join(log_list))
+    QA = gdal.Open(qa_mask_path(masked_product), gdal.GA_Update)
+    QA.SetMetadataItem("QA_CLASSIFY", "1" if classify else "0")
+    QA = None
 
-        # Set 1 where WATER mask is == 1, CLOUD mask == 0 , NDWI mask = 1, 0 in the rest
-        WaterCloudMask = np.where(np.logical_and(WaterMaskRead==1, CloudMaskRead==0), 1, 0)
-        FinalMaskData = np.where(np.logical_and(WaterCloudMask==1, Band8MaskRead==1), 1, 0)
+    return log_list, classify
 
-        # Save the mask
-        Driver = gdal.GetDriverByName("GTiff")
-        FinalMask = Driver.Create(FinalMaskPath,CloudMaskOpen.RasterXSize,CloudMaskOpen.RasterYSize,1,gdal.GDT_Byte)
-        FinalMask.SetProjection(CloudMaskOpen.GetProjectionRef())
-        FinalMask.SetGeoTransform(CloudMaskOpen.GetGeoTransform()) 
-        FinalMaskBand = FinalMask.GetRasterBand(1)
-        FinalMaskBand.WriteArray(FinalMaskData)
-        FinalMaskBand = None
-
-    elif NDWI_or_Band8_andS2cloudlessUIn[0] == None and NDWI_or_Band8_andS2cloudlessUIn[1] == True:
-       
-        log_list.append("Created FINAL Mask using WATER Mask and CLOUD Mask")
+#######################################################################################################################################
+def triage_skipped(masked_product):
+    """
+    This function checks if the classification of a masked product was skipped by triage_product, from the QA_CLASSIFY
+    metadata item of the QA mask.
+    Input: masked_product - Folder of the masked product. String.
+    Output: True if the classification was skipped. Bool.
+    """
+    QAPath = qa_mask_path(masked_product)
+    if not os.path.exists(QAPath):
+        return False
+    QA = gdal.Open(QAPath)
+    classify = QA.GetMetadataItem("QA_CLASSIFY")
+    QA = None
 
-        # Pick CLOUD mask
-        CloudMask = ",".join(glob.glob(os.path.join(MaskingProductFolder, '*CLOUD_Mask_10m.tif'))).replace("\\","/")
-        CloudMaskOpen = gdal.Open(CloudMask)
-        CloudMaskData = CloudMaskOpen.GetRasterBand(1)
-        CloudMaskRead = CloudMaskData.ReadAsArray()
+    return classify == "0"
 
-        # Set 1 where WATER mask is == 1, CLOUD mask == 0 , 0 in the rest
-        FinalMaskData = np.where(np.logical_and(WaterMaskRead==1, CloudMaskRead==0), 1, 0)
+#######################################################################################################################################
+def write_mask(MaskPath, MaskData, GeoTransform, Projection):
+    """
+    This function writes a mask array as a Byte TIF, with the storage profile.
+    Input: MaskPath - Path of the TIF file. String.
+           MaskData - Mask array.
+           GeoTransform, Projection - Georeference of the mask (GDAL geotransform and WKT).
+    Output: Mask TIF.
+    """
+    Driver = gdal.GetDriverByName("GTiff")
+    Mask = Driver.Create(MaskPath, MaskData.shape[1], MaskData.shape[0], 1, gdal.GDT_Byte, options=creation_options(gdal.GDT_Byte))
+    Mask.SetProjection(Projection)
+    Mask.SetGeoTransform(GeoTransform)
+    Mask.GetRasterBand(1).WriteArray(MaskData)
+    Mask = None
 
-        # Save the mask
-        Driver = gdal.GetDriverByName("GTiff")
-        FinalMask = Driver.Create(FinalMaskPath,CloudMaskOpen.RasterXSize,CloudMaskOpen.RasterYSize,1,gdal.GDT_Byte)  
-        FinalMask.SetProjection(CloudMaskOpen.GetProjectionRef())
-        FinalMask.SetGeoTransform(CloudMaskOpen.GetGeoTransform()) 
-        FinalMaskBand = FinalMask.GetRasterBand(1)
-        FinalMaskBand.WriteArray(FinalMaskData)
-        FinalMaskBand = None
-          
-    elif NDWI_or_Band8_andS2cloudlessUIn[0] == 'NDWI' and NDWI_or_Band8_andS2cloudlessUIn[1] == False:
-       
-        log_list.append("Created FINAL Mask using WATER Mask and NDWI Mask")
-          
-        # Pick NDWI mask
-        NDWIMask = ",".join(glob.glob(os.path.join(MaskingProductFolder, '*NDWI_Thr_Dil_Mask.tif'))).replace("\\","/")
-        NDWIMaskOpen = gdal.Open(NDWIMask)
-        NDWIMaskData = NDWIMaskOpen.GetRasterBand(1)
-        NDWIMaskRead = NDWIMaskData.ReadAsArray()
-
-        # Set 1 where WATER mask is == 1, NDWI mask = 1, 0 in the rest
-        FinalMaskData = np.where(np.logical_and(WaterMaskRead==1, NDWIMaskRead==1), 1, 0)      
-              
-        # Save the mask
-        Driver = gdal.GetDriverByName("GTiff")
-        FinalMask = Driver.Create(FinalMaskPath,NDWIMaskOpen.RasterXSize,NDWIMaskOpen.RasterYSize,1,gdal.GDT_Byte)
-        FinalMask.SetProjection(NDWIMaskOpen.GetProjectionRef())
-        FinalMask.SetGeoTransform(NDWIMaskOpen.GetGeoTransform()) 
-        FinalMaskBand = FinalMask.GetRasterBand(1)
-        FinalMaskBand.WriteArray(FinalMaskData)
-        FinalMaskBand = None
-
-    elif NDWI_or_Band8_andS2cloudlessUIn[0] == 'BAND8' and NDWI_or_Band8_andS2cloudlessUIn[1] == False:
-       
-        log_list.append("Created FINAL Mask using WATER Mask and BAND 8 Mask")
-          
-        # Pick BAND 8 mask
-        Band8Mask = ",".join(glob.glob(os.path.join(MaskingProductFolder, '*Band8_Thr_Dil_Mask.tif'))).replace("\\","/")
-        Band8MaskOpen = gdal.Open(Band8Mask)
-        Band8MaskData = Band8MaskOpen.GetRasterBand(1)
-        Band8MaskRead = Band8MaskData.ReadAsArray()
-
-        # Set 1 where WATER mask is == 1, NDWI mask = 1, 0 in the rest
-        FinalMaskData = np.where(np.logical_and(WaterMaskRead==1, Band8MaskRead==1), 1, 0)      
-              
-        # Save the mask
-        Driver = gdal.GetDriverByName("GTiff")
-        FinalMask = Driver.Create(FinalMaskPath,Band8MaskOpen.RasterXSize,Band8MaskOpen.RasterYSize,1,gdal.GDT_Byte)
-        FinalMask.SetProjection(Band8MaskOpen.GetProjectionRef())
-        FinalMask.SetGeoTransform(Band8MaskOpen.GetGeoTransform()) 
-        FinalMaskBand = FinalMask.GetRasterBand(1)
-        FinalMaskBand.WriteArray(FinalMaskData)
-        FinalMaskBand = None
+#######################################################################################################################################
+def stack_georeference(ProductToMask):
+    """
+    This function provides the georeference of the ACOLITE-corrected stack.
+    Input: ProductToMask - Path to the ACOLITE product folder where the stack is saved. String.
+    Output: GeoTransform, Projection - GDAL geotransform and WKT.
+    """
+    Stack = gdal.Open(stack_path(ProductToMask))
+    GeoTransform, Projection = Stack.GetGeoTransform(), Stack.GetProjectionRef()
+    Stack = None
 
-    else:
-        log_list.append("FINAL Mask corresponds to the WATER Mask")
-        # Pick WATER mask, make a copy and change name
-        shutil.copy(WaterMask, FinalMaskPath)
-
-    # Close rasters
-    WaterMaskOpen = None
-    NDWIMaskOpen = None
-    CloudMaskOpen = None
-    Band8MaskOpen = None
-        
-    return log_list, FinalMaskPath
+    return GeoTransform, Projection
 
 #######################################################################################################################################
 def mask_stack(ac_product_folder, masked_product_folder, filter_ignore_value):
     """
-    This function uses a mask to filter the data in a stack TIF file and creates a new masked stack TIF. 
+    This function uses the final mask (FINAL layer of the QA mask) to filter the data in a stack TIF file and creates a new masked stack TIF. 
     It also removes negative reflectances (optional).
     Input: ac_product_folder - Product folder with atmospheric corrected stack TIF.
-           masked_product_folder - Product folder with Masks folder inside where the mask is located.
-           filter_ignore_value - Value of the mask to ignore.
-    Output: Masked stack TIF saved inside masked_product_folder. 
+           masked_product_folder - Product folder with Masks folder inside where the QA mask is located.
+           filter_ignore_value - Value of the final mask to ignore.
+    Output: Masked stack TIF saved inside masked_product_folder. For virtual stacks, only the bands are masked
+            and a masked virtual stack (VRT) is written, indices of masked pixels are NaN.
     """
-    ac_product_name = os.path.basename(ac_product_folder)
-    stack_path = os.path.join(ac_product_folder, ac_product_name+"_stack.tif")
-    stack = gdal.Open(stack_path)
+    ac_stack_path = stack_path(ac_product_folder)
+    masked_product_name = os.path.basename(masked_product_folder)
+    if ac_stack_path.endswith(".vrt"):
+        bands_path, features, s2platform = virtual_stack_info(ac_stack_path)
+        input_path = bands_path
+        masked_stack_path = os.path.join(masked_product_folder, masked_product_name+"_masked_bands.tif")
+    else:
+        input_path = ac_stack_path
+        masked_stack_path = os.path.join(masked_product_folder, masked_product_name+"_masked_stack.tif")
+    stack = gdal.Open(input_path)
     stack_size = [stack.RasterXSize, stack.RasterYSize]
     band_number = stack.RasterCount
 
-    # Read mask as array
-    masked_product_name = os.path.basename(masked_product_folder)
-    mask_path = os.path.join(masked_product_folder, "Masks", masked_product_name+"_FINAL_Mask.tif")
-    mask = gdal.Open(mask_path)
+    # Open QA mask, the final mask is the FINAL layer
+    mask = gdal.Open(qa_mask_path(masked_product_folder))
     mask_band = mask.GetRasterBand(1)
-    mask_data = mask_band.ReadAsArray()
+    # Check if the mask can be used with the stack in terms of shape
+    assert [mask.RasterXSize, mask.RasterYSize] == stack_size
 
     # Init masked stack
     driver = gdal.GetDriverByName("GTiff")
-    masked_stack_path = os.path.join(masked_product_folder, masked_product_name+"_masked_stack.tif")
-    masked_stack = driver.Create(masked_stack_path, stack_size[0], stack_size[1], band_number, gdal.GDT_Float32)
+    masked_stack = driver.Create(masked_stack_path, stack_size[0], stack_size[1], band_number, gdal.GDT_Float32, 
+                                 options=creation_options(gdal.GDT_Float32, features_raster=True))
     masked_stack.SetProjection(stack.GetProjectionRef())
     masked_stack.SetGeoTransform(stack.GetGeoTransform())
 
+    no_data_vals = []
     for bn in range(1, band_number+1):
         band = stack.GetRasterBand(bn)
-        band_name = band.GetDescription()
-        no_data_val = band.GetNoDataValue()
-        band_data = band.ReadAsArray()
-        # Check if the mask can be used with the stack in terms of shape
-        assert band_data.shape == mask_data.shape
-        # Apply filter
-        band_data[mask_data==filter_ignore_value] = no_data_val
-        masked_band = masked_stack.GetRasterBand(bn)
-        masked_band.SetDescription(band_name)
-        masked_band.WriteArray(band_data)
+        masked_stack.GetRasterBand(bn).SetDescription(band.GetDescription())
+        no_data_vals.append(band.GetNoDataValue())
+
+    # Apply filter by blocks, all bands of a block are read and written in one call (pixel or band interleaved stacks)
+    for xoff, yoff, xsize, ysize in block_windows(stack_size[0], stack_size[1], 1024):
+        stack_data = stack.ReadAsArray(xoff, yoff, xsize, ysize).reshape(band_number, ysize, xsize).astype(np.float32, copy=False)
+        final_data = (mask_band.ReadAsArray(xoff, yoff, xsize, ysize) & QA_BITS["FINAL"]) != 0
+        filtered = final_data.astype(np.uint8) == filter_ignore_value
+        for bn, no_data_val in enumerate(no_data_vals):
+            stack_data[bn][filtered] = no_data_val
+        masked_stack.WriteRaster(xoff, yoff, xsize, ysize, stack_data.tobytes(), buf_type=gdal.GDT_Float32)
 
     # Close
     stack = None
+    mask = None
     masked_stack = None
 
+    # Masked virtual stack
+    if ac_stack_path.endswith(".vrt"):
+        write_virtual_stack(os.path.join(masked_product_folder, masked_product_name+"_masked_stack.vrt"), masked_stack_path, 
+                            features, s2platform)
+
 #######################################################################################################################################
-def mask_stack_later(folder_with_mosaic, masked_product_folder, filter_ignore_value):
+def masked_pixels_path(masked_product_folder):
+    """
+    This function provides the path of the valid pixels file of a masked product (see mask_stack_pixels).
+    Input: masked_product_folder - Folder of the masked product. String.
+    Output: Path of the NPZ file. String.
+    """
+    return os.path.join(masked_product_folder, os.path.basename(masked_product_folder)+"_masked_stack.npz")
+
+#######################################################################################################################################
+def remove_masked_stacks(masked_product_folder):
+    """
+    This function removes the masked stack of a masked product in every masked_stack_format (TIF, VRT with its bands
+    TIF and valid pixels NPZ). A product masked again (cloud_remask) keeps its folder, so a stack of a previous format 
+    would otherwise remain and also be classified.
+    Input: masked_product_folder - Folder of the masked product. String.
+    Output: Masked stacks removed from masked_product_folder.
+    """
+    masked_product_name = os.path.basename(masked_product_folder)
+    for masked_stack in glob.glob(os.path.join(masked_product_folder, masked_product_name+"_masked_stack.*")) + \
+                        glob.glob(os.path.join(masked_product_folder, masked_product_name+"_masked_bands.tif")):
+        os.remove(masked_stack)
+
+#######################################################################################################################################
+def mask_stack_pixels(ac_product_folder, masked_product_folder, filter_ignore_value, features=None, block_lines=256):
+    """
+    This function uses the final mask (FINAL layer of the QA mask) to select the valid pixels of a stack, instead of 
+    writing a masked stack TIF (see mask_stack). The flat indices of the valid pixels (row*columns+column) are saved in
+    a NPZ file, with the shape and path of the stack, and optionally the features of the valid pixels as a packed 
+    (valid pixels x features) matrix. RF and XGB classify the valid pixels directly (see convert_masked_pixels_rfxgb), 
+    so masked pixels are not copied, written or classified.
+    Input: ac_product_folder - Product folder with atmospheric corrected stack TIF (or VRT).
+           masked_product_folder - Product folder with Masks folder inside where the QA mask is located.
+           filter_ignore_value - Value of the final mask to ignore.
+           features - Tuple of features to save for the valid pixels. Default None only saves the indices, the features
+                      are read from the stack during classification.
+           block_lines - Number of lines read by block.
+    Output: NPZ file saved inside masked_product_folder (see masked_pixels_path).
+            n_valid - Number of valid pixels.
+    """
+    ac_stack_path = stack_path(ac_product_folder)
+    stack = gdal.Open(ac_stack_path)
+    x_size, y_size = stack.RasterXSize, stack.RasterYSize
+
+    # Open QA mask, the final mask is the FINAL layer
+    mask = gdal.Open(qa_mask_path(masked_product_folder))
+    mask_band = mask.GetRasterBand(1)
+    # Check if the mask can be used with the stack in terms of shape
+    assert [mask.RasterXSize, mask.RasterYSize] == [x_size, y_size]
+
+    # Flat indices of valid pixels, by blocks of lines (sorted)
+    index_dtype = np.uint32 if x_size*y_size < 2**32 else np.int64
+    indices = []
+    for yoff in range(0, y_size, block_lines):
+        ysize = min(block_lines, y_size-yoff)
+        final_data = (mask_band.ReadAsArray(0, yoff, x_size, ysize) & QA_BITS["FINAL"]) != 0
+        valid = final_data.astype(np.uint8) != filter_ignore_value
+        indices.append((np.flatnonzero(valid) + yoff*x_size).astype(index_dtype))
+    indices = np.concatenate(indices)
+    mask_band = None
+    mask = None
+
+    masked_pixels = {"indices": indices, "shape": np.array([y_size, x_size]), "stack": np.array(ac_stack_path)}
+    if features is not None:
+        masked_pixels["features"] = np.array(features)
+        masked_pixels["pixels"] = read_pixel_vectors(stack, stack_band_numbers(ac_stack_path, features), block_lines, indices)
+    stack = None
+    np.savez(masked_pixels_path(masked_product_folder), **masked_pixels)
+
+    return len(indices)
+
+#######################################################################################################################################
+def copy_stack(ac_product_folder, masked_product_folder):
+    """
+    This function copies the stack to the masked product folder without masking. For virtual stacks, the bands TIF
+    is copied and the virtual stack is rebuilt over the copy.
+    Input: ac_product_folder - Product folder with atmospheric corrected stack TIF (or VRT).
+           masked_product_folder - Product folder where the stack is copied as masked stack.
+    Output: Stack TIF (or VRT) saved inside masked_product_folder. 
+    """
+    ac_stack_path = stack_path(ac_product_folder)
+    masked_product_name = os.path.basename(masked_product_folder)
+    if ac_stack_path.endswith(".vrt"):
+        bands_path, features, s2platform = virtual_stack_info(ac_stack_path)
+        masked_bands_path = os.path.join(masked_product_folder, masked_product_name+"_masked_bands.tif")
+        shutil.copy(bands_path, masked_bands_path)
+        write_virtual_stack(os.path.join(masked_product_folder, masked_product_name+"_masked_stack.vrt"), masked_bands_path, 
+                            features, s2platform)
+    else:
+        shutil.copy(ac_stack_path, os.path.join(masked_product_folder, masked_product_name+"_masked_stack.tif"))
+
+#######################################################################################################################################
+def vrt_mask(in_ar, out_ar, xoff, yoff, xsize, ysize, raster_xsize, raster_ysize, buf_radius, gt, **kwargs):
+    """
+    This function is the GDAL VRT Python pixel function used by masked virtual stacks to apply the final mask on read.
+    Input: in_ar - List of source arrays, the stack band and the QA mask.
+           out_ar - Output array, filled in place.
+           xoff, yoff, xsize, ysize, raster_xsize, raster_ysize, buf_radius, gt - Window information given by GDAL, not used.
+           kwargs - PixelFunctionArguments of the VRT band: "bit" (FINAL bit of the QA mask), "ignore" (value of the 
+                    final mask to ignore) and "nodata" (value of the masked pixels).
+    Output: Masked band values written in out_ar.
+    """
+    # GDAL gives the arguments as bytes
+    arguments = {key:(value.decode() if isinstance(value, bytes) else value) for key, value in kwargs.items()}
+    filtered = ((np.asarray(in_ar[1]).astype(np.uint8) & int(arguments["bit"])) != 0).astype(np.uint8) == int(arguments["ignore"])
+    out_ar[:] = in_ar[0]
+    out_ar[filtered] = float(arguments["nodata"])
+
+#######################################################################################################################################
+def write_masked_virtual_stack(ac_product_folder, masked_product_folder, filter_ignore_value=None):
     """
-    This function is similar to mask_stack function, but used for Unet later masking  and applies and additional nan mask. 
+    This function writes the masked stack as a virtual stack (VRT) over the atmospheric corrected stack, instead of a
+    masked copy (see mask_stack and copy_stack). The final mask (FINAL layer of the QA mask) is applied on read by the 
+    Python pixel function vrt_mask, only for the windows requested, so the stack is not duplicated on disk. The QA mask
+    is a sidecar of the masked product (Masks folder). Band descriptions keep the stack schema.
+    Input: ac_product_folder - Product folder with atmospheric corrected stack TIF (or VRT).
+           masked_product_folder - Product folder with Masks folder inside where the QA mask is located.
+           filter_ignore_value - Value of the final mask to ignore. Default None does not mask the stack (Unet, masked later).
+    Output: Masked virtual stack (VRT) saved inside masked_product_folder.
     """
-    # Read nan masks as array
+    enable_vrt_python()
+    ac_stack_path = stack_path(ac_product_folder)
     masked_product_name = os.path.basename(masked_product_folder)
-    nan_mask_path = os.path.join(masked_product_folder, "Masks", masked_product_name+"_NAN_Mask.tif")
-    nan_mask = gdal.Open(nan_mask_path)
-    nan_mask_band = nan_mask.GetRasterBand(1)
-    nan_mask_data = nan_mask_band.ReadAsArray()
+    vrt_path = os.path.join(masked_product_folder, masked_product_name+"_masked_stack.vrt")
+    stack_file = os.path.relpath(ac_stack_path, masked_product_folder)
+    qa_file = os.path.relpath(qa_mask_path(masked_product_folder), masked_product_folder)
+
+    stack = gdal.Open(ac_stack_path)
+    vrt = ET.Element("VRTDataset", rasterXSize=str(stack.RasterXSize), rasterYSize=str(stack.RasterYSize))
+    ET.SubElement(vrt, "SRS").text = stack.GetProjectionRef()
+    ET.SubElement(vrt, "GeoTransform").text = ", ".join(repr(value) for value in stack.GetGeoTransform())
+    metadata = ET.SubElement(vrt, "Metadata")
+    ET.SubElement(metadata, "MDI", key="STACK_FILE").text = stack_file
+    if filter_ignore_value is not None:
+        ET.SubElement(metadata, "MDI", key="QA_FILE").text = qa_file
+
+    for bn in range(1, stack.RasterCount+1):
+        band = stack.GetRasterBand(bn)
+        no_data_val = band.GetNoDataValue()
+        if filter_ignore_value is None:
+            vrt_band = ET.SubElement(vrt, "VRTRasterBand", dataType="Float32", band=str(bn))
+        else:
+            vrt_band = ET.SubElement(vrt, "VRTRasterBand", dataType="Float32", band=str(bn), subClass="VRTDerivedRasterBand")
+        ET.SubElement(vrt_band, "Description").text = band.GetDescription()
+        if no_data_val is not None:
+            ET.SubElement(vrt_band, "NoDataValue").text = repr(no_data_val)
+        if filter_ignore_value is not None:
+            ET.SubElement(vrt_band, "PixelFunctionType").text = "modules.Masking.vrt_mask"
+            ET.SubElement(vrt_band, "PixelFunctionLanguage").text = "Python"
+            ET.SubElement(vrt_band, "PixelFunctionArguments", bit=str(QA_BITS["FINAL"]), ignore=str(filter_ignore_value), 
+                          nodata="nan" if no_data_val is None else repr(no_data_val))
+        for source_file, source_band in [(stack_file, bn)] + ([] if filter_ignore_value is None else [(qa_file, 1)]):
+            simple_source = ET.SubElement(vrt_band, "SimpleSource")
+            ET.SubElement(simple_source, "SourceFilename", relativeToVRT="1").text = source_file
+            ET.SubElement(simple_source, "SourceBand").text = str(source_band)
+    stack = None
+
+    ET.ElementTree(vrt).write(vrt_path)
+
+#######################################################################################################################################
+def mask_stack_later(folder_with_mosaic, masked_product_folder, filter_ignore_value):
+    """
+    This function is similar to mask_stack function, but used for Unet later masking  and applies and additional nan mask.
+    The nan mask (NAN layer) and the final mask (FINAL layer) are decoded from a single read of the QA mask. 
+    """
+    # Read QA mask, decode nan and final masks
+    qa_mask = gdal.Open(qa_mask_path(masked_product_folder))
+    qa_mask_data = qa_mask.GetRasterBand(1).ReadAsArray()
+    qa_mask = None
+    nan_mask_data = ((qa_mask_data & QA_BITS["NAN"]) != 0).astype(np.uint8)
+    mask_data = ((qa_mask_data & QA_BITS["FINAL"]) != 0).astype(np.uint8)
+    qa_mask_data = None
 
     # Apply nan mask to mosaic
     folder_with_mosaic_name = os.path.basename(folder_with_mosaic)
@@ -548,21 +1095,14 @@ def mask_stack_later(folder_with_mosaic, masked_product_folder, filter_ignore_va
     mosaic_data[nan_mask_data == 1] = np.nan
     mosaic_band.WriteArray(mosaic_data)
 
-    nan_mask = None
     mosaic = None
 
     # Apply final mask to mosaic
     mosaic = gdal.Open(mosaic_path)
     mosaic_size = [mosaic.RasterXSize, mosaic.RasterYSize]
  
-    # Read mask as array
-    masked_product_name = os.path.basename(masked_product_folder)
-    mask_path = os.path.join(masked_product_folder, "Masks", masked_product_name+"_FINAL_Mask.tif")
-    mask = gdal.Open(mask_path)
-    mask_band = mask.GetRasterBand(1)
-    mask_data = mask_band.ReadAsArray()
-
     # Create masked mosaic
+    masked_product_name = os.path.basename(masked_product_folder)
     driver = gdal.GetDriverByName("GTiff")
     masked_mosaic_path = os.path.join(folder_with_mosaic, masked_product_name+"_masked_stack_unet")
     if folder_with_mosaic_name[:-1] == "sc_map":
@@ -571,7 +1111,7 @@ def mask_stack_later(folder_with_mosaic, masked_product_folder, filter_ignore_va
     else:
         dtype = gdal.GDT_Float32
         masked_mosaic_path = masked_mosaic_path + "-probamap.tif"
-    masked_mosaic = driver.Create(masked_mosaic_path, mosaic_size[0], mosaic_size[1], 1, eType=dtype)
+    masked_mosaic = driver.Create(masked_mosaic_path, mosaic_size[0], mosaic_size[1], 1, eType=dtype, options=creation_options(dtype))
     masked_mosaic.SetProjection(mosaic.GetProjectionRef())
     masked_mosaic.SetGeoTransform(mosaic.GetGeoTransform())
     band = mosaic.GetRasterBand(1)
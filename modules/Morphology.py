@@ -0,0 +1,104 @@
+#!/usr/bin/env python3.9
+# -*- coding: utf-8 -*-
+"""
+Binary morphology functions for masks (dilation and erosion), with a cost independent of the radius.
+
+@author: AIR Centre
+"""
+
+### Import Libraries ###################################################################################################################
+import numpy as np
+from scipy import ndimage
+
+########################################################################################################################################
+# Radius up to which a direct dilation (structuring element) is faster than a distance transform. Above it, distance
+# transforms are used, with a cost that does not depend on the radius. Both give the same result.
+CROSS_DIRECT_MAX_ITERATIONS = 2
+DISK_DIRECT_MAX_RADIUS = 3
+
+########################################################################################################################################
+def process_strips(mask, halo, process_strip, block_lines=1024):
+    """
+    This function applies a morphological operation to a mask by strips of lines, with halo lines above and below,
+    so the temporary arrays (e.g. distance transforms) are the size of a strip (as the blocks of Auxiliar.process_blocks).
+    The result is exact when the operation only depends on pixels up to halo lines away.
+    Input: mask - 2D mask array.
+           halo - Number of lines added above and below each strip.
+           process_strip - Function called as process_strip(mask_strip), returns an array with the same shape.
+           block_lines - Number of lines of each strip.
+    Output: result - 2D array as uint8.
+    """
+    result = np.empty(mask.shape, dtype=np.uint8)
+    for start in range(0, mask.shape[0], block_lines):
+        end = min(start+block_lines, mask.shape[0])
+        lo, hi = max(0, start-halo), min(mask.shape[0], end+halo)
+        result[start:end] = process_strip(mask[lo:hi])[start-lo:end-lo]
+
+    return result
+
+########################################################################################################################################
+def dilate_cross(mask, iterations, block_lines=1024):
+    """
+    This function dilates a binary mask with the 3x3 cross structuring element repeated a number of times, same as
+    ndimage.binary_dilation(mask, iterations=iterations). The result is the set of pixels up to a taxicab distance
+    of iterations from the mask, obtained with a single chamfer distance transform instead of one pass by iteration.
+    Input: mask - 2D mask array (1 or True for mask pixels).
+           iterations - Number of iterations of the dilation (>= 1).
+           block_lines - Number of lines processed at once.
+    Output: Dilated mask as uint8.
+    """
+    mask = np.asarray(mask) != 0
+    if iterations <= CROSS_DIRECT_MAX_ITERATIONS:
+        return ndimage.binary_dilation(mask, iterations=iterations).astype(np.uint8)
+
+    def dilate_strip(mask_strip):
+        if not mask_strip.any():
+            return np.zeros(mask_strip.shape, dtype=np.uint8)
+        return ndimage.distance_transform_cdt(~mask_strip, metric="taxicab") <= iterations
+
+    return process_strips(mask, iterations, dilate_strip, block_lines)
+
+########################################################################################################################################
+def disk(radius):
+    """
+    This function provides a disk structuring element, pixels with x^2+y^2 <= radius^2 (same as skimage.morphology.disk).
+    Input: radius - Radius of the disk in pixels.
+    Output: Disk array (2*radius+1, 2*radius+1) as uint8.
+    """
+    y, x = np.mgrid[-radius:radius+1, -radius:radius+1]
+    return (x**2 + y**2 <= radius**2).astype(np.uint8)
+
+########################################################################################################################################
+def dilate_disk(mask, radius, block_lines=1024):
+    """
+    This function dilates a binary mask with a disk of a given radius, same as skimage.morphology.dilation(mask, disk(radius))
+    used by s2cloudless. The result is the set of pixels up to an euclidean distance of radius from the mask, obtained
+    with an exact euclidean distance transform instead of a maximum over the disk for each pixel.
+    Input: mask - 2D mask array (1 or True for mask pixels).
+           radius - Radius of the disk in pixels (>= 1).
+           block_lines - Number of lines processed at once.
+    Output: Dilated mask as uint8.
+    """
+    mask = np.asarray(mask) != 0
+    if radius <= DISK_DIRECT_MAX_RADIUS:
+        return ndimage.binary_dilation(mask, structure=disk(radius)).astype(np.uint8)
+
+    def dilate_strip(mask_strip):
+        if not mask_strip.any():
+            return np.zeros(mask_strip.shape, dtype=np.uint8)
+        return ndimage.distance_transform_edt(~mask_strip) <= radius
+
+    return process_strips(mask, radius, dilate_strip, block_lines)
+
+########################################################################################################################################
+def erode_square(mask, radius, border_value=1):
+    """
+    This function erodes a binary mask with a (2*radius+1)x(2*radius+1) square, same as
+    ndimage.minimum_filter(mask, size=2*radius+1, mode='constant', cval=border_value). It is a single
+    ndimage.minimum_filter call over uint8 data, instead of the int64 array previously used for the land buffer.
+    Input: mask - 2D mask array with 0 and 1 values.
+           radius - Radius of the square in pixels.
+           border_value - Value of the pixels outside the mask (1 does not erode from the borders).
+    Output: Eroded mask as uint8.
+    """
+    return ndimage.minimum_filter(np.asarray(mask, dtype=np.uint8), size=2*radius+1, mode='constant', cval=border_value)
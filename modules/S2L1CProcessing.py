@@ -11,8 +11,11 @@ import glob
 import os
 import zipfile
 import sys
-from xml.dom import minidom
+import math
+import xml.etree.ElementTree as ET
 import shutil
+import pandas as pd
+from shapely.geometry import box
 from tqdm import tqdm
 import time
 from datetime import datetime, timedelta
@@ -30,6 +33,9 @@ import sentinel2 as sentinel2
 sys.path.append(os.path.join(Basepath,'configs/acolite-main'))
 import acolite as ac
 
+### Import Defined Functions ###########################################################################################################
+from modules.S2L2Processing import S2_BANDS_WAVELENGTHS, feature_bands
+
 ########################################################################################################################################
 def CollectDownloadLinkofS2L1Cproducts_GC(ROI, SensingPeriod, S2CatalogueFolder, OutputFolder):
     """
@@ -189,7 +195,86 @@ def download_s2l1c_cdse(cdse_user, cdse_pass, url_safe, output_folder):
     return log_list
 
 #######################################################################################################################################
-def ACacolite(FilesToAC, OutputFolder, EDuser, EDpass, ROI):
+def roi_pixels(ROI, resolution=10):
+    """
+    This function estimates the number of pixels of the ROI bounding box (the ACOLITE limit, see ACacolite) at a 
+    spatial resolution, with the length of a degree at the center latitude of the ROI.
+    Input: ROI - SentinelHub EOBrowser (https://apps.sentinel-hub.com/eo-browser/) dictionary format.
+           resolution - Spatial resolution in meters.
+    Output: Number of pixels. Integer.
+    """
+    S = ROI['coordinates'][0][0][1]
+    W = ROI['coordinates'][0][0][0]
+    N = ROI['coordinates'][0][2][1]
+    E = ROI['coordinates'][0][2][0]
+    degree = 111320
+    height = abs(N-S)*degree
+    width = abs(E-W)*degree*math.cos(math.radians((N+S)/2))
+
+    return int(round(width/resolution))*int(round(height/resolution))
+
+#######################################################################################################################################
+def acolite_output_profile(masking, masking_options, atmospheric_correction_options, features=None, ROI=None):
+    """
+    This function builds the ACOLITE output profile, so ACOLITE only produces and writes the L2W parameters that 
+    are read downstream. Rayleigh-corrected reflectances (rhorc) are needed for the features stack, surface 
+    reflectances (rhos) B03 and B08 only for the NDWI-based mask and top of atmosphere reflectances (rhot) only for
+    the s2cloudless cloud mask. RGB PNGs are never read, so they are not produced.
+    With the direct stack option, ACOLITE keeps the L2W NetCDF instead of exporting per-band GeoTIFFs.
+    With the ROI, the L2W bytes written with the profile and with the default profile of ACacolite are estimated from 
+    the ROI size (float32 bands at 10m, see roi_pixels), so the reduction of ACOLITE writes is logged in bytes.
+    Input: masking - Masking option from User_Inputs. Bool.
+           masking_options - Masking options dictionary from User_Inputs.
+           atmospheric_correction_options - Atmospheric correction options dictionary from User_Inputs.
+           features - Tuple of features stored in the stack (see required_features). Default None for all features.
+           ROI - SentinelHub EOBrowser (https://apps.sentinel-hub.com/eo-browser/) dictionary format. Default None does
+                 not estimate the bytes written.
+    Output: output_profile - Dictionary with ACOLITE settings to update in ACacolite.
+            log_list - Logging messages.
+    """
+    # Logging list
+    log_list = []
+
+    # Bands read downstream
+    if features is None:
+        rhorc_bands = ['B01','B02','B03','B04','B05','B06','B07','B08','B8A','B11','B12']
+    else:
+        rhorc_bands = list(feature_bands(features))
+    rhos_bands = []
+    rhot_bands = []
+    if masking == True:
+        if masking_options["features_mask"] == "NDWI":
+            rhos_bands = ['B03','B08']
+        if masking_options["cloud_mask"] == True:
+            rhot_bands = ['B01','B02','B04','B05','B08','B8A','B09','B10','B11','B12']
+
+    l2w_parameters = [f"rhorc_{wl}" for band in rhorc_bands for wl in S2_BANDS_WAVELENGTHS[band]] + \
+                     [f"rhos_{wl}" for band in rhos_bands for wl in S2_BANDS_WAVELENGTHS[band]] + \
+                     [f"rhot_{wl}" for band in rhot_bands for wl in S2_BANDS_WAVELENGTHS[band]]
+    output_profile = {'l2w_parameters': l2w_parameters, 'rgb_rhot': False, 'rgb_rhos': False}
+    if atmospheric_correction_options["direct_stack"] == True:
+        output_profile['l2w_export_geotiff'] = False
+        output_profile['l2w_delete_netcdf'] = False
+        log_list.append("ACOLITE L2W NetCDF will be read directly by the features stack and masking")
+
+    log_list.append("ACOLITE output profile: " + str(len(rhorc_bands)) + " rhorc, " + str(len(rhos_bands)) + " rhos and " + 
+                    str(len(rhot_bands)) + " rhot bands, no RGB PNGs")
+
+    # L2W bands of the default profile (see ACacolite): rhot of all bands, rhos and rhorc of all bands except the 
+    # atmospheric bands B09 and B10. Each band of a product has one wavelength.
+    if ROI is not None:
+        band_bytes = 4*roi_pixels(ROI)
+        default_bands = len(S2_BANDS_WAVELENGTHS) + 2*len([band for band in S2_BANDS_WAVELENGTHS if band not in ['B09','B10']])
+        profile_bands = len(rhorc_bands) + len(rhos_bands) + len(rhot_bands)
+        log_list.append("ACOLITE L2W writes estimated from the ROI size: " + str(round(profile_bands*band_bytes/1e6, 1)) + " MB (" + 
+                        str(profile_bands) + " bands) instead of " + str(round(default_bands*band_bytes/1e6, 1)) + " MB (" + 
+                        str(default_bands) + " bands) with the default profile, " + 
+                        str(round((default_bands-profile_bands)*band_bytes/1e6, 1)) + " MB less by product")
+
+    return output_profile, log_list
+
+#######################################################################################################################################
+def ACacolite(FilesToAC, OutputFolder, EDuser, EDpass, ROI, OutputProfile=None):
     """
     This function applies atmospheric correction to Sentinel-2 L1C products using ACOLITE.
     Input: FilesToAC - List with paths (strings) of products to process.
@@ -197,6 +282,8 @@ def ACacolite(FilesToAC, OutputFolder, EDuser, EDpass, ROI):
            EDuser - EarthData user as string.
            EDpass - EarthData password as string.
            ROI - SentinelHub EOBrowser (https://apps.sentinel-hub.com/eo-browser/) dictionary format.
+           OutputProfile - Dictionary with ACOLITE settings created by acolite_output_profile. If None,
+                           all rhot, rhos and rhorc bands and RGB PNGs are produced.
     Output: Atmospherically Corrected products (L2).
     """
     # Define settings
@@ -237,6 +324,9 @@ def ACacolite(FilesToAC, OutputFolder, EDuser, EDpass, ROI):
     settings['delete_acolite_run_text_files'] = True
     # GeoTIFF export options for L2W files
     settings['l2w_export_geotiff'] = True
+    # Only produce what will be read downstream
+    if OutputProfile is not None:
+        settings.update(OutputProfile)
  
     # Run Acolite
     ac.acolite.acolite_run(settings)
@@ -352,6 +442,96 @@ def CleanAndOrganizeACOLITE(AcoliteFolder, S2L1CproductsFolder, SAFEFileName):
                 
     return log_list
            
+#######################################################################################################################################
+def OrganizeACOLITE_L2W(AcoliteFolder, S2L1CproductsFolder, SAFEFileName):
+    """
+    This function is similar to CleanAndOrganizeACOLITE, but used when ACOLITE keeps the L2W NetCDF (direct stack option).
+    The L2W NetCDF is moved into a folder according to product name, ready for create_features_stack_from_l2w and masking.
+    Input: AcoliteFolder - Path to the folder containing the ACOLITE L2W NetCDF. String.
+           S2L1CproductsFolder - Folder path where the original products are saved. String.
+           SAFEFileName - SAFE file name of the original product. String.
+    Output: L2W NetCDF organized into a folder with the product name.
+            log_list - Logging messages.
+    """
+    # Logging list
+    log_list = []
+
+    # Delete unnecessary files in output folder
+    for FileToDelete in glob.glob(os.path.join(AcoliteFolder, "*.png")) + glob.glob(os.path.join(AcoliteFolder, "*flags.tif")): 
+        os.remove(FileToDelete)
+
+    ListOfL2WPaths = glob.glob(os.path.join(AcoliteFolder, "*_L2W.nc"))
+    # Through message if the ROI falls 100% on the no data side of the partial tile.
+    if len(ListOfL2WPaths) == 0:
+        log_list.append("ROI falls 100% on the no data side of the partial tile. Product excluded")
+        # Deleting unnecessary original products files from S2L1CproductsFolder 
+        shutil.rmtree(os.path.join(S2L1CproductsFolder, SAFEFileName))
+    else:
+        L2WPath = ListOfL2WPaths[0]
+        ACOLITEProductFolderName = '_'.join(os.path.basename(L2WPath).split('_')[0:9])
+        ACOLITEProductFolder = os.path.join(AcoliteFolder, ACOLITEProductFolderName)
+
+        # Avoid overwrite of results by ACOLITE for products with same SENSING TIME
+        if os.path.exists(ACOLITEProductFolder):
+            log_list.append("Product with same sensing time. Overwrite avoided. Product excluded")
+            os.remove(L2WPath)
+            shutil.rmtree(os.path.join(S2L1CproductsFolder, SAFEFileName))
+        else:
+            os.mkdir(ACOLITEProductFolder)
+            shutil.move(L2WPath, os.path.join(ACOLITEProductFolder, os.path.basename(L2WPath)))
+            
+            # Create text file with SAFE file name inside
+            with open(os.path.join(ACOLITEProductFolder, "Info.txt"), "w") as text_file:
+                text_file.write(SAFEFileName)
+
+    # Delete logfiles (.txt) left on the folder
+    for TxttoDelete in glob.glob(os.path.join(AcoliteFolder, "*.txt")): 
+        os.remove(TxttoDelete)
+
+    return log_list
+
+#######################################################################################################################################
+def read_xml_values(xml_path, tags):
+    """
+    This function reads the values of XML elements with a streaming parser, ignoring namespaces. Elements inside a parent
+    with a resolution attribute are named as TAG_resolution (e.g. NROWS_10). Parsing stops when all tags are found.
+    Input: xml_path - Path to the XML file. String.
+           tags - List of tags to read.
+    Output: values - Dictionary with tags as keys and text as values. Missing tags are not included.
+    """
+    values = {}
+    parents = []
+    for event, element in ET.iterparse(xml_path, events=("start", "end")):
+        if event == "start":
+            parents.append(element)
+            continue
+        parents.pop()
+        tag = element.tag.split("}")[-1]
+        if parents and ("resolution" in parents[-1].attrib):
+            tag = tag + "_" + parents[-1].attrib["resolution"]
+        if (tag in tags) and (tag not in values):
+            values[tag] = (element.text or "").strip()
+            if len(values) == len(tags):
+                break
+        element.clear()
+
+    return values
+
+#######################################################################################################################################
+def acolite_name(SAFEFileName, SensingTime):
+    """
+    This function builds the ACOLITE product name from the SAFE file name and the sensing time.
+    Input: SAFEFileName - SAFE file name. String.
+           SensingTime - Sensing time from the tile metadata (e.g. 2020-09-18T16:19:21.024Z). String.
+    Output: ACOLITESAFEname - Same name as ACOLITEProductFolder.
+    """
+    FileNameSplitted = SAFEFileName.split('_')
+    Sensor = FileNameSplitted[1]
+    Date = FileNameSplitted[2]
+    ACOLITESAFEname = FileNameSplitted[0] + "_" + Sensor[0:3] + "_" + Date[0:4]+ "_" + Date[4:6]+ "_" + Date[6:8] + "_" + SensingTime[11:13] + "_" + SensingTime[14:16] + "_" + SensingTime[17:19] + "_" + FileNameSplitted[5]
+
+    return ACOLITESAFEname
+
 #######################################################################################################################################
 def Extract_ACOLITE_name_from_SAFE(SAFEProductFile):
     """
@@ -361,17 +541,122 @@ def Extract_ACOLITE_name_from_SAFE(SAFEProductFile):
     Output: ACOLITESAFEnames - Same name as ACOLITEProductFolder.
     """
     # Get name for output folder same as ACOLITE outputs           
-    xmlFile = ",".join(glob.glob(os.path.join(SAFEProductFile,'GRANULE/*/MTD_TL.xml'))).replace("\\","/")   
-    xmlfile_Open = minidom.parse(xmlFile)
-    xml_GeneralInfo = xmlfile_Open.firstChild
-    xml_SensingTime = xml_GeneralInfo.getElementsByTagName('SENSING_TIME')
-    SensingTime = xml_SensingTime[0].firstChild.data
-    FileNameSplitted = os.path.basename(SAFEProductFile).split('_')
-    Sensor = FileNameSplitted[1]
-    Date = FileNameSplitted[2]
-    ACOLITESAFEname = FileNameSplitted[0] + "_" + Sensor[0:3] + "_" + Date[0:4]+ "_" + Date[4:6]+ "_" + Date[6:8] + "_" + SensingTime[11:13] + "_" + SensingTime[14:16] + "_" + SensingTime[17:19] + "_" + FileNameSplitted[5]
+    xmlFile = glob.glob(os.path.join(SAFEProductFile,'GRANULE/*/MTD_TL.xml'))[0]
+    SensingTime = read_xml_values(xmlFile, ['SENSING_TIME'])['SENSING_TIME']
             
-    return ACOLITESAFEname
+    return acolite_name(os.path.basename(SAFEProductFile), SensingTime)
+
+#######################################################################################################################################
+def parse_safe_metadata(SAFEProductFile):
+    """
+    This function parses the tile (MTD_TL.xml) and datastrip (MTD_DS.xml) metadata of a SAFE product with a streaming parser.
+    Relative orbit and processing baseline are taken from the SAFE name if they are not in the datastrip metadata.
+    Input: SAFEProductFile - SAFE Folder path where the original product is saved. String.
+    Output: metadata - Dictionary with safe_file_name, acolite_name, sensing_time, mgrs_tile, relative_orbit, 
+                       processing_baseline, footprint_epsg and footprint (WKT polygon in the tile EPSG).
+    """
+    SAFEFileName = os.path.basename(SAFEProductFile)
+    FileNameSplitted = SAFEFileName.split('_')
+
+    # Tile metadata
+    xmlFile_tl = glob.glob(os.path.join(SAFEProductFile,'GRANULE/*/MTD_TL.xml'))[0]
+    tl = read_xml_values(xmlFile_tl, ['SENSING_TIME', 'TILE_ID', 'HORIZONTAL_CS_CODE', 'NROWS_10', 'NCOLS_10', 'ULX_10', 'ULY_10'])
+    
+    # Datastrip metadata
+    xmlFiles_ds = glob.glob(os.path.join(SAFEProductFile,'DATASTRIP/*/MTD_DS.xml'))
+    if len(xmlFiles_ds) != 0:
+        ds = read_xml_values(xmlFiles_ds[0], ['PROCESSING_BASELINE', 'SENSING_ORBIT_NUMBER'])
+    else:
+        ds = {}
+
+    # MGRS tile
+    mgrs_tile = [part for part in tl.get('TILE_ID', "").split('_') if (len(part) == 6) and part.startswith('T')]
+    mgrs_tile = mgrs_tile[0] if len(mgrs_tile) != 0 else FileNameSplitted[5]
+
+    # Footprint
+    if all(key in tl for key in ['NROWS_10', 'NCOLS_10', 'ULX_10', 'ULY_10']):
+        ulx, uly = float(tl['ULX_10']), float(tl['ULY_10'])
+        lrx, lry = ulx + 10*int(tl['NCOLS_10']), uly - 10*int(tl['NROWS_10'])
+        footprint = box(ulx, lry, lrx, uly).wkt
+    else:
+        footprint = ""
+
+    metadata = {"safe_file_name": SAFEFileName,
+                "acolite_name": acolite_name(SAFEFileName, tl['SENSING_TIME']),
+                "sensing_time": tl['SENSING_TIME'],
+                "mgrs_tile": mgrs_tile,
+                "relative_orbit": int(ds.get('SENSING_ORBIT_NUMBER', FileNameSplitted[4][1:])),
+                "processing_baseline": float(ds.get('PROCESSING_BASELINE', FileNameSplitted[3][1:3]+"."+FileNameSplitted[3][3:5])),
+                "footprint_epsg": tl.get('HORIZONTAL_CS_CODE', ""),
+                "footprint": footprint}
+
+    return metadata
+
+#######################################################################################################################################
+def index_safe_products(S2L1CproductsFolder, SAFEFileNames):
+    """
+    This function parses the metadata of downloaded SAFE products once and stores it in a local table
+    (S2L1CProducts_Index.csv inside S2L1CproductsFolder). Products already in the table are not parsed again.
+    The table is shared by naming, de-duplication and scheduling.
+    Input: S2L1CproductsFolder - Folder path where the original products are saved. String.
+           SAFEFileNames - List of SAFE file names to index. Products not downloaded are ignored.
+    Output: safe_index - Dataframe indexed by safe_file_name.
+            log_list - Logging messages.
+    """
+    # Logging list
+    log_list = []
+
+    # Read existing table
+    index_path = os.path.join(S2L1CproductsFolder, "S2L1CProducts_Index.csv")
+    if os.path.exists(index_path):
+        safe_index = pd.read_csv(index_path, index_col="safe_file_name", keep_default_na=False)
+    else:
+        safe_index = pd.DataFrame(columns=["acolite_name", "sensing_time", "mgrs_tile", "relative_orbit", "processing_baseline", 
+                                           "footprint_epsg", "footprint"])
+        safe_index.index.name = "safe_file_name"
+
+    # Parse new products
+    new_rows = []
+    for SAFEFileName in SAFEFileNames:
+        SAFEProductFile = os.path.join(S2L1CproductsFolder, SAFEFileName)
+        if (SAFEFileName not in safe_index.index) and os.path.exists(SAFEProductFile):
+            try:
+                new_rows.append(parse_safe_metadata(SAFEProductFile))
+            except Exception as e:
+                log_list.append("Unable to index " + SAFEFileName + ": " + str(e))
+    
+    if len(new_rows) != 0:
+        safe_index = pd.concat([safe_index, pd.DataFrame(new_rows).set_index("safe_file_name")])
+        safe_index.to_csv(index_path)
+        log_list.append(str(len(new_rows)) + " products added to SAFE metadata index")
+
+    return safe_index, log_list
+
+#######################################################################################################################################
+def schedule_safe_products(urls_list, safe_index):
+    """
+    This function uses the SAFE metadata index to drop products with same sensing time (same ACOLITE name, only the 
+    highest processing baseline is kept) and to order the products by sensing time and MGRS tile. 
+    Products not in the index (not downloaded yet) keep their order after the indexed ones.
+    Input: urls_list - List with all products URLs.
+           safe_index - Dataframe from index_safe_products.
+    Output: urls_list_scheduled - List of products URLs to process, in order.
+            urls_list_duplicated - List of products URLs with same sensing time as a scheduled product.
+    """
+    indexed_urls = [url for url in urls_list if url.split('/')[-1] in safe_index.index]
+    not_indexed_urls = [url for url in urls_list if url.split('/')[-1] not in safe_index.index]
+
+    # Order by sensing time and tile, the highest processing baseline first inside each ACOLITE name
+    indexed = safe_index.loc[[url.split('/')[-1] for url in indexed_urls]].copy()
+    indexed["url"] = indexed_urls
+    indexed = indexed.sort_values(["sensing_time", "mgrs_tile", "processing_baseline"], ascending=[True, True, False])
+
+    # Drop duplicates
+    duplicated = indexed.duplicated(subset="acolite_name", keep="first")
+    urls_list_scheduled = list(indexed["url"][~duplicated]) + not_indexed_urls
+    urls_list_duplicated = list(indexed["url"][duplicated])
+
+    return urls_list_scheduled, urls_list_duplicated
 
 #######################################################################################################################################
 # [Discontinued]
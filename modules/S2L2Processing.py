@@ -10,37 +10,451 @@ Sentinel-2 L2 (after aplying ACOLITE on S2L1C) processing functions for masking
 from osgeo import osr, gdal
 from terracatalogueclient import Catalogue
 from shapely.geometry import box
+from netCDF4 import Dataset
+import numpy as np
+import xml.etree.ElementTree as ET
+import threading
+import glob
 import os
 
+### Import Defined Functions ###########################################################################################################
+from modules.SpectralIndices import calculate_indices, set_index_threads, index_bands, INDEX_EXPRESSIONS
+from modules.Auxiliar import block_windows, process_blocks, creation_options
+
+# Central wavelengths (nm) used by ACOLITE to name each Sentinel-2 band. Valid for S2A and S2B
+S2_BANDS_WAVELENGTHS = {'B01':['442','443'], 'B02':['492'], 'B03':['559','560'], 'B04':['665'], 'B05':['704'], 'B06':['739','740'],
+                        'B07':['780','783'], 'B08':['833'], 'B8A':['864','865'], 'B09':['943','945'], 'B10':['1373','1377'],
+                        'B11':['1610','1614'], 'B12':['2186','2202']}
+
+# Order of the features inside the stack
+STACK_BANDS = ('B01', 'B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B08', 'B8A', 'B11', 'B12')
+STACK_INDICES = tuple(INDEX_EXPRESSIONS)
+
+# Virtual stacks evaluate the indices on read with the GDAL VRT Python pixel function modules.SpectralIndices.vrt_index,
+# and masked virtual stacks apply the final mask with modules.Masking.vrt_mask. Only these trusted modules are allowed 
+# to run Python code from VRT files (see vrt_python_options).
+VRT_PYTHON_TRUSTED_MODULES = ("modules.SpectralIndices", "modules.Masking")
+
+########################################################################################################################################
+def vrt_python_options():
+    """
+    This function provides the GDAL configuration options that allow the Python pixel functions of the virtual stacks
+    to run. The trusted modules are appended to the modules already trusted by the user (GDAL configuration or 
+    environment variable), and Python pixel functions already enabled for all modules ("YES") are kept.
+    Output: Dictionary of GDAL configuration options.
+    """
+    enable_python = gdal.GetConfigOption("GDAL_VRT_ENABLE_PYTHON", "")
+    trusted_modules = [module for module in gdal.GetConfigOption("GDAL_VRT_PYTHON_TRUSTED_MODULES", "").split(",") if module]
+    trusted_modules = trusted_modules + [module for module in VRT_PYTHON_TRUSTED_MODULES if module not in trusted_modules]
+
+    return {"GDAL_VRT_ENABLE_PYTHON": "YES" if enable_python.upper() == "YES" else "TRUSTED_MODULES",
+            "GDAL_VRT_PYTHON_TRUSTED_MODULES": ",".join(trusted_modules)}
+
+########################################################################################################################################
+def enable_vrt_python():
+    """
+    This function sets the GDAL configuration options of vrt_python_options, so virtual stacks written or read with 
+    GDAL can run their Python pixel functions.
+    """
+    for option, value in vrt_python_options().items():
+        gdal.SetConfigOption(option, value)
+
+########################################################################################################################################
+def required_features(classification, classification_options, masking, masking_options):
+    """
+    This function works out the features that must be stored in the stack. These are the features used by the
+    classification model, B01 for the NaN mask and B08 for the Band8 mask. The NDWI mask and cloud mask use
+    ACOLITE rhos and rhot bands, not the stack. If classification is not active, all features are stored, since 
+    the stack may be classified later with another model.
+    Input: classification - Classification option from User_Inputs. Bool.
+           classification_options - Classification options dictionary from User_Inputs.
+           masking - Masking option from User_Inputs. Bool.
+           masking_options - Masking options dictionary from User_Inputs.
+    Output: features - Tuple of features in the stack order.
+            log_list - Logging messages.
+    """
+    # Logging list
+    log_list = []
+
+    if classification == True:
+        needed = set(classification_options["features"])
+        if masking == True:
+            needed.add("B01")
+            if masking_options["features_mask"] == "BAND8":
+                needed.add("B08")
+        features = tuple(feature for feature in STACK_BANDS+STACK_INDICES if feature in needed)
+    else:
+        features = STACK_BANDS+STACK_INDICES
+    log_list.append("Features stack: " + ", ".join(features) + " (" + str(len(features)) + " of " + 
+                    str(len(STACK_BANDS+STACK_INDICES)) + " features)")
+
+    return features, log_list
+
+########################################################################################################################################
+def feature_bands(features):
+    """
+    This function provides the bands that must be read to calculate a group of features.
+    Input: features - Tuple of features, e.g. ("B02", "NDVI").
+    Output: bands - Tuple of band IDs in the stack order, e.g. ("B02", "B04", "B08").
+    """
+    needed = set(feature for feature in features if feature in STACK_BANDS)
+    needed.update(index_bands([feature for feature in features if feature in STACK_INDICES]))
+
+    return tuple(band for band in STACK_BANDS if band in needed)
+
+########################################################################################################################################
+def stack_band_numbers(stack_path, features):
+    """
+    This function finds the band numbers of features inside a stack, using the band descriptions (stack schema).
+    Stacks without descriptions are assumed to have all features in the default order.
+    Input: stack_path - Path to the stack TIF file. String.
+           features - Tuple of features, e.g. ("B02", "NDVI").
+    Output: band_numbers - List of band numbers (starting at 1), same order as features.
+    """
+    stack = gdal.Open(stack_path)
+    descriptions = [stack.GetRasterBand(i+1).GetDescription() for i in range(stack.RasterCount)]
+    stack = None
+    if all(description == "" for description in descriptions):
+        descriptions = list(STACK_BANDS+STACK_INDICES)[:len(descriptions)]
+
+    missing = [feature for feature in features if feature not in descriptions]
+    if len(missing) != 0:
+        raise Exception("Features " + ", ".join(missing) + " not found in stack " + os.path.basename(stack_path))
+
+    return [descriptions.index(feature)+1 for feature in features]
+
+########################################################################################################################################
+def read_pixel_vectors(stack_raster, features_n, block_lines=256, indices=None):
+    """
+    This function reads features of a stack as pixel vectors, a (pixels x features) array in row-major pixel order.
+    Lines are read by blocks, each block with a single read of all features written directly in pixel order, which
+    matches pixel interleaved stacks (no reshaping copies). Band interleaved stacks are also supported.
+    Input: stack_raster - Stack opened with GDAL.
+           features_n - List of band numbers of the features.
+           block_lines - Number of lines read by block, use a multiple of the 256 pixels GeoTIFF tiles.
+           indices - Sorted array of flat pixel indices (row*columns+column) to read. Default None reads all pixels.
+                     Only the selected pixels are kept, blocks without selected pixels are not read.
+    Output: pixel_vectors - Array (pixels, features) as float32.
+    """
+    x_size, y_size, n_features = stack_raster.RasterXSize, stack_raster.RasterYSize, len(features_n)
+    n_pixels = y_size*x_size if indices is None else len(indices)
+    pixel_vectors = np.empty((n_pixels, n_features), dtype=np.float32)
+    item_size = pixel_vectors.itemsize
+    start = 0
+    for yoff in range(0, y_size, block_lines):
+        ysize = min(block_lines, y_size-yoff)
+        if indices is None:
+            end = (yoff+ysize)*x_size
+        else:
+            end = np.searchsorted(indices, (yoff+ysize)*x_size)
+            if end == start:
+                continue
+        block = stack_raster.ReadRaster(0, yoff, x_size, ysize, buf_type=gdal.GDT_Float32, band_list=list(features_n), 
+                                        buf_pixel_space=item_size*n_features, buf_line_space=item_size*n_features*x_size, 
+                                        buf_band_space=item_size)
+        block = np.frombuffer(block, dtype=np.float32).reshape(-1, n_features)
+        if indices is None:
+            pixel_vectors[start:end] = block
+        else:
+            pixel_vectors[start:end] = block[indices[start:end]-yoff*x_size]
+        start = end
+
+    return pixel_vectors
+
+########################################################################################################################################
+def stack_path(product_folder, suffix="_stack"):
+    """
+    This function provides the path of the stack inside a product folder, the virtual stack (.vrt) if it exists,
+    otherwise the materialized stack (.tif).
+    Input: product_folder - Path to the product folder, the folder and stack must have same name. String.
+           suffix - Stack suffix, "_stack" for atmospheric corrected products and "_masked_stack" for masked products.
+    Output: Path to the stack. String.
+    """
+    product_name = os.path.basename(product_folder)
+    vrt_path = os.path.join(product_folder, product_name+suffix+".vrt")
+    if os.path.exists(vrt_path):
+        enable_vrt_python()
+        return vrt_path
+    else:
+        return os.path.join(product_folder, product_name+suffix+".tif")
+
+########################################################################################################################################
+def write_virtual_stack(vrt_path, bands_path, features, s2platform):
+    """
+    This function writes a virtual stack (VRT) over a TIF with the reflectance bands. Bands are read from the TIF and 
+    indices are derived bands, evaluated on read by the Python pixel function modules.SpectralIndices.vrt_index, only 
+    for the windows requested. Band descriptions keep the stack schema.
+    Input: vrt_path - Path of the virtual stack. String.
+           bands_path - Path to the TIF with the bands used by the features, with band IDs as descriptions. String.
+           features - Tuple of features, in the stack order.
+           s2platform - String with S2A or S2B platforms.
+    Output: Virtual stack as VRT file.
+    """
+    enable_vrt_python()
+    bands_raster = gdal.Open(bands_path)
+    bands_numbers = {bands_raster.GetRasterBand(i+1).GetDescription():i+1 for i in range(bands_raster.RasterCount)}
+    bands_file = os.path.relpath(bands_path, os.path.dirname(os.path.abspath(vrt_path)))
+
+    vrt = ET.Element("VRTDataset", rasterXSize=str(bands_raster.RasterXSize), rasterYSize=str(bands_raster.RasterYSize))
+    ET.SubElement(vrt, "SRS").text = bands_raster.GetProjectionRef()
+    ET.SubElement(vrt, "GeoTransform").text = ", ".join(repr(value) for value in bands_raster.GetGeoTransform())
+    metadata = ET.SubElement(vrt, "Metadata")
+    ET.SubElement(metadata, "MDI", key="BANDS_FILE").text = bands_file
+    ET.SubElement(metadata, "MDI", key="S2PLATFORM").text = s2platform
+    bands_raster = None
+
+    for i, feature in enumerate(features):
+        if feature in STACK_BANDS:
+            vrt_band = ET.SubElement(vrt, "VRTRasterBand", dataType="Float32", band=str(i+1))
+            sources = [feature]
+        else:
+            vrt_band = ET.SubElement(vrt, "VRTRasterBand", dataType="Float32", band=str(i+1), subClass="VRTDerivedRasterBand")
+            sources = sorted(index_bands([feature]))
+        ET.SubElement(vrt_band, "Description").text = feature
+        if feature in STACK_INDICES:
+            ET.SubElement(vrt_band, "PixelFunctionType").text = "modules.SpectralIndices.vrt_index"
+            ET.SubElement(vrt_band, "PixelFunctionLanguage").text = "Python"
+            ET.SubElement(vrt_band, "PixelFunctionArguments", index=feature, bands=",".join(sources), s2platform=s2platform)
+            ET.SubElement(vrt_band, "SourceTransferType").text = "Float32"
+        for source in sources:
+            simple_source = ET.SubElement(vrt_band, "SimpleSource")
+            ET.SubElement(simple_source, "SourceFilename", relativeToVRT="1").text = bands_file
+            ET.SubElement(simple_source, "SourceBand").text = str(bands_numbers[source])
+
+    ET.ElementTree(vrt).write(vrt_path)
+
+########################################################################################################################################
+def virtual_stack_info(vrt_path):
+    """
+    This function reads the information needed to rebuild a virtual stack (e.g. after masking its bands).
+    Input: vrt_path - Path of the virtual stack. String.
+    Output: bands_path - Path to the TIF with the bands. String.
+            features - Tuple of features, in the stack order.
+            s2platform - String with S2A or S2B platforms.
+    """
+    vrt = gdal.Open(vrt_path)
+    bands_path = os.path.join(os.path.dirname(vrt_path), vrt.GetMetadataItem("BANDS_FILE"))
+    s2platform = vrt.GetMetadataItem("S2PLATFORM")
+    features = tuple(vrt.GetRasterBand(i+1).GetDescription() for i in range(vrt.RasterCount))
+    vrt = None
+
+    return bands_path, features, s2platform
+
+########################################################################################################################################
+def l2w_georeference(l2w):
+    """
+    This function builds the georeference of an ACOLITE L2W NetCDF file from its global attributes, the same 
+    way ACOLITE exports GeoTIFFs.
+    Input: l2w - Opened netCDF4 Dataset of the ACOLITE L2W file.
+    Output: geotransform - GDAL geotransform.
+            projection - Projection as WKT.
+    """
+    xrange = l2w.getncattr("xrange")
+    yrange = l2w.getncattr("yrange")
+    pixel_size = l2w.getncattr("pixel_size")
+    geotransform = (float(xrange[0]), float(pixel_size[0]), 0.0, float(yrange[0]), 0.0, float(pixel_size[1]))
+    srs = osr.SpatialReference()
+    srs.ImportFromProj4(l2w.getncattr("proj4_string"))
+    projection = srs.ExportToWkt()
+
+    return geotransform, projection
+
+########################################################################################################################################
+def l2w_band_variables(l2w, parameter):
+    """
+    This function associates the band IDs with the variables of one parameter (e.g. rhorc, rhos, rhot) 
+    inside an ACOLITE L2W NetCDF file.
+    Input: l2w - Opened netCDF4 Dataset of the ACOLITE L2W file.
+           parameter - Parameter prefix as string, e.g. "rhorc".
+    Output: variables - Dictionary with band IDs as keys (e.g. "B01") and variable names as values.
+    """
+    # Associate wavelengths with band IDs
+    wavelengths_to_ids = {wl:band_id for band_id, wls in S2_BANDS_WAVELENGTHS.items() for wl in wls}
+
+    variables = {}
+    for variable in l2w.variables:
+        if variable.startswith(parameter+"_") and (variable.split("_")[-1] in wavelengths_to_ids):
+            variables[wavelengths_to_ids[variable.split("_")[-1]]] = variable
+
+    return variables
+
+########################################################################################################################################
+def l2w_window_reader(l2w, variables, lock):
+    """
+    This function creates a reader of windows of band variables inside an ACOLITE L2W NetCDF file, with NaN for no data.
+    Input: l2w - Opened netCDF4 Dataset of the ACOLITE L2W file.
+           variables - Dictionary with band IDs as keys and variable names as values (see l2w_band_variables).
+           lock - threading.Lock shared by all readers of the file, NetCDF reads are not thread-safe.
+    Output: read_window - Function called as read_window((xoff, yoff, xsize, ysize)), returns a dictionary with 
+                          the band IDs as keys and float32 arrays of the window as values.
+    """
+    def read_window(window):
+        xoff, yoff, xsize, ysize = window
+        with lock:
+            data = {band_id:l2w.variables[variable][yoff:yoff+ysize, xoff:xoff+xsize] for band_id, variable in variables.items()}
+        return {band_id:np.ma.filled(values, np.nan).astype(np.float32) for band_id, values in data.items()}
+
+    return read_window
+
+########################################################################################################################################
+def l2w_path(product_folder):
+    """
+    This function provides the path of the ACOLITE L2W NetCDF file kept inside a product folder (direct stack option).
+    Input: product_folder - ACOLITE product folder. String.
+    Output: Path of the L2W NetCDF file, None if the product has no L2W NetCDF file. String.
+    """
+    l2w_paths = glob.glob(os.path.join(product_folder, "*_L2W.nc"))
+
+    return l2w_paths[0] if len(l2w_paths) > 0 else None
+
 ########################################################################################################################################
-def create_features_stack(input_folder, output_folder):
+def write_raster_blockwise(raster_path, band_names, process_window, x_size, y_size, geotransform, projection, block_size=1024, n_threads=0,
+                           features_raster=False):
+    """
+    This function creates a float32 TIF, with the storage profile, and fills it block by block. Blocks are processed with a thread
+    pool and written in the main thread (see Auxiliar.process_blocks).
+    Input: raster_path - Path of the TIF file. String.
+           band_names - List of band names, saved as band descriptions.
+           process_window - Function called as process_window((xoff, yoff, xsize, ysize)), returns a dictionary 
+                            with band names as keys and arrays of the window as values.
+           x_size, y_size - Raster size in pixels.
+           geotransform - GDAL geotransform.
+           projection - Projection as WKT.
+           block_size - Size of the processing blocks in pixels, rounded to a multiple of the 256 pixels GeoTIFF tiles.
+           n_threads - Number of threads, 0 to use all cores.
+           features_raster - True for rasters with features, stored with the features encoding. Bool.
+    Output: TIF file.
     """
-    This function creates a stack of features and saves into a single TIF.
-    It deletes the isolated feature TIFs after creating the stack.
-    Input: input_folder - Path to the folder where the isolated features are saved. String.
+    block_size = max(256, 256*round(block_size/256))
+
+    driver = gdal.GetDriverByName("GTiff")
+    raster = driver.Create(raster_path, x_size, y_size, len(band_names), gdal.GDT_Float32, 
+                           options=creation_options(gdal.GDT_Float32, features_raster))
+    raster.SetProjection(projection)
+    raster.SetGeoTransform(geotransform)
+    for i, band_name in enumerate(band_names):
+        raster.GetRasterBand(i+1).SetDescription(band_name)
+
+    # All bands of a window are written in one call, so pixel interleaved tiles are written once and complete
+    def write_window(window, data):
+        window_data = np.stack([np.asarray(data[band_name], dtype=np.float32) for band_name in band_names])
+        raster.WriteRaster(window[0], window[1], window[2], window[3], window_data.tobytes(), buf_type=gdal.GDT_Float32)
+
+    process_blocks(block_windows(x_size, y_size, block_size), process_window, write_window, n_threads)
+    raster = None
+
+########################################################################################################################################
+def write_features_stack(stack_path, read_window, s2platform, x_size, y_size, geotransform, projection, block_size=1024, n_threads=0,
+                         index_backend="auto", features=STACK_BANDS+STACK_INDICES, virtual=False):
+    """
+    This function calculates the spectral indices from the bands and writes bands and indices into a single tiled
+    stack TIF, block by block. No isolated feature TIFs are created. Only the requested features are calculated
+    and their names are saved as band descriptions (stack schema).
+    With virtual, only the bands are stored (_bands.tif) and the indices are evaluated on read by a virtual 
+    stack (_stack.vrt), see write_virtual_stack.
+    Input: stack_path - Path of the stack TIF file, ending with _stack.tif. String.
+           read_window - Function called as read_window((xoff, yoff, xsize, ysize)), returns a dictionary with 
+                         the band arrays of the window {"B01": array, ...}, see feature_bands. Must be thread-safe.
+           s2platform - String with S2A or S2B platforms.
+           x_size, y_size - Stack size in pixels.
+           geotransform - GDAL geotransform.
+           projection - Projection as WKT.
+           block_size - Size of the processing blocks in pixels.
+           n_threads - Number of threads, 0 to use all cores.
+           index_backend - Index kernels backend, "numexpr", "numpy" or "auto".
+           features - Tuple of features to store, in the stack order.
+           virtual - Store only bands and write a virtual stack. Bool.
+    Output: Single stack of features as TIF or VRT file.
+    """
+    if virtual == True:
+        bands_path = stack_path[:-len("_stack.tif")] + "_bands.tif"
+        write_raster_blockwise(bands_path, feature_bands(features), read_window, x_size, y_size, geotransform, projection, 
+                               block_size, n_threads, features_raster=True)
+        write_virtual_stack(stack_path[:-len(".tif")] + ".vrt", bands_path, features, s2platform)
+        return
+
+    indices_names = [feature for feature in features if feature in STACK_INDICES]
+
+    # Share the cores between the blocks thread pool and the numexpr threads, restored after the stack is written
+    cores = os.cpu_count() or 1
+    previous_threads = set_index_threads(cores//(n_threads if n_threads > 0 else cores))
+
+    def features_window(window):
+        bands = read_window(window)
+        indices = calculate_indices(bands, s2platform, index_backend, indices_names)
+        return {feature:(bands[feature] if feature in STACK_BANDS else indices[feature]) for feature in features}
+
+    try:
+        write_raster_blockwise(stack_path, features, features_window, x_size, y_size, geotransform, projection, 
+                               block_size, n_threads, features_raster=True)
+    finally:
+        set_index_threads(previous_threads)
+
+########################################################################################################################################
+def create_features_stack_from_l2w(product_folder, block_size=1024, n_threads=0, index_backend="auto", 
+                                   features=STACK_BANDS+STACK_INDICES, virtual=False):
+    """
+    This function reads the ACOLITE L2W NetCDF file inside the product folder and writes the features stack
+    directly, without per-band GeoTIFF intermediates. The NetCDF file is kept, masking reads the surface 
+    reflectance and top of atmosphere bands from it (see l2w_path), and it is deleted with the intermediate files.
+    Input: product_folder - Path to the product folder organized by OrganizeACOLITE_L2W. String.
+           block_size - Size of the processing blocks in pixels.
+           n_threads - Number of threads, 0 to use all cores.
+           index_backend - Index kernels backend, "numexpr", "numpy" or "auto".
+           features - Tuple of features to store, in the stack order.
+           virtual - Store only bands and write a virtual stack. Bool.
+    Output: Single stack of features as TIF (or VRT) file, same name as product_folder.
+    """
+    product_name = os.path.basename(product_folder)
+
+    with Dataset(l2w_path(product_folder)) as l2w:
+        geotransform, projection = l2w_georeference(l2w)
+        rhorc_variables = l2w_band_variables(l2w, "rhorc")
+        rhorc_variables = {band:rhorc_variables[band] for band in feature_bands(features)}
+        y_size, x_size = l2w.variables[list(rhorc_variables.values())[0]].shape
+
+        # Rayleigh-corrected reflectances to stack
+        write_features_stack(os.path.join(product_folder, product_name+"_stack.tif"), l2w_window_reader(l2w, rhorc_variables, threading.Lock()), 
+                             product_name[0:3], x_size, y_size, geotransform, projection, block_size, n_threads, index_backend, features, virtual)
+
+########################################################################################################################################
+def create_features_stack(input_folder, output_folder, block_size=1024, n_threads=0, index_backend="auto", 
+                          features=STACK_BANDS+STACK_INDICES, virtual=False):
+    """
+    This function reads the band TIFs block by block, calculates the spectral indices in memory and writes bands and
+    indices into a single stack TIF. No index TIFs are created. It deletes the isolated band TIFs after creating the stack.
+    Input: input_folder - Path to the folder where the isolated band TIFs are saved. String.
            output_folder - Path to the folder where the single stack will be saved. String.
-    Output: Single stack of features as TIF file.
+           block_size - Size of the processing blocks in pixels.
+           n_threads - Number of threads, 0 to use all cores.
+           index_backend - Index kernels backend, "numexpr", "numpy" or "auto".
+           features - Tuple of features to store, in the stack order.
+           virtual - Store only bands and write a virtual stack. Bool.
+    Output: Single stack of features as TIF (or VRT) file.
     """
-    sorting_pattern = ('B01', 'B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B08', 'B8A', 'B11', 
-                    'B12') + ('NDVI', 'FAI', 'FDI', 'SI', 'NDWI', 'NRD', 'NDMI', 'BSI')
-    paths_list = [os.path.join(input_folder, feature+".tif") for feature in sorting_pattern]
+    bands = feature_bands(features)
 
-    virtual_stack = gdal.BuildVRT('', paths_list, separate=True)
+    # Open bands once, reads are shared between threads
+    band_rasters = {band:gdal.Open(os.path.join(input_folder, band+".tif")) for band in bands}
+    geotransform = band_rasters[bands[0]].GetGeoTransform()
+    projection = band_rasters[bands[0]].GetProjectionRef()
+    x_size = band_rasters[bands[0]].RasterXSize
+    y_size = band_rasters[bands[0]].RasterYSize
+    lock = threading.Lock()
 
-    i = 1
-    for feature in sorting_pattern:
-        virtual_stack_band = virtual_stack.GetRasterBand(i)
-        virtual_stack_band.SetDescription(feature)
-        i += 1
+    def read_window(window):
+        with lock:
+            return {band:band_raster.GetRasterBand(1).ReadAsArray(*window) for band, band_raster in band_rasters.items()}
 
-    gdal.Translate(os.path.join(output_folder, os.path.basename(output_folder) +'_stack.tif'), virtual_stack, format='GTiff')
-    virtual_stack = None
+    write_features_stack(os.path.join(output_folder, os.path.basename(output_folder) +'_stack.tif'), read_window, 
+                         os.path.basename(input_folder)[0:3], x_size, y_size, geotransform, projection, block_size, n_threads, index_backend, features, virtual)
+    band_rasters = None
 
-    # Delete isolated features, redundant information
-    for tif_file in paths_list: 
-        os.remove(tif_file)
+    # Delete isolated bands, redundant information
+    for band in STACK_BANDS:
+        if os.path.exists(os.path.join(input_folder, band+".tif")):
+            os.remove(os.path.join(input_folder, band+".tif"))
    
-
 ########################################################################################################################################
 def stack_info(stack_path):
     """
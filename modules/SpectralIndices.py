@@ -9,11 +9,307 @@ Functions to calculate spectral indices.
 ### Import Libraries ###################################################################################################################
 from osgeo import gdal
 import numpy as np
+import ast
+import functools
 import os
+try:
+    import numexpr as ne
+except ImportError:
+    ne = None
 
 ### Import Defined Functions ###########################################################################################################
 from modules.Auxiliar import *
 
+########################################################################################################################################
+# Index registry. Each index is a named expression over band IDs (B01...B12, B8A) and the constants of index_constants.
+# The registry order is the order of the indices in the features stack, so adding an index only needs a new entry here.
+# Requested indices are evaluated together (see index_plan): terms shared by several indices are computed once, and 
+# each remaining expression is evaluated in a single fused, multi-threaded pass by numexpr, or by NumPy when numexpr is 
+# not installed. Constants are float32, so the arithmetic stays in float32. Division by zero and invalid operations 
+# (e.g. cube root of negative numbers) give inf/NaN without warnings.
+INDEX_EXPRESSIONS = {"NDVI": "(B08-B04)/(B08+B04)",
+                     "FAI": "B08-(B04+(B11-B04)*fai_factor)",
+                     "FDI": "B08-(B06+(B11-B06)*fdi_factor*ten)",
+                     "SI": "((one-B02)*(one-B03)*(one-B04))**third",
+                     "NDWI": "(B03-B08)/(B03+B08)",
+                     "NRD": "B08-B04",
+                     "NDMI": "(B08-B11)/(B08+B11)",
+                     "BSI": "((B11+B04)-(B08+B02))/((B11+B04)+(B08+B02))"}
+
+# Central wavelengths used by FAI and FDI, according to Sentinel-2 platform (S2-A or -B)
+INDEX_WAVELENGTHS = {"S2A": {"B04": 664.6, "B06": 740.5, "B08": 832.8, "B11": 1613.7},
+                     "S2B": {"B04": 664.9, "B06": 739.1, "B08": 832.9, "B11": 1610.4}}
+
+INDEX_BACKEND = "numpy" if ne is None else "numexpr"
+
+INDEX_BANDS = ("B01", "B02", "B03", "B04", "B05", "B06", "B07", "B08", "B8A", "B09", "B10", "B11", "B12")
+
+# NumPy operators of the terms supported in index expressions (see index_plan), used without numexpr
+INDEX_OPERATORS = {ast.Add: np.add, ast.Sub: np.subtract, ast.Mult: np.multiply, ast.Div: np.true_divide, 
+                   ast.Pow: np.power, ast.USub: np.negative, ast.UAdd: np.positive}
+
+########################################################################################################################################
+def index_constants(s2platform):
+    """
+    This function provides the float32 constants used by the index expressions.
+    Input: s2platform - String with S2A or S2B platforms.
+    Output: constants - Dictionary with constant names as keys and float32 scalars as values.
+    """
+    wl = INDEX_WAVELENGTHS["S2A"] if s2platform == "S2A" else INDEX_WAVELENGTHS["S2B"]
+    constants = {"fai_factor": np.float32((wl["B08"]-wl["B04"])/(wl["B11"]-wl["B04"])),
+                 "fdi_factor": np.float32((wl["B08"]-wl["B06"])/(wl["B11"]-wl["B06"])),
+                 "ten": np.float32(10),
+                 "one": np.float32(1),
+                 "third": np.float32(1/3)}
+
+    return constants
+
+########################################################################################################################################
+def evaluate_index(expression, variables, backend=None):
+    """
+    This function evaluates an index expression over float32 arrays.
+    Input: expression - Index expression as string, e.g. "(B08-B04)/(B08+B04)".
+           variables - Dictionary with band arrays and constants used by the expression.
+           backend - "numexpr", "numpy" or "auto". Default "auto" uses numexpr if installed.
+    Output: Index array as float32.
+    """
+    if (backend is None) or (backend == "auto"):
+        backend = INDEX_BACKEND
+
+    if backend == "numexpr":
+        return ne.evaluate(expression, local_dict=variables).astype(np.float32, copy=False)
+    else:
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            return np.asarray(_evaluate_node(_parse_expression(expression), variables), dtype=np.float32)
+
+@functools.lru_cache(maxsize=64)
+def _parse_expression(expression):
+    """
+    This function parses an index expression, cached by expression.
+    Input: expression - Index expression as string.
+    Output: Root node of the expression (ast).
+    """
+    return ast.parse(expression, mode="eval").body
+
+def _evaluate_node(node, variables):
+    """
+    This function evaluates a parsed index expression with the NumPy operators of INDEX_OPERATORS.
+    Input: node - Node of the expression (ast Name, Constant, UnaryOp or BinOp).
+           variables - Dictionary with band arrays and constants used by the expression.
+    Output: Array (or scalar) with the value of the node.
+    """
+    if isinstance(node, ast.Name):
+        if node.id not in variables:
+            raise Exception("Unknown variable in index expression: " + node.id)
+        return variables[node.id]
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+        return node.value
+    if isinstance(node, ast.UnaryOp) and (type(node.op) in INDEX_OPERATORS):
+        return INDEX_OPERATORS[type(node.op)](_evaluate_node(node.operand, variables))
+    if isinstance(node, ast.BinOp) and (type(node.op) in INDEX_OPERATORS):
+        return INDEX_OPERATORS[type(node.op)](_evaluate_node(node.left, variables), _evaluate_node(node.right, variables))
+    raise Exception("Not supported term in index expression: " + ast.unparse(node))
+
+########################################################################################################################################
+def index_plan(indices, expressions=None):
+    """
+    This function builds the evaluation plan of a group of indices. The expressions are parsed into a dependency 
+    graph of terms, where commutative terms are matched regardless of operand order (e.g. B08+B04 and B04+B08). 
+    Terms used more than once (e.g. B08-B04 in NDVI and NRD, B11+B04 and B08+B02 in BSI) become intermediate 
+    steps, computed once and reused by the expressions that depend on them.
+    Input: indices - List of index names, e.g. ["NDVI", "FAI"].
+           expressions - Dictionary with index names as keys and expressions as values, e.g. to evaluate candidate 
+                         indices. Default None uses INDEX_EXPRESSIONS.
+    Output: plan - Dictionary with "bands" (set of band IDs used), "steps" (list of (name, expression), in 
+                   evaluation order) and "outputs" (dictionary with the step name of each index).
+    """
+    if expressions is None:
+        expressions = INDEX_EXPRESSIONS
+    return _index_plan(tuple((index, expressions[index]) for index in indices))
+
+@functools.lru_cache(maxsize=64)
+def _index_plan(indices_expressions):
+    """
+    This function builds the evaluation plan of index_plan, cached by (index, expression) pairs.
+    Input: indices_expressions - Tuple of (index name, expression) pairs.
+    Output: plan - Dictionary as in index_plan.
+    """
+    constants = set(index_constants("S2A"))
+
+    def term_key(node):
+        # Canonical key of a term, with sorted operands for commutative operators
+        if isinstance(node, ast.Name):
+            return node.id
+        if isinstance(node, ast.Constant):
+            return repr(node.value)
+        if isinstance(node, ast.UnaryOp):
+            return type(node.op).__name__ + "(" + term_key(node.operand) + ")"
+        if isinstance(node, ast.BinOp):
+            operands = [term_key(node.left), term_key(node.right)]
+            if isinstance(node.op, (ast.Add, ast.Mult)):
+                operands.sort()
+            return type(node.op).__name__ + "(" + ",".join(operands) + ")"
+        raise Exception("Not supported term in index expression: " + ast.unparse(node))
+
+    # Dependency graph: count the uses of each term, without descending twice into the same term
+    roots, uses, first_node, order, bands = {}, {}, {}, [], set()
+    def visit(node):
+        key = term_key(node)
+        uses[key] = uses.get(key, 0)+1
+        if uses[key] == 1:
+            first_node[key] = node
+            for child in ast.iter_child_nodes(node):
+                if isinstance(child, ast.expr):
+                    visit(child)
+            if isinstance(node, ast.Name):
+                if node.id in INDEX_BANDS:
+                    bands.add(node.id)
+                elif node.id not in constants:
+                    raise Exception("Unknown variable in index expression: " + node.id)
+            elif not isinstance(node, ast.Constant):
+                order.append(key)
+        return key
+
+    for index, expression in indices_expressions:
+        roots[index] = visit(ast.parse(expression, mode="eval").body)
+
+    # Shared terms and index expressions become steps, in dependency order
+    step_names = {}
+    for key in order:
+        if uses[key] > 1:
+            step_names[key] = "_t" + str(len(step_names))
+    for index, key in roots.items():
+        if key not in step_names and not isinstance(first_node[key], ast.Name):
+            step_names[key] = index
+
+    class ReplaceSteps(ast.NodeTransformer):
+        def __init__(self, own_key):
+            self.own_key = own_key
+        def visit(self, node):
+            if isinstance(node, ast.expr):
+                key = term_key(node)
+                if key != self.own_key and key in step_names:
+                    return ast.Name(id=step_names[key], ctx=ast.Load())
+            return super().visit(node)
+
+    steps = []
+    for key in order:
+        if key in step_names:
+            node = ReplaceSteps(key).visit(ast.parse(ast.unparse(first_node[key]), mode="eval").body)
+            steps.append((step_names[key], ast.unparse(node)))
+    outputs = {index: step_names.get(key, key) for index, key in roots.items()}
+
+    return {"bands": bands, "steps": steps, "outputs": outputs}
+
+########################################################################################################################################
+def index_bands(indices, expressions=None):
+    """
+    This function provides the bands used by the expressions of a group of indices.
+    Input: indices - List of index names, e.g. ["NDVI", "FAI"].
+           expressions - Dictionary with index expressions. Default None uses INDEX_EXPRESSIONS.
+    Output: bands - Set of band IDs, e.g. {"B04", "B08", "B11"}.
+    """
+    return set(index_plan(indices, expressions)["bands"])
+
+########################################################################################################################################
+def vrt_index(in_ar, out_ar, xoff, yoff, xsize, ysize, raster_xsize, raster_ysize, buf_radius, gt, **kwargs):
+    """
+    This function is the GDAL VRT Python pixel function used by virtual stacks to evaluate an index on read.
+    Input: in_ar - List of source band arrays, same order as kwargs["bands"].
+           out_ar - Output array, filled in place.
+           xoff, yoff, xsize, ysize, raster_xsize, raster_ysize, buf_radius, gt - Window information given by GDAL, not used.
+           kwargs - PixelFunctionArguments of the VRT band: "index", "bands" (comma separated band IDs) and "s2platform".
+    Output: Index values written in out_ar.
+    """
+    # GDAL gives the arguments as bytes
+    arguments = {key:(value.decode() if isinstance(value, bytes) else value) for key, value in kwargs.items()}
+    variables = {**{band:np.asarray(data, dtype=np.float32) for band, data in zip(arguments["bands"].split(","), in_ar)}, 
+                 **index_constants(arguments["s2platform"])}
+    out_ar[:] = evaluate_index(INDEX_EXPRESSIONS[arguments["index"]], variables)
+
+########################################################################################################################################
+def set_index_threads(n_threads):
+    """
+    This function sets the number of threads used by numexpr in each index evaluation. When blocks are already
+    processed by a thread pool, use cores/pool threads to avoid oversubscription.
+    Input: n_threads - Number of numexpr threads. None does not change it.
+    Output: Previous number of numexpr threads, to restore it. None without numexpr.
+    """
+    if (ne is not None) and (n_threads is not None):
+        return ne.set_num_threads(max(1, n_threads))
+
+########################################################################################################################################
+def normalized_index(band1_data, band2_data):
+    """
+    This function calculates a normalized index [(BandData1-BandData2)/(BandData1+BandData2)] from two band arrays.
+    Input: band1_data, band2_data - Band arrays with same shape.
+    Output: Normalized index array.
+    """
+    return evaluate_index("(b1-b2)/(b1+b2)", {"b1": np.asarray(band1_data, dtype=np.float32), "b2": np.asarray(band2_data, dtype=np.float32)})
+
+########################################################################################################################################
+def fai_or_fdi(b04_data, b06_data, b08_data, b11_data, s2platform, index):
+    """
+    This function calculates the Floating Algae Index or Floating Debris Index from band arrays.
+    Input: b04_data, b06_data, b08_data, b11_data - Band arrays with same shape.
+           s2platform - String with S2A or S2B platforms.
+           index - String with FAI or FDI.
+    Output: FAI or FDI array.
+    """
+    bands = {"B04": b04_data, "B06": b06_data, "B08": b08_data, "B11": b11_data}
+    variables = {**{band:np.asarray(data, dtype=np.float32) for band, data in bands.items()}, **index_constants(s2platform)}
+    return evaluate_index(INDEX_EXPRESSIONS[index], variables)
+
+########################################################################################################################################
+def shadow_index(b02_data, b03_data, b04_data):
+    """
+    This function calculates the shadow index from band arrays.
+    Input: b02_data, b03_data, b04_data - Band arrays with same shape.
+    Output: SI array.
+    """
+    bands = {"B02": b02_data, "B03": b03_data, "B04": b04_data}
+    variables = {**{band:np.asarray(data, dtype=np.float32) for band, data in bands.items()}, **index_constants("S2A")}
+    return evaluate_index(INDEX_EXPRESSIONS["SI"], variables)
+
+########################################################################################################################################
+def bare_soil_index(b02_data, b04_data, b08_data, b11_data):
+    """
+    This function calculates the bare soil index from band arrays.
+    Input: b02_data, b04_data, b08_data, b11_data - Band arrays with same shape.
+    Output: BSI array.
+    """
+    bands = {"B02": b02_data, "B04": b04_data, "B08": b08_data, "B11": b11_data}
+    variables = {band:np.asarray(data, dtype=np.float32) for band, data in bands.items()}
+    return evaluate_index(INDEX_EXPRESSIONS["BSI"], variables)
+
+########################################################################################################################################
+def calculate_indices(bands, s2platform, backend=None, indices_names=None, expressions=None):
+    """
+    This function calculates indices (NDVI,FAI,FDI,SI,NDWI,NRD,NDMI,BSI) from band arrays, without
+    reading or writing any file. The requested indices are evaluated in one pass following index_plan: 
+    shared terms are computed once, and each step is a single fused evaluation.
+    Input: bands - Dictionary with band arrays {"B01": array, ..., "B12": array}. Only the bands used by
+                   the requested indices are needed (see index_bands).
+           s2platform - String with S2A or S2B platforms.
+           backend - "numexpr", "numpy" or "auto". Default "auto" uses numexpr if installed.
+           indices_names - List of indices to calculate. Default None calculates all indices of the registry.
+           expressions - Dictionary with index names as keys and expressions as values, e.g. to evaluate candidate 
+                         indices. Default None uses INDEX_EXPRESSIONS.
+    Output: indices - Dictionary with index arrays, in the registry (stack) order or in the order of expressions.
+    """
+    if expressions is None:
+        expressions = INDEX_EXPRESSIONS
+    if indices_names is None:
+        indices_names = list(expressions)
+    plan = index_plan([index for index in expressions if index in indices_names], expressions)
+    variables = {**{band:np.asarray(bands[band], dtype=np.float32) for band in plan["bands"]}, 
+                 **index_constants(s2platform)}
+
+    for name, expression in plan["steps"]:
+        variables[name] = evaluate_index(expression, variables, backend)
+
+    return {index:np.asarray(variables[name], dtype=np.float32) for index, name in plan["outputs"].items()}
+
 ########################################################################################################################################
 def CalculateNormalizedIndexTif(BandPaths, PathAndTifName):
     """
@@ -31,13 +327,12 @@ def CalculateNormalizedIndexTif(BandPaths, PathAndTifName):
     Band2Raster = gdal.Open(BandPaths[1])
     Band2Data = Band2Raster.GetRasterBand(1).ReadAsArray()
     
-    # Calculation. Allow division by zero
-    np.seterr(divide="ignore", invalid="ignore")
-    NIdata = (Band1Data-Band2Data)/(Band1Data+Band2Data)
+    # Calculation
+    NIdata = normalized_index(Band1Data, Band2Data)
     
     # Initiate raster and save to folder
     Driver = gdal.GetDriverByName("GTiff")
-    NIraster = Driver.Create(PathAndTifName, Band1Raster.RasterXSize, Band1Raster.RasterYSize, 1, gdal.GDT_Float32)
+    NIraster = Driver.Create(PathAndTifName, Band1Raster.RasterXSize, Band1Raster.RasterYSize, 1, gdal.GDT_Float32, options=creation_options(gdal.GDT_Float32))
     NIraster.SetProjection(Band1Raster.GetProjectionRef())
     NIraster.SetGeoTransform(Band1Raster.GetGeoTransform())
     
@@ -61,18 +356,6 @@ def CalculateFAIorFDItif(B4B6B8B11Paths, S2platform, PathAndTifName, Index):
     Output: FAI or FDI tif file.
     """
 
-    # Select central wavelength according to Sentinel-2 platform (S2-A or -B)
-    if S2platform == "S2A":
-        wlB04 = 664.6
-        wlB06 = 740.5
-        wlB08 = 832.8
-        wlB11 = 1613.7
-    else:
-        wlB04 = 664.9
-        wlB06 = 739.1
-        wlB08 = 832.9
-        wlB11 = 1610.4
-    
     # Extract data from bands
     B04Raster = gdal.Open(B4B6B8B11Paths[0])
     B04Data = B04Raster.GetRasterBand(1).ReadAsArray()
@@ -87,14 +370,11 @@ def CalculateFAIorFDItif(B4B6B8B11Paths, S2platform, PathAndTifName, Index):
     B11Data = B11Raster.GetRasterBand(1).ReadAsArray()
         
     # Calculate FAI or FDI
-    if Index == "FAI":
-        IndexData = B08Data - (B04Data + (B11Data-B04Data)*((wlB08-wlB04)/(wlB11-wlB04)))
-    else:
-        IndexData = B08Data - (B06Data + (B11Data-B06Data)*((wlB08-wlB06)/(wlB11-wlB06))*10)
+    IndexData = fai_or_fdi(B04Data, B06Data, B08Data, B11Data, S2platform, Index)
     
     # Save Index
     Driver = gdal.GetDriverByName("GTiff")
-    IndexRaster = Driver.Create(PathAndTifName, B04Raster.RasterXSize, B04Raster.RasterYSize, 1, gdal.GDT_Float32)
+    IndexRaster = Driver.Create(PathAndTifName, B04Raster.RasterXSize, B04Raster.RasterYSize, 1, gdal.GDT_Float32, options=creation_options(gdal.GDT_Float32))
     IndexRaster.SetProjection(B04Raster.GetProjectionRef())
     IndexRaster.SetGeoTransform(B04Raster.GetGeoTransform()) 
     
@@ -125,13 +405,12 @@ def CalculateSITif(BandPaths, PathAndTifName):
     Band4Raster = gdal.Open(BandPaths[2])
     Band4Data = Band4Raster.GetRasterBand(1).ReadAsArray()
     
-    # Calculation. Allow division by zero
-    np.seterr(divide="ignore", invalid="ignore")
-    SIdata = ((1-Band2Data)*(1-Band3Data)*(1-Band4Data))**(1/3)
+    # Calculation
+    SIdata = shadow_index(Band2Data, Band3Data, Band4Data)
     
     # Initiate raster and save to folder
     Driver = gdal.GetDriverByName("GTiff")
-    SIraster = Driver.Create(PathAndTifName, Band2Raster.RasterXSize, Band2Raster.RasterYSize, 1, gdal.GDT_Float32)
+    SIraster = Driver.Create(PathAndTifName, Band2Raster.RasterXSize, Band2Raster.RasterYSize, 1, gdal.GDT_Float32, options=creation_options(gdal.GDT_Float32))
     SIraster.SetProjection(Band2Raster.GetProjectionRef())
     SIraster.SetGeoTransform(Band2Raster.GetGeoTransform())
     
@@ -160,13 +439,12 @@ def CalculateNRDTif(BandPaths, PathAndTifName):
     Band4Raster = gdal.Open(BandPaths[1])
     Band4Data = Band4Raster.GetRasterBand(1).ReadAsArray()
     
-    # Calculation. Allow division by zero
-    np.seterr(divide="ignore", invalid="ignore")
+    # Calculation
     NRDdata = Band8Data - Band4Data
     
     # Initiate raster and save to folder
     Driver = gdal.GetDriverByName("GTiff")
-    NRDraster = Driver.Create(PathAndTifName, Band8Raster.RasterXSize, Band8Raster.RasterYSize, 1, gdal.GDT_Float32)
+    NRDraster = Driver.Create(PathAndTifName, Band8Raster.RasterXSize, Band8Raster.RasterYSize, 1, gdal.GDT_Float32, options=creation_options(gdal.GDT_Float32))
     NRDraster.SetProjection(Band8Raster.GetProjectionRef())
     NRDraster.SetGeoTransform(Band8Raster.GetGeoTransform())
     
@@ -198,13 +476,12 @@ def CalculateBSITif(BandPaths, PathAndTifName):
     Band11Raster = gdal.Open(BandPaths[3])
     Band11Data = Band11Raster.GetRasterBand(1).ReadAsArray()
     
-    # Calculation. Allow division by zero
-    np.seterr(divide="ignore", invalid="ignore")
-    BSIdata = ((Band11Data+Band4Data)-(Band8Data+Band2Data))/((Band11Data+Band4Data)+(Band8Data+Band2Data))
+    # Calculation
+    BSIdata = bare_soil_index(Band2Data, Band4Data, Band8Data, Band11Data)
     
     # Initiate raster and save to folder
     Driver = gdal.GetDriverByName("GTiff")
-    BSIraster = Driver.Create(PathAndTifName, Band2Raster.RasterXSize, Band2Raster.RasterYSize, 1, gdal.GDT_Float32)
+    BSIraster = Driver.Create(PathAndTifName, Band2Raster.RasterXSize, Band2Raster.RasterYSize, 1, gdal.GDT_Float32, options=creation_options(gdal.GDT_Float32))
     BSIraster.SetProjection(Band2Raster.GetProjectionRef())
     BSIraster.SetGeoTransform(Band2Raster.GetGeoTransform())
     
@@ -10,12 +10,34 @@ Tiling functions to prepare dataset for prediction with U-Net.
 
 import os
 import glob
-import itertools
 from osgeo import gdal
 import numpy as np
+import pandas as pd
 import rasterio as rio
 import shutil
 
+### Import Defined Functions ###########################################################################################################
+from modules.S2L2Processing import stack_path
+from modules.Auxiliar import creation_options, rasterio_creation_options
+from modules.Masking import qa_mask_path, QA_BITS
+
+#######################################################################################################################################
+# Default tiling (patch size and overlap) and limits of the tiling planner (see plan_tiling).
+# The margin is the context kept at each side of a patch border, half of the default overlap (64 pixels).
+# Unet patches must be divisible by 16 (4 downsamplings).
+DEFAULT_PATCH_SIZE = (256, 256)
+DEFAULT_OVERLAP = 0.5
+TILING_MARGIN = 64
+TILING_PATCH_MULTIPLE = 16
+TILING_MAX_PATCH_SIZE = 1024
+TILING_MAX_BATCH_SIZE = 8
+# Fraction of the available memory used by a batch of patches during prediction
+TILING_MEMORY_FRACTION = 0.25
+# Float32 activations by pixel for each hidden channel of the Unet (modules.unet, depth of 4 levels): the skip 
+# connections kept by the encoder, the concatenations and double convolutions of the decoder, with a margin for the 
+# intermediate tensors of PyTorch (estimate, not measured by model)
+UNET_ACTIVATIONS_PER_HCHANNEL = 24
+
 #######################################################################################################################################
 def start_points(size, split_size, overlap=0):
     """
@@ -36,170 +58,355 @@ def start_points(size, split_size, overlap=0):
         counter += 1
     return points
 
+#######################################################################################################################################
+def patch_windows(x_size, y_size, patch_size, overlap=0):
+    """
+    This function provides the windows of overlapping patches of an image, same as split_image_with_overlap.
+    Input: x_size, y_size - Image size in pixels.
+           patch_size - Size of the patch in the format (width, height).
+           overlap - Percentage of overlap (0-1).
+    Output: windows - List of windows as (row, column, xoff, yoff), in row-major order.
+    """
+    # Based on https://github.com/Devyanshu/image-split-with-overlap
+    x_points = start_points(x_size, patch_size[0], overlap)
+    y_points = start_points(y_size, patch_size[1], overlap)
+
+    return [(row, column, x, y) for row, y in enumerate(y_points) for column, x in enumerate(x_points)]
+
+#######################################################################################################################################
+def patch_geotransform(geotransform, xoff, yoff):
+    """
+    This function provides the geotransform of a patch from the geotransform of the image.
+    Input: geotransform - GDAL geotransform of the image.
+           xoff, yoff - Offset of the patch in pixels.
+    Output: GDAL geotransform of the patch as tuple.
+    """
+    geo_transform = list(geotransform)
+    geo_transform[0] = geo_transform[0] + xoff*geo_transform[1] + yoff*geo_transform[2]
+    geo_transform[3] = geo_transform[3] + xoff*geo_transform[4] + yoff*geo_transform[5]
+
+    return tuple(geo_transform)
+
+#######################################################################################################################################
+def read_final_mask(qa_path):
+    """
+    This function reads the final mask (FINAL layer of the QA mask) of an image, used to count the valid pixels of
+    each patch (see patch_valid_pixels).
+    Input: qa_path - Path of the QA mask TIF (see Masking.qa_mask_path). String.
+    Output: Final mask array as bool, True for valid pixels.
+    """
+    qa_mask = gdal.Open(qa_path)
+    final_mask = (qa_mask.GetRasterBand(1).ReadAsArray() & QA_BITS["FINAL"]) != 0
+    qa_mask = None
+
+    return final_mask
+
+#######################################################################################################################################
+def patch_valid_pixels(final_mask, xoff, yoff, patch_size):
+    """
+    This function counts the valid pixels of a patch, pixels of the final mask inside the patch window. The count does
+    not depend on the stack values, so patches of unmasked stacks (Unet masked later) are also counted.
+    Patches without valid pixels (e.g. land, clouds) are not classified.
+    Input: final_mask - Final mask array, see read_final_mask.
+           xoff, yoff - Offset of the patch in pixels.
+           patch_size - Size of the patch in the format (width, height).
+    Output: Number of valid pixels. Integer.
+    """
+    return int(np.count_nonzero(final_mask[yoff:yoff+patch_size[1], xoff:xoff+patch_size[0]]))
+
+#######################################################################################################################################
+def patch_index_path(folder):
+    """
+    This function provides the path of the patch index, the table with the windows and valid pixels of all patches
+    of an image (see save_patch_index).
+    Input: folder - Folder of the patches (or maps of patches). String.
+    Output: Path to Patches.csv. String.
+    """
+    return os.path.join(folder, "Patches.csv")
+
+#######################################################################################################################################
+def save_patch_index(folder, patch_index):
+    """
+    This function saves the patch index, with one line by patch (skipped or not) with row, column, xoff, yoff
+    and valid_pixels (see patch_valid_pixels). It is used by mosaic_patches to fill skipped patches.
+    Input: folder - Folder where Patches.csv is saved. String.
+           patch_index - List of (row, column, xoff, yoff, valid_pixels).
+    Output: Patches.csv saved inside folder.
+    """
+    pd.DataFrame(patch_index, columns=["row", "column", "xoff", "yoff", "valid_pixels"]).to_csv(patch_index_path(folder), index=False)
+
+#######################################################################################################################################
+def generate_patches(image_path, patch_size, overlap=0, band_list=None, final_mask=None):
+    """
+    This function yields the overlapping patches of a stack (see patch_windows) as arrays, without patch files. Each
+    row of patches is read with a single window read of patch height lines and the patches are views of it, so only
+    one row of patches is in memory. With a final mask, patches without valid pixels are not read (patch is None) and 
+    rows of patches without valid pixels are not read at all.
+    Input: image_path - Path to the stack TIF (or VRT). String.
+           patch_size - Size of the patch in the format (width, height).
+           overlap - Percentage of overlap (0-1).
+           band_list - List of band numbers to read (e.g. features of the model). Default None reads all bands.
+           final_mask - Final mask array of the stack, see read_final_mask. Default None reads all patches.
+    Output: Generator of (row, column, xoff, yoff, geotransform, patch, valid_pixels), patch is an array view 
+            (bands, height, width) and valid_pixels the number of valid pixels (see patch_valid_pixels), None without
+            final mask.
+    """
+    image_open = gdal.Open(image_path)
+    img_width, img_height = image_open.RasterXSize, image_open.RasterYSize
+    geotransform = image_open.GetGeoTransform()
+    if band_list is None:
+        band_list = list(range(1, image_open.RasterCount+1))
+
+    strip, strip_y = None, None
+    for row, column, x, y in patch_windows(img_width, img_height, patch_size, overlap):
+        valid_pixels = None if final_mask is None else patch_valid_pixels(final_mask, x, y, patch_size)
+        if valid_pixels == 0:
+            yield row, column, x, y, patch_geotransform(geotransform, x, y), None, valid_pixels
+            continue
+        if y != strip_y:
+            strip_y = y
+            strip = image_open.ReadAsArray(0, y, img_width, min(patch_size[1], img_height-y), band_list=list(band_list))
+            strip = strip.reshape(len(band_list), -1, img_width)
+        yield row, column, x, y, patch_geotransform(geotransform, x, y), strip[:, :, x:x+patch_size[0]], valid_pixels
+
+    image_open = None
+
+#######################################################################################################################################
 def split_image_with_overlap(folder_path, patch_size, overlap=0):
     """
     This function splits any tif image containing stacked bands with any degree of overlap.
-    Input: folder_path - Path to the folder containing the tif image, the folder and file must have same name. String.
+    Patches are read by generate_patches. Patches without valid pixels (final mask of the QA mask) are not read or
+    saved, the valid pixels of all patches are saved in the patch index (see save_patch_index).
+    Input: folder_path - Path to the folder containing the tif (or vrt) image, the folder and file must have same name. String.
            patch_size - Size of the patch in the format (width, height).
            overlap - Percentage of overlap (0-1).
-    Output: Patches with stacks tif bands saved in folder called patches.
+    Output: log_list - Logging messages.
+            Patches with stacks tif bands saved in folder called patches.
+            Patch index (Patches.csv) saved in folder called patches.
     """
+    # Logging list
+    log_list = []
+
     # Create folder to store patches
     patches_path = os.path.join(folder_path, "Patches")
     if not os.path.exists(patches_path):
         os.mkdir(patches_path)
 
     # Open stacked raster
-    image_path = os.path.join(folder_path, os.path.basename(folder_path) + "_masked_stack.tif")
-    image_open = gdal.Open(image_path,1)
-    image = image_open.ReadAsArray()
-    img_shape = image.shape
-    img_height = img_shape[1]
-    img_width = img_shape[2]
-    #print("Image: " + str(img_width) + "x" + str(img_height))
+    image_path = stack_path(folder_path, "_masked_stack")
+    image_open = gdal.Open(image_path)
+    projection = image_open.GetProjection()
+    descriptions = [image_open.GetRasterBand(band+1).GetDescription() for band in range(image_open.RasterCount)]
+    image_open = None
     
     patch_width = patch_size[0]
     patch_height = patch_size[1]
-    #print("Desired patch: " + str(patch_width) + "x" + str(patch_height))
 
-    # Based on https://github.com/Devyanshu/image-split-with-overlap
-    x_points = start_points(img_width, patch_width, overlap)
-    y_points = start_points(img_height, patch_height, overlap)
-
-    row_count = 0
-    for y in y_points:
-        column_count = 0
-        for x in x_points:
-            patch = image[:, y:y+patch_height, x:x+patch_width] 
-            patch_nbands = patch.shape[0]
-            #print("Processed patch: " + str(patch_nbands) + "," + str(patch.shape[2]) + "x" + str(patch.shape[1]))
-            
-            # Patch path
-            patch_path = os.path.join(patches_path, str(patch_width)+'x'+str(patch_height)+"_patch_"+str(row_count)+"-"+str(column_count)+".tif")
-
-            # Init patch saving
-            driver = gdal.GetDriverByName("GTiff")
-            patch_data = driver.Create(patch_path, patch_width, patch_height, patch_nbands, gdal.GDT_Float32)
-            
-            # Set georeference for the patch
-            geo_transform = list(image_open.GetGeoTransform())
-            geo_transform[0] = geo_transform[0] + x*geo_transform[1] + y*geo_transform[2]
-            geo_transform[3] = geo_transform[3] + x*geo_transform[4] + y*geo_transform[5]
-            patch_data.SetGeoTransform(tuple(geo_transform))    
-            patch_data.SetProjection(image_open.GetProjection())
-
-            # Write patch data to give path
-            for band in range(0, patch_nbands):             
-                patch_data.GetRasterBand(band+1).WriteArray(patch[band, :, :])
-                patch_data.GetRasterBand(band+1).SetNoDataValue(np.NaN)
-            patch_data.FlushCache()
-            patch_data = None
-              
-            column_count += 1
-        row_count += 1
+    patch_index = []
+    final_mask = read_final_mask(qa_mask_path(folder_path))
+    for row_count, column_count, x, y, geo_transform, patch, valid_pixels in generate_patches(image_path, patch_size, overlap, 
+                                                                                               final_mask=final_mask):
+        # Skip patches without valid pixels
+        patch_index.append((row_count, column_count, x, y, valid_pixels))
+        if valid_pixels == 0:
+            continue
+        patch_nbands = patch.shape[0]
+        
+        # Patch path
+        patch_path = os.path.join(patches_path, str(patch_width)+'x'+str(patch_height)+"_patch_"+str(row_count)+"-"+str(column_count)+".tif")
+
+        # Init patch saving
+        driver = gdal.GetDriverByName("GTiff")
+        patch_data = driver.Create(patch_path, patch_width, patch_height, patch_nbands, gdal.GDT_Float32, 
+                                   options=creation_options(gdal.GDT_Float32, features_raster=True))
+        
+        # Set georeference for the patch
+        patch_data.SetGeoTransform(geo_transform)    
+        patch_data.SetProjection(projection)
+
+        # Write patch data to give path
+        for band in range(0, patch_nbands):             
+            patch_data.GetRasterBand(band+1).WriteArray(patch[band, :, :])
+            patch_data.GetRasterBand(band+1).SetNoDataValue(np.NaN)
+            # Keep stack schema, features are selected by name
+            patch_data.GetRasterBand(band+1).SetDescription(descriptions[band])
+        patch_data.FlushCache()
+        patch_data = None
+
+    final_mask = None
+    save_patch_index(patches_path, patch_index)
+    skipped = sum(1 for patch in patch_index if patch[4] == 0)
+    log_list.append("Split into " + str(len(patch_index)) + " patches, " + str(skipped) + " patches without valid pixels skipped")
+
+    return log_list
 
-    image_open = None
+#######################################################################################################################################
+def available_memory():
+    """
+    This function provides the available system memory (RAM).
+    Output: Available memory in bytes, None if it is not known (not Linux).
+    """
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES")*os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
 
 #######################################################################################################################################
-def mosaic_two_patches(left_or_top, right_or_bottom, output_folder, counter, axis=0):
-    """
-    This function reads two overlapping patches that are adjacent and creates a mosaic image.
-    Where the patches overlap, half of this area is removed in both patches.
-    Modified after created by ChatGPT.
-    Input: left_or_top (lot) - Left or Top TIF path.
-           right_or_bottom (rob) - Right or Bottom TIF path. Same shape and same CRS as left_or_top.
-                                   Must overlap left_or_top.
-           output_folder - Folder where the final mosaic will be saved.
-           counter - Integer to add to output file name, used if you want to apply the function
-                     more times to mosaic the previous mosaic rows.
-           axis - 0 if the patches overlap in the same row. 
-                  1 if the patches overlap in the same column.
-    Output: Mosaic image saved inside output_folder.
+def patch_memory_per_pixel(classification_options):
+    """
+    This function estimates the memory used by the prediction of each pixel of a patch. For Unet, the float32 
+    activations of the layers (UNET_ACTIVATIONS_PER_HCHANNEL by hidden channel), the output classes and the input 
+    features, for RF and XGB the features dataframe and its copies.
+    Input: classification_options - Classification options dictionary, see Classification.create_sc_proba_maps.
+    Output: Memory in bytes by pixel.
+    """
+    n_features = len(classification_options["features"])
+    if classification_options["ml_algorithm"] == "unet":
+        return 4*(UNET_ACTIVATIONS_PER_HCHANNEL*classification_options["n_hchannels"] + 2*classification_options["n_classes"] + 2*n_features)
+    return 8*4*n_features
+
+#######################################################################################################################################
+def tiling_pixels(x_size, y_size, patch_size, overlap):
+    """
+    This function provides the number of patches of an image and the number of pixels predicted (with overlaps).
+    Input: x_size, y_size - Image size in pixels.
+           patch_size - Size of the patch in the format (width, height).
+           overlap - Percentage of overlap (0-1).
+    Output: n_patches - Number of patches.
+            n_pixels - Number of pixels of all patches.
+    """
+    n_patches = len(patch_windows(x_size, y_size, patch_size, overlap))
+
+    return n_patches, n_patches*patch_size[0]*patch_size[1]
+
+#######################################################################################################################################
+def plan_tiling(image_path, classification_options, memory=None, prediction_time=None, max_batch_size=1):
+    """
+    This function plans the tiling of an image for classification: patch size (multiple of 16), overlap and batch size.
+    Unet patches overlap by the margin of the default tiling (TILING_MARGIN at each side of a border), so larger patches
+    predict fewer overlapping pixels. RF and XGB classify each pixel independently, so patches do not overlap.
+    The patch size and batch size are limited by the image size and by the memory. The expected time of each patch size
+    is estimated from a timing probe (time of a call and of each pixel), or from the number of pixels without a probe.
+    Input: image_path - Path to the stack TIF (or VRT). String.
+           classification_options - Classification options dictionary, see Classification.create_sc_proba_maps.
+           memory - Memory available for prediction in bytes. Default None uses the available system memory.
+           prediction_time - Timing probe, function called as prediction_time(patch_size, batch_size) that returns the time
+                             in seconds of a prediction of a batch of random patches. Default None (no probe).
+           max_batch_size - Maximum number of patches predicted at once.
+    Output: plan - Dictionary with "patch_size", "overlap", "batch_size", "n_patches", "relative_compute" (pixels
+                   predicted relative to the default tiling) and "expected_time" (seconds, None without probe).
+            log_list - Logging messages.
     """
-    if axis==0:
-        # Open the left and right TIFF files
-        with rio.open(left_or_top) as lot_tif, rio.open(right_or_bottom) as rob_tif:
-            # Calculate the overlap start and end based on the bounding boxes
-            lot_left, lot_bottom, lot_right, lot_top = lot_tif.bounds
-            rob_left, rob_bottom, rob_right, rob_top = rob_tif.bounds
-            pixel_width = lot_tif.res[0]
-            overlap_start = max(lot_left, rob_left)
-            overlap_end = min(lot_right, rob_right)
-
-            if overlap_start >= overlap_end:
-                raise ValueError("The TIFF files do not overlap.")
-
-            # Read the half of the overlapping area from the left TIFF
-            lot_window = rio.windows.from_bounds(overlap_start, lot_bottom, overlap_start+(overlap_end-overlap_start)/2, lot_top, lot_tif.transform)
-            lot_data = lot_tif.read(window=lot_window)
-
-            # Read the half of the overlapping area from the right TIFF
-            rob_window = rio.windows.from_bounds(overlap_start+(overlap_end-overlap_start)/2, rob_bottom, overlap_end, rob_top, rob_tif.transform)
-            rob_data = rob_tif.read(window=rob_window)
-
-            # Read the non-overlapping area from the left and right TIFFs
-            lot_non_overlap_window = rio.windows.from_bounds(lot_left, lot_bottom, overlap_start, lot_top, lot_tif.transform)
-            lot_non_overlap = lot_tif.read(window=lot_non_overlap_window)
-            rob_non_overlap_window = rio.windows.from_bounds(overlap_end, rob_bottom, rob_right, rob_top, rob_tif.transform)
-            rob_non_overlap = rob_tif.read(window=rob_non_overlap_window)
-
-            # Calculate the width of the new TIFF file
-            #new_width = lot_tif.width + rob_tif.width - lot_data.shape[2] - rob_data.shape[2]
-            new_width = (rob_right-lot_left)/pixel_width
-
-            # Create the new TIFF file with the concatenated data
-            new_profile = lot_tif.profile
-            new_profile.update(width=new_width, transform=rio.transform.from_bounds(lot_left, lot_bottom, rob_right, lot_top, new_width, lot_tif.height))
-            new_data = np.concatenate((lot_non_overlap, lot_data, rob_data, rob_non_overlap), axis=2)
-        with rio.open(os.path.join(output_folder, "mosaic_row-" + str(counter) + ".tif"), 'w', **new_profile) as new_tif:
-            new_tif.write(new_data)
+    # Logging list
+    log_list = []
+
+    image_open = gdal.Open(image_path)
+    x_size, y_size = image_open.RasterXSize, image_open.RasterYSize
+    image_open = None
+
+    n_default, pixels_default = tiling_pixels(x_size, y_size, DEFAULT_PATCH_SIZE, DEFAULT_OVERLAP)
+    default_plan = {"patch_size": DEFAULT_PATCH_SIZE, "overlap": DEFAULT_OVERLAP, "batch_size": 1, "n_patches": n_default, 
+                    "relative_compute": 1.0, "expected_time": None}
+
+    # Patch sizes, multiple of 16, not smaller than the default and not larger than the image
+    unet = classification_options["ml_algorithm"] == "unet"
+    max_size = min(TILING_MAX_PATCH_SIZE, min(x_size, y_size)//TILING_PATCH_MULTIPLE*TILING_PATCH_MULTIPLE)
+    sizes = list(range(DEFAULT_PATCH_SIZE[0], max_size+1, TILING_PATCH_MULTIPLE))
+
+    # Memory limit of a batch
+    if memory is None:
+        memory = available_memory()
+    if memory is not None:
+        max_pixels = memory*TILING_MEMORY_FRACTION/patch_memory_per_pixel(classification_options)
+        sizes = [size for size in sizes if size*size <= max_pixels]
     else:
-        # Open the top and bottom TIFF files
-        with rio.open(left_or_top) as lot_tif, rio.open(right_or_bottom) as rob_tif:
-            # Calculate the overlap start and end based on the bounding boxes
-            lot_left, lot_bottom, lot_right, lot_top = lot_tif.bounds
-            rob_left, rob_bottom, rob_right, rob_top = rob_tif.bounds
-            pixel_height = lot_tif.res[1]
-            overlap_start = max(lot_bottom, rob_bottom)
-            overlap_end = min(lot_top, rob_top)
-
-            if overlap_start >= overlap_end:
-                raise ValueError("The TIFF files do not overlap.")
-
-            # Read the half of the overlapping area from the top TIFF
-            lot_window = rio.windows.from_bounds(lot_left, overlap_start+(overlap_end-overlap_start)/2, lot_right, overlap_end, lot_tif.transform)
-            lot_data = lot_tif.read(window=lot_window)
-
-            # Read the half of the overlapping area from the bottom TIFF
-            rob_window = rio.windows.from_bounds(rob_left, overlap_start, rob_right, overlap_start+(overlap_end-overlap_start)/2, rob_tif.transform)
-            rob_data = rob_tif.read(window=rob_window)
-
-            # Read the non-overlapping area from the top and bottom TIFFs
-            lot_non_overlap_window = rio.windows.from_bounds(lot_left, overlap_end, lot_right, lot_top, lot_tif.transform)
-            lot_non_overlap = lot_tif.read(window=lot_non_overlap_window)
-            rob_non_overlap_window = rio.windows.from_bounds(rob_left, rob_bottom, rob_right, overlap_start, rob_tif.transform)
-            rob_non_overlap = rob_tif.read(window=rob_non_overlap_window)
-
-            # Calculate the height of the new TIFF file
-            #new_height = rob_tif.height + lot_tif.height - rob_data.shape[1] - lot_data.shape[1]
-            new_height = (lot_top-rob_bottom)/pixel_height
-
-            # Create the new TIFF file with the concatenated data
-            new_profile = rob_tif.profile
-            new_profile.update(height=new_height, transform=rio.transform.from_bounds(rob_left, rob_bottom, rob_right, lot_top, rob_tif.width, new_height))
-            new_data = np.concatenate((lot_non_overlap, lot_data, rob_data, rob_non_overlap), axis=1)
-        with rio.open(os.path.join(output_folder, "mosaic_column-" + str(counter) + ".tif"), 'w', **new_profile) as new_tif:
-            new_tif.write(new_data)
+        max_pixels = float("inf")
+    if len(sizes) == 0:
+        log_list.append("Tiling plan: image or memory too small, default tiling used")
+        return default_plan, log_list
+
+    # Timing probe, time of a call and time of each pixel
+    if prediction_time is not None:
+        prediction_time(sizes[0], 1) # warm up
+        time_small = prediction_time(sizes[0], 1)
+        time_large = prediction_time(sizes[-1], 1)
+        if sizes[-1] > sizes[0]:
+            pixel_time = max((time_large-time_small)/(sizes[-1]**2-sizes[0]**2), 0)
+        else:
+            pixel_time = time_small/sizes[0]**2
+        call_time = max(time_small-pixel_time*sizes[0]**2, 0)
+        log_list.append("Tiling probe: " + str(sizes[0]) + "x" + str(sizes[0]) + " patch " + str(round(time_small, 3)) + " s, " + 
+                        str(sizes[-1]) + "x" + str(sizes[-1]) + " patch " + str(round(time_large, 3)) + " s")
+    else:
+        call_time, pixel_time = 0, 1
+
+    # Expected time of each patch size
+    plans = []
+    for size in sizes:
+        overlap = 2*TILING_MARGIN/size if unet else 0
+        batch_size = int(max(1, min(max_batch_size, TILING_MAX_BATCH_SIZE, max_pixels//(size*size))))
+        n_patches, n_pixels = tiling_pixels(x_size, y_size, (size, size), overlap)
+        expected_time = call_time*-(-n_patches//batch_size) + pixel_time*n_pixels
+        plans.append((expected_time, -size, {"patch_size": (size, size), "overlap": overlap, "batch_size": batch_size, 
+                                             "n_patches": n_patches, "relative_compute": n_pixels/pixels_default, 
+                                             "expected_time": expected_time if prediction_time is not None else None}))
+    plan = min(plans, key=lambda p: p[:2])[2]
+
+    log_list.append("Tiling plan: " + str(plan["patch_size"][0]) + "x" + str(plan["patch_size"][1]) + " patches, overlap " + 
+                    str(round(plan["overlap"], 3)) + ", batch size " + str(plan["batch_size"]) + ", " + str(plan["n_patches"]) + " patches")
+    message = "Tiling expected compute: " + str(round(plan["relative_compute"], 2)) + "x of " + str(DEFAULT_PATCH_SIZE[0]) + "x" + \
+              str(DEFAULT_PATCH_SIZE[1]) + " patches with overlap " + str(DEFAULT_OVERLAP) + " (" + str(n_default) + " patches)"
+    if prediction_time is not None:
+        default_time = call_time*n_default + pixel_time*pixels_default
+        message = message + ", expected time " + str(round(plan["expected_time"], 1)) + " s (default " + str(round(default_time, 1)) + " s)"
+    log_list.append(message)
+
+    return plan, log_list
 
 #######################################################################################################################################
-def mosaic_patches(input_folder, output_folder, final_mosaic_name):
+def keep_regions(points, split_size):
+    """
+    This function provides the region kept from each overlapping patch along one axis when mosaicking. Where two
+    adjacent patches overlap, half of this area is kept from each patch. With an odd number of pixels, the first
+    patch keeps the larger half.
+    Input: points - Sorted start points of the patches along the axis (see start_points).
+           split_size - Size of the patch along the axis.
+    Output: regions - List of (start, end) of the region kept from each patch, in image pixels.
+    """
+    bounds = [points[0]] + [point + max(0, points[i]+split_size-point+1)//2 for i, point in enumerate(points[1:])] + [points[-1]+split_size]
+
+    return list(zip(bounds[:-1], bounds[1:]))
+
+#######################################################################################################################################
+def mosaic_regions(x_points, y_points, x_size, y_size):
+    """
+    This function provides the regions kept from the patches of an image when mosaicking (see keep_regions). The last
+    patch of each axis ends at the image border (see start_points), so the patch size is the image size minus the last
+    start point, and the mosaic has the size of the image.
+    Input: x_points, y_points - Sorted start points of the patches (xoff of the columns and yoff of the rows).
+           x_size, y_size - Image size in pixels.
+    Output: x_regions, y_regions - Lists of (start, end) of the region kept from the patches of each column and row.
+    """
+    return keep_regions(x_points, x_size-x_points[-1]), keep_regions(y_points, y_size-y_points[-1])
+
+#######################################################################################################################################
+def mosaic_patches(input_folder, output_folder, final_mosaic_name, patch_index=None, image_path=None, dtype="float32", nodata=None):
     """
     This function reads overlapping patches and creates a mosaic image.
+    The mosaic raster is created once and the region kept from each patch (half of the overlaps, see keep_regions) is
+    written directly into place, one row of patches at a time, so the cost is linear in the number of patches.
+    Every pixel is taken from its patch at its georeferenced position.
     Input: input_folder - Folder where the overlapping patches are saved.
                           The patches must follow the name convention 256x256_patch_0-0.tif,
                           widthxheight_patch_row-column.tif.
            output_folder - Folder where the Mosaics folder containing the final mosaics will be saved.
            final_mosaic_name - Name of the final mosaic.
+           patch_index - Path to the patch index (see save_patch_index). Patches of the index without a patch in
+                         input_folder (skipped) are filled with nodata (or 0). Default None uses the patches in input_folder.
+           image_path - Path to the image that was split (masked stack), used with patch_index. The mosaic has the size
+                        and georeference of the image and the patch offsets of the index, so it does not depend on any 
+                        patch (all patches can be skipped).
+           dtype, nodata - Data type and nodata of the mosaic, used with patch_index (see Classification.map_profile).
     Output: Mosaic image saved inside output_folder.
     """
     # Create folder to store mosaics
@@ -210,53 +417,58 @@ def mosaic_patches(input_folder, output_folder, final_mosaic_name):
     # List of patches to read
     patches_path_list = glob.glob(os.path.join(input_folder, "*.tif"))
 
-    # Reference patch size name
-    patch_size_str = os.path.basename(patches_path_list[0]).split('_')[0]
-
-    # Reference patch indicator name
-    patch_indicator_str = os.path.basename(patches_path_list[0]).split('_')[3]
-
-    # Split each element of the list
-    patches_split = [(int(os.path.basename(p).split('_')[2].split('-')[0]), 
-                      int(os.path.basename(p).split('_')[2].split('-')[1])) for p in patches_path_list]
-    
-    # Sort the list by patch number
-    patches_sorted = sorted(patches_split)
-
-    # Group the list by the patch number
-    groups = []
-    for _, g in itertools.groupby(patches_sorted, lambda x: x[0]):
-        groups.append(list(g))
-
-    # Convert each element of the grouped list back to the original patch format
-    patches_grouped = [[os.path.join(input_folder, patch_size_str+"_patch_"+str(k[0])+'-'+str(k[1])+"_"+patch_indicator_str) for k in group] for group in groups]
-    
-    # Cycle through patch groups, create mosaic of patches for each row
-    j = 0
-    for patch_row in patches_grouped:
-        group_len = len(patch_row)
-        i = 0
-        left_patch = patch_row[i]
-        while i < group_len-1:
-            right_patch = patch_row[i+1] 
-            mosaic_two_patches(left_patch, right_patch, mosaics_folder, j, axis=0)
-            left_patch = os.path.join(mosaics_folder, "mosaic_row-" + str(j) + ".tif")
-            i += 1
-        j += 1
-
-    # Create mosaic of each row mosaic
-    row_mosaics_len = len(glob.glob(os.path.join(mosaics_folder, "*.tif")))
-    i = 0
-    top_patch = os.path.join(mosaics_folder, "mosaic_row-0.tif")
-    while i < row_mosaics_len-1:
-        bottom_patch = os.path.join(mosaics_folder, "mosaic_row-" + str(i+1) + ".tif")
-        mosaic_two_patches(top_patch, bottom_patch, mosaics_folder, 0, axis=1)
-        top_patch = os.path.join(mosaics_folder, "mosaic_column-0.tif")
-        i += 1
-
-    # Rename final mosaic and move to the outisde
-    os.rename(os.path.join(mosaics_folder, "mosaic_column-0.tif"), os.path.join(mosaics_folder, final_mosaic_name+".tif"))
-    shutil.copy(os.path.join(mosaics_folder, final_mosaic_name+".tif"), os.path.join(output_folder, final_mosaic_name+".tif"))
+    # Patches by (row, column)
+    patches = {(int(os.path.basename(p).split('_')[2].split('-')[0]), 
+                int(os.path.basename(p).split('_')[2].split('-')[1])): p for p in patches_path_list}
+
+    # Patch offsets in pixels and georeference, from the patch index and the image or from the patches
+    if patch_index is not None:
+        index = pd.read_csv(patch_index)
+        rows, y_points = zip(*sorted(set(zip(index["row"], index["yoff"]))))
+        columns, x_points = zip(*sorted(set(zip(index["column"], index["xoff"]))))
+        with rio.open(image_path) as image_tif:
+            profile = {"driver": "GTiff", "count": 1, "dtype": dtype, "nodata": nodata, "crs": image_tif.crs}
+            transform = image_tif.transform
+            x_regions, y_regions = mosaic_regions(x_points, y_points, image_tif.width, image_tif.height)
+    else:
+        # Reference patch for the profile and georeference
+        with rio.open(patches[min(patches)]) as reference_tif:
+            profile = reference_tif.profile
+            transform = reference_tif.transform
+            patch_width, patch_height = reference_tif.width, reference_tif.height
+        rows = sorted(set(row for row, _ in patches))
+        columns = sorted(set(column for _, column in patches))
+        x_points, y_points = [], []
+        for column in columns:
+            with rio.open(patches[(rows[0], column)]) as patch_tif:
+                x_points.append(int(round((patch_tif.transform.c-transform.c)/transform.a)))
+        for row in rows:
+            with rio.open(patches[(row, columns[0])]) as patch_tif:
+                y_points.append(int(round((patch_tif.transform.f-transform.f)/transform.e)))
+        x_regions = keep_regions(x_points, patch_width)
+        y_regions = keep_regions(y_points, patch_height)
+    fill_value = profile["nodata"] if profile["nodata"] is not None else 0
+
+    # Create the mosaic raster once
+    mosaic_width, mosaic_height = x_regions[-1][1], y_regions[-1][1]
+    profile.update(width=mosaic_width, height=mosaic_height, transform=transform)
+    profile.update(**rasterio_creation_options(profile["dtype"]))
+    mosaic_path = os.path.join(mosaics_folder, final_mosaic_name+".tif")
+    with rio.open(mosaic_path, 'w', **profile) as mosaic_tif:
+        for row, y, (y_start, y_end) in zip(rows, y_points, y_regions):
+            # Row of patches with the lines kept
+            mosaic_row = np.full((profile["count"], y_end-y_start, mosaic_width), fill_value, dtype=profile["dtype"])
+            for column, x, (x_start, x_end) in zip(columns, x_points, x_regions):
+                # Skipped patches keep the fill value
+                if (row, column) not in patches:
+                    continue
+                patch_window = rio.windows.Window(x_start-x, y_start-y, x_end-x_start, y_end-y_start)
+                with rio.open(patches[(row, column)]) as patch_tif:
+                    mosaic_row[:, :, x_start:x_end] = patch_tif.read(window=patch_window)
+            mosaic_tif.write(mosaic_row, window=rio.windows.Window(0, y_start, mosaic_width, y_end-y_start))
+
+    # Copy final mosaic to the outside
+    shutil.copy(mosaic_path, os.path.join(output_folder, final_mosaic_name+".tif"))
 
 #######################################################################################################################################
 # def create_stacked_masked_bands(folder_path):
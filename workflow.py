@@ -117,6 +117,10 @@ pre_start_flag = logging_flag * clone_flag * \
 POS2IDON_time0 = time.time()
 if pre_start_flag == 1:
 
+    # Storage profile of all rasters created by the pipeline
+    log_list_14 = set_storage_profile(storage_options, classification_options["ml_algorithm"])
+    for log in log_list_14: main_logger.info(log)
+
     # SEARCH PRODUCTS ######################################################################
     main_logger.info("SEARCH PRODUCTS")
     if search == True:
@@ -169,12 +173,38 @@ if pre_start_flag == 1:
             excluded_products_old_format = []
             excluded_products_no_data_sensing_time = []
             excluded_products_corrupted = []
+            triaged_products = []
+
+            # Features stack and ACOLITE output profile, only produce what will be read downstream
+            if atmospheric_correction == True:
+                stack_features, log_list_13 = required_features(classification, classification_options, masking, masking_options)
+                for log in log_list_13: main_logger.info(log)
+                acolite_profile, log_list_11 = acolite_output_profile(masking, masking_options, atmospheric_correction_options, stack_features, roi)
+                for log in log_list_11: main_logger.info(log)
 
             # Filter products URLs
             urls_list, urls_ignored = filter_safe_products(urls_list, service_options["filter"])
             if len(urls_ignored) != 0:
                 main_logger.info("Some URLs have been ignored, because of filtering option")
 
+            # Index metadata of downloaded products, drop same sensing time duplicates and order products
+            safe_index, log_list_12 = index_safe_products(s2l1c_products_folder, [url.split('/')[-1] for url in urls_list])
+            for log in log_list_12: main_logger.info(log)
+            urls_list, urls_duplicated = schedule_safe_products(urls_list, safe_index)
+            if len(urls_duplicated) != 0:
+                main_logger.info("Some URLs have been ignored, because of products with same sensing time")
+                excluded_products_no_data_sensing_time = excluded_products_no_data_sensing_time + [url.split('/')[-1] for url in urls_duplicated]
+                # Delete original products with same sensing time
+                for url in urls_duplicated:
+                    if os.path.exists(os.path.join(s2l1c_products_folder, url.split('/')[-1])):
+                        shutil.rmtree(os.path.join(s2l1c_products_folder, url.split('/')[-1]))
+            # Products not downloaded yet (e.g. download option) can't be indexed before the loop
+            urls_not_indexed = [url for url in urls_list if url.split('/')[-1] not in safe_index.index]
+            if len(urls_not_indexed) != 0:
+                main_logger.info(str(len(urls_not_indexed)) + " of " + str(len(urls_list)) + " products are not downloaded yet and were not scheduled by " +
+                                 "sensing time, products with same sensing time are only excluded after download")
+            scheduled_short_names = []
+
             # Start loop on urls list
             for i, url in enumerate(urls_list):
                 # Get SAFE file name from url link
@@ -208,11 +238,22 @@ if pre_start_flag == 1:
                     # URL list is the reference for product selection used during processing
                     product_in_urls_list = glob.glob(safe_file_path)
                     if len(product_in_urls_list)==1:
-                        product_short_name = Extract_ACOLITE_name_from_SAFE(product_in_urls_list[0])
+                        safe_index, log_list_12 = index_safe_products(s2l1c_products_folder, [safe_file_name])
+                        for log in log_list_12: main_logger.info(log)
+                        product_short_name = safe_index.loc[safe_file_name, "acolite_name"]
                         # Product folders
                         ac_product = os.path.join(ac_products_folder, product_short_name)
                         masked_product = os.path.join(masked_products_folder, product_short_name)
                         classification_product = os.path.join(classification_products_folder, product_short_name)
+                        # Products downloaded during processing are only checked here
+                        if product_short_name in scheduled_short_names:
+                            main_logger.info("Product with same sensing time. Product excluded")
+                            excluded_products_no_data_sensing_time.append(safe_file_name)
+                            product_short_name = "NONE"
+                            # Delete original product
+                            shutil.rmtree(safe_file_path)
+                        else:
+                            scheduled_short_names.append(product_short_name)
                     else:
                         product_short_name = "NONE"
                 except Exception as e:
@@ -225,8 +266,9 @@ if pre_start_flag == 1:
                         if product_short_name != "NONE":
                             main_logger.info("Performing atmospheric correction with ACOLITE") 
                             # Apply ACOLITE algorithm
+                            acolite_time0 = time.time()
                             try:
-                                ACacolite(product_in_urls_list[0], ac_products_folder, os.getenv(evariables[4]), os.getenv(evariables[5]), roi)
+                                ACacolite(product_in_urls_list[0], ac_products_folder, os.getenv(evariables[4]), os.getenv(evariables[5]), roi, acolite_profile)
                                 corrupted_flag = 0
                             except Exception as e:
                                 corrupted_flag = 1
@@ -236,14 +278,28 @@ if pre_start_flag == 1:
                                 for trash_txt in glob.glob(os.path.join(ac_products_folder, "*.txt")): 
                                     os.remove(trash_txt) 
                             # Organize structure of folders and files
-                            log_list_2 = CleanAndOrganizeACOLITE(ac_products_folder, s2l1c_products_folder, safe_file_name)
+                            if atmospheric_correction_options["direct_stack"] == True:
+                                log_list_2 = OrganizeACOLITE_L2W(ac_products_folder, s2l1c_products_folder, safe_file_name)
+                            else:
+                                log_list_2 = CleanAndOrganizeACOLITE(ac_products_folder, s2l1c_products_folder, safe_file_name)
                             for log in log_list_2: main_logger.info(log)
                             if os.path.exists(ac_product):
+                                acolite_time = int(time.time() - acolite_time0)
+                                main_logger.info("ACOLITE processing time: " + str(acolite_time) + " seconds, " + 
+                                                 str(round(folder_size(ac_product)/1e6, 1)) + " MB written")
                                 try:
-                                    # Calculate spectral indices
-                                    CalculateAllIndexes(ac_product)
-                                    # Stack all and delete isolated TIF features
-                                    create_features_stack(ac_product, ac_product)
+                                    if atmospheric_correction_options["direct_stack"] == True:
+                                        # Calculate spectral indices and stack with bands directly from ACOLITE L2W
+                                        create_features_stack_from_l2w(ac_product, atmospheric_correction_options["block_size"], 
+                                                                       atmospheric_correction_options["n_threads"], 
+                                                                       atmospheric_correction_options["index_backend"], stack_features, 
+                                                                       atmospheric_correction_options["virtual_stack"])
+                                    else:
+                                        # Calculate spectral indices, stack with bands and delete isolated TIF bands
+                                        create_features_stack(ac_product, ac_product, atmospheric_correction_options["block_size"], 
+                                                              atmospheric_correction_options["n_threads"], 
+                                                              atmospheric_correction_options["index_backend"], stack_features, 
+                                                              atmospheric_correction_options["virtual_stack"])
                                     main_logger.info("Spectral indices calculated and stacked with bands")
                                 except Exception as e:
                                     main_logger.info("Product corrupted. Not all features are available: " + str(e))
@@ -262,7 +318,7 @@ if pre_start_flag == 1:
                 try:
                     # -> Masking
                     if masking == True:
-                        if (product_short_name != "NONE") and (os.path.exists(os.path.join(ac_product, product_short_name+"_stack.tif"))):
+                        if (product_short_name != "NONE") and (os.path.exists(stack_path(ac_product))):
                             # Only a confirmation that you are reading the right atmospheric corrected product
                             with open(os.path.join(ac_product, "Info.txt")) as text_file:
                                 safe_file_name = text_file.read()
@@ -270,77 +326,118 @@ if pre_start_flag == 1:
                             main_logger.info("Masking: " + safe_file_name + " (" + ac_product_name + ")") 
                            
                             # Reproject previous stack bounds to 4326 and provide geometry
-                            ac_product_stack = os.path.join(ac_product, ac_product_name+"_stack.tif")
+                            ac_product_stack = stack_path(ac_product)
                             stack_epsg, stack_res, stack_bounds, stack_size = stack_info(ac_product_stack)
                             _, stack_geometry = TransformBounds_EPSG(stack_bounds, int(stack_epsg), TargetEPSG=4326)
                            
-                            # -> Water mask with ESA Worldcover
-                            if masking_options["use_existing_ESAwc"] == False:
-                                # TS credentials
-                                ts_user = os.getenv(evariables[2])
-                                ts_pass = os.getenv(evariables[3])
-                                # Download ESA WorldCover Maps
-                                main_logger.info("Downloading WorldCover tile")
-                                log_list_3, esa_wc_non_existing = Download_WorldCoverMaps([ts_user, ts_pass], stack_geometry, esa_wc_folder) 
-                                for log in log_list_3: main_logger.info(log)
+                            # -> Re-mask clouds of the existing QA mask from saved (quantized) cloud probabilities, see cloud_remask
+                            remask = (masking_options["cloud_remask"] == True) and (masking_options["cloud_mask"] == True) and \
+                                     os.path.exists(qa_mask_path(masked_product)) and \
+                                     (cloud_probability_resolution(ac_product) == masking_options["cloud_mask_resolution"])
+                            if remask == True:
+                                main_logger.info("Re-masking clouds from quantized cloud probabilities (" + os.path.basename(cloud_probability_path(ac_product)) + "), s2cloudless and other masks not run")
+                                cloud = cloud_mask_from_probability(cloud_probability_path(ac_product), masking_options["cloud_mask_threshold"], 
+                                                                    masking_options["cloud_mask_average"], masking_options["cloud_mask_dilation"])
+                                log_list_6 = update_qa_cloud_mask(qa_mask_path(masked_product), cloud, masking_options["final_mask_expression"])
+                                for log in log_list_6: main_logger.info(log)
+                                cloud = None
                             else:
-                                main_logger.info("Download of ESA WorldCover maps ignored")
-                                if len(glob.glob(os.path.join(esa_wc_folder, "*.tif"))) == 0:
-                                    main_logger.info("2-1_ESA_Worldcover folder is empty, using artificial water mask") 
-                                    esa_wc_non_existing = True
+                                # -> Water mask with ESA Worldcover
+                                if masking_options["use_existing_ESAwc"] == False:
+                                    # TS credentials
+                                    ts_user = os.getenv(evariables[2])
+                                    ts_pass = os.getenv(evariables[3])
+                                    # Download ESA WorldCover Maps
+                                    main_logger.info("Downloading WorldCover tile")
+                                    log_list_3, esa_wc_non_existing = Download_WorldCoverMaps([ts_user, ts_pass], stack_geometry, esa_wc_folder) 
+                                    for log in log_list_3: main_logger.info(log)
                                 else:
-                                    esa_wc_non_existing = False
-
-                            # Create masked product folder and masks folder inside
-                            CreateBrandNewFolder(masked_product)
-                            masks_folder = os.path.join(masked_product, "Masks")
-                            CreateBrandNewFolder(masks_folder)
-
-                            # -> Water Mask
-                            main_logger.info("Creating Water mask")
-                            log_list_4 = Create_Mask_fromWCMaps(masked_product, esa_wc_folder, stack_epsg, stack_bounds, stack_res[0], esa_wc_non_existing, masking_options["land_buffer"])
-                            for log in log_list_4: main_logger.info(log)
+                                    main_logger.info("Download of ESA WorldCover maps ignored")
+                                    if len(glob.glob(os.path.join(esa_wc_folder, "*.tif"))) == 0:
+                                        main_logger.info("2-1_ESA_Worldcover folder is empty, using artificial water mask") 
+                                        esa_wc_non_existing = True
+                                    else:
+                                        esa_wc_non_existing = False
+
+                                # Create masked product folder and masks folder inside
+                                CreateBrandNewFolder(masked_product)
+                                masks_folder = os.path.join(masked_product, "Masks")
+                                CreateBrandNewFolder(masks_folder)
+
+                                # Masks are created in memory and written as layers of a single QA mask (and as TIFs with "save_intermediate_masks")
+                                masks = {}
+                                # -> Water Mask
+                                main_logger.info("Creating Water mask")
+                                log_list_4, masks["WATER"], mask_geotransform, mask_projection = water_mask(esa_wc_folder, stack_epsg, stack_bounds, stack_res[0], esa_wc_non_existing, masking_options["land_buffer"])
+                                for log in log_list_4: main_logger.info(log)
                        
-                            # -> Features Masks
-                            if masking_options["features_mask"] == "NDWI":
-                                main_logger.info("Creating NDWI-based mask")
-                                Create_Mask_fromNDWI(ac_product, masks_folder, masking_options["threshold_values"][0], masking_options["dilation_values"][0])
-                            elif masking_options["features_mask"] == "BAND8":
-                                main_logger.info("Creating Band8-based mask")
-                                Create_Mask_fromBand8(ac_product, masks_folder, masking_options["threshold_values"][1], masking_options["dilation_values"][1])
-                            else:
-                                main_logger.info("NDWI-based or Band8-based masking ignored")
+                                # -> Features Masks
+                                if masking_options["features_mask"] == "NDWI":
+                                    main_logger.info("Creating NDWI-based mask")
+                                    masks["NDWI"] = ndwi_mask(ac_product, masking_options["threshold_values"][0], masking_options["dilation_values"][0])
+                                elif masking_options["features_mask"] == "BAND8":
+                                    main_logger.info("Creating Band8-based mask")
+                                    masks["BAND8"] = band8_mask(ac_product, masking_options["threshold_values"][1], masking_options["dilation_values"][1])
+                                else:
+                                    main_logger.info("NDWI-based or Band8-based masking ignored")
                            
-                            # -> Cloud Mask
-                            if masking_options["cloud_mask"] == True:
-                                main_logger.info("Creating Cloud mask")
-                                try:
-                                    CloudMasking_S2CloudLess_ROI_10m(ac_product, masks_folder, masking_options["cloud_mask_threshold"], masking_options["cloud_mask_average"], masking_options["cloud_mask_dilation"])
-                                except Exception as e:
-                                    if str(e)[-15:] == "'GetRasterBand'":
-                                        main_logger.info("Product corrupted. Bands are missing")
-                                        excluded_products_corrupted.append(safe_file_name)
-                                    else:
-                                        main_logger.info(str(e))
-                                    masking_options["cloud_mask"] = False
-                            else:
-                                main_logger.info("Cloud masking ignored")
+                                # -> Cloud Mask
+                                if masking_options["cloud_mask"] == True:
+                                    try:
+                                        # Cloud probabilities are saved for cloud_remask
+                                        main_logger.info("Creating Cloud mask")
+                                        masks["CLOUD"] = cloud_mask(ac_product, masking_options["cloud_mask_threshold"], masking_options["cloud_mask_average"], masking_options["cloud_mask_dilation"],
+                                                                    masking_options["cloud_mask_resolution"], ProbabilityPath=cloud_probability_path(ac_product))
+                                    except Exception as e:
+                                        if str(e)[-15:] == "'GetRasterBand'":
+                                            main_logger.info("Product corrupted. Bands are missing")
+                                            excluded_products_corrupted.append(safe_file_name)
+                                        else:
+                                            main_logger.info(str(e))
+                                        masking_options["cloud_mask"] = False
+                                else:
+                                    main_logger.info("Cloud masking ignored")
+
+                                # -> Nan Mask (saved in the QA mask, used by Unet later masking)
+                                masks["NAN"] = nan_mask(ac_product)
  
-                            # Create final mask
-                            main_logger.info("Creating Final mask")
-                            user_inputs_masks = [masking_options["features_mask"], masking_options["cloud_mask"]]
-                            log_list_6, final_mask_path = CreateFinalMask(masked_product, user_inputs_masks)
-                            for log in log_list_6: main_logger.info(log)
-
-                            # Apply mask
-                            if (classification_options["ml_algorithm"] == "rf") or (classification_options["ml_algorithm"] == "xgb"):
-                                # Apply final mask to stack
-                                main_logger.info("Masking stack")
-                                mask_stack(ac_product, masked_product, filter_ignore_value=0)
+                                # Create final mask and QA mask
+                                main_logger.info("Creating Final mask")
+                                log_list_6, qa_path = save_masks(masked_product, masks, mask_geotransform, mask_projection, masking_options["save_intermediate_masks"], 
+                                                                 masking_options["final_mask_expression"])
+                                for log in log_list_6: main_logger.info(log)
+                                masks = None
+
+                            # -> Triage (coverage of valid pixels)
+                            log_list_triage, classify_product = triage_product(masked_product, masking_options["min_valid_coverage"])
+                            for log in log_list_triage: main_logger.info(log)
+
+                            # Apply mask (stale masked stacks of other formats are removed, e.g. with cloud_remask)
+                            remove_masked_stacks(masked_product)
+                            if classify_product == False:
+                                main_logger.info("Masking of stack ignored, product will not be classified")
+                            elif (classification_options["ml_algorithm"] == "rf") or (classification_options["ml_algorithm"] == "xgb"):
+                                if masking_options["masked_stack_format"] == "tif":
+                                    # Apply final mask to stack
+                                    main_logger.info("Masking stack")
+                                    mask_stack(ac_product, masked_product, filter_ignore_value=0)
+                                elif masking_options["masked_stack_format"] == "vrt":
+                                    # Masked virtual stack, final mask applied on read
+                                    main_logger.info("Masking stack (virtual stack)")
+                                    write_masked_virtual_stack(ac_product, masked_product, filter_ignore_value=0)
+                                else:
+                                    # Save valid pixels of stack (indices and optional features)
+                                    main_logger.info("Saving valid pixels of stack")
+                                    n_valid = mask_stack_pixels(ac_product, masked_product, filter_ignore_value=0, 
+                                                                features=classification_options["features"] if masking_options["masked_stack_format"] == "features" else None)
+                                    main_logger.info("Valid pixels: " + str(n_valid))
                             else:
                                 # For UNET apply final mask later
                                 main_logger.info("For Unet masking will be applied later")
-                                shutil.copy(os.path.join(ac_product, ac_product_name+"_stack.tif"), os.path.join(masked_product, ac_product_name+"_masked_stack.tif"))
+                                if masking_options["masked_stack_format"] == "vrt":
+                                    write_masked_virtual_stack(ac_product, masked_product)
+                                else:
+                                    copy_stack(ac_product, masked_product)
 
                             # Copy info text file
                             info_file_in = os.path.join(ac_product, "Info.txt")
@@ -356,60 +453,87 @@ if pre_start_flag == 1:
                 try:
                     # -> Classification
                     if classification == True:
-                        if (product_short_name != "NONE") and (os.path.exists(masked_product)):
+                        if (product_short_name != "NONE") and (os.path.exists(masked_product)) and triage_skipped(masked_product):
+                            # Products skipped by triage, placeholder maps (no classification)
+                            masked_file_name = os.path.basename(stack_path(masked_product, "_masked_stack"))[:-4]
+                            main_logger.info("Classification of " + os.path.basename(masked_product) + " skipped by triage (see Triage.txt), saving placeholder maps")
+                            CreateBrandNewFolder(classification_product)
+                            save_placeholder_maps(classification_product, masked_file_name + "_" + classification_options["ml_algorithm"], 
+                                                  qa_mask_path(masked_product), classification_options)
+                            shutil.copy(os.path.join(masked_product, "Info.txt"), os.path.join(classification_product, "Info.txt"))
+                            triaged_products.append(os.path.basename(masked_product))
+                        elif (product_short_name != "NONE") and (os.path.exists(masked_product)):
                             # Only a confirmation that you are reading the right masked product
                             with open(os.path.join(masked_product, "Info.txt")) as text_file:
                                 safe_file_name = text_file.read()
                             masked_product_name = os.path.basename(masked_product)
-                            masked_file_name = os.path.basename(glob.glob(os.path.join(masked_product, "*.tif"))[0])[:-4]
+                            masked_file_name = os.path.basename(stack_path(masked_product, "_masked_stack"))[:-4]
                             main_logger.info("Classification of: " + safe_file_name + " (" + masked_product_name + ")")
 
+                            # Valid pixels (RF and XGB) are classified directly, without split and mosaic
+                            split_and_mosaic = classification_options["split_and_mosaic"]
+                            if os.path.exists(masked_pixels_path(masked_product)) and classification_options["ml_algorithm"] in ["rf", "xgb"]:
+                                main_logger.info("Classification of valid pixels, split and mosaic ignored")
+                                split_and_mosaic = False
+
                             # -> Split
-                            if classification_options["split_and_mosaic"] == True:
-                                main_logger.info("Spliting into 256x256 patches") 
-                                split_image_with_overlap(masked_product, patch_size=(256,256), overlap=0.5) # overlap of 50%
+                            if split_and_mosaic == True and classification_options["patch_files"] == True:
+                                patch_size, overlap = DEFAULT_PATCH_SIZE, DEFAULT_OVERLAP
+                                if classification_options["tiling"] == "auto":
+                                    tiling_plan, log_list_16 = plan_tiling(stack_path(masked_product, "_masked_stack"), classification_options)
+                                    for log in log_list_16: main_logger.info(log)
+                                    patch_size, overlap = tiling_plan["patch_size"], tiling_plan["overlap"]
+                                main_logger.info("Spliting into " + str(patch_size[0]) + "x" + str(patch_size[1]) + " patches") 
+                                log_list_15 = split_image_with_overlap(masked_product, patch_size=patch_size, overlap=overlap)
+                                for log in log_list_15: main_logger.info(log)
+                            elif split_and_mosaic == True:
+                                main_logger.info("Spliting into patches in memory during classification") 
                             else: 
                                 main_logger.info("Spliting ignored")
 
+                            # Names of the mosaics of patches
+                            if (classification_options["ml_algorithm"] == "unet"):
+                                mosaic_names = {"sc_maps": masked_product_name + "_stack_unet-scmap_mosaic", 
+                                                "proba_maps": masked_product_name + "_stack_unet-probamap_mosaic"}
+                            else:
+                                mosaic_names = {"sc_maps": masked_file_name + "_" + classification_options["ml_algorithm"] + "-scmap", 
+                                                "proba_maps": masked_file_name + "_" + classification_options["ml_algorithm"] + "-probamap"}
+
                             # -> Classification selection
                             # Create classification product folder
                             CreateBrandNewFolder(classification_product)
                             main_logger.info("Performing classification")
-                            if classification_options["split_and_mosaic"] == True:
+                            if split_and_mosaic == True and classification_options["patch_files"] == True:
                                 log_list_7 = create_sc_proba_maps(os.path.join(masked_product, "Patches"), classification_product, classification_options)
                                 for log in log_list_7: main_logger.info(log)
+                            elif split_and_mosaic == True:
+                                # Default patch size and overlap, or planned (tiling "auto")
+                                log_list_7 = create_sc_proba_maps_from_patches(stack_path(masked_product, "_masked_stack"), classification_product, 
+                                                                               classification_options, tiling_plan=classification_options["tiling"] == "auto", 
+                                                                               qa_path=qa_mask_path(masked_product), mosaic_names=mosaic_names)
+                                for log in log_list_7: main_logger.info(log)
                             else:
                                 log_list_7 = create_sc_proba_maps(masked_product, classification_product, classification_options)
                                 for log in log_list_7: main_logger.info(log)
 
                             # -> Mosaic
-                            if classification_options["split_and_mosaic"] == True:
-                                main_logger.info("Performing mosaic of patches") 
-                                sc_maps_folder = os.path.join(classification_product, "sc_maps")
-                                if (classification_options["ml_algorithm"] == "unet"):
-                                    final_mosaic_name = masked_product_name + "_stack_unet-scmap_mosaic"
-                                    mosaic_patches(sc_maps_folder, sc_maps_folder, final_mosaic_name)
-                                    # Apply later mask to Unet mosaic
-                                    main_logger.info("Creating Nan mask")
-                                    masks_folder = os.path.join(masked_product, "Masks")
-                                    Create_Nan_Mask(ac_product, masks_folder)
-                                    mask_stack_later(sc_maps_folder, masked_product, filter_ignore_value=0)
-                                    main_logger.info("Final mask applied to Unet mosaic (sc_map)")
+                            if split_and_mosaic == True:
+                                map_folders = ["sc_maps"] + (["proba_maps"] if classification_options["classification_probabilities"] == True else [])
+                                if classification_options["patch_files"] == True:
+                                    main_logger.info("Performing mosaic of patches") 
+                                    # Patches without valid pixels were skipped, filled from the patch index (georeference of the masked stack)
+                                    patch_index = patch_index_path(os.path.join(masked_product, "Patches"))
+                                    for map_folder in map_folders:
+                                        maps_folder = os.path.join(classification_product, map_folder)
+                                        mosaic_patches(maps_folder, maps_folder, mosaic_names[map_folder], patch_index, 
+                                                       stack_path(masked_product, "_masked_stack"), *map_profile(classification_options, map_folder))
                                 else:
-                                    final_mosaic_name = masked_file_name + "_" + classification_options["ml_algorithm"] + "-"
-                                    mosaic_patches(sc_maps_folder, sc_maps_folder, final_mosaic_name+"scmap")
-
-                                if classification_options["classification_probabilities"] == True:
-                                    proba_maps_folder = os.path.join(classification_product, "proba_maps")
-                                    if (classification_options["ml_algorithm"] == "unet"):
-                                        final_mosaic_name = masked_product_name + "_stack_unet-probamap_mosaic"
-                                        mosaic_patches(proba_maps_folder, proba_maps_folder, final_mosaic_name)
-                                        # Apply later mask to Unet mosaic
-                                        mask_stack_later(proba_maps_folder, masked_product, filter_ignore_value=0)
-                                        main_logger.info("Final mask applied to Unet mosaic (proba_map)")
-                                    else:
-                                        final_mosaic_name = masked_file_name + "_" + classification_options["ml_algorithm"] + "-"
-                                        mosaic_patches(proba_maps_folder, proba_maps_folder, final_mosaic_name+"probamap")
+                                    main_logger.info("Mosaics of patches written during classification")
+                                # Apply later mask to Unet mosaic
+                                if (classification_options["ml_algorithm"] == "unet"):
+                                    for map_folder in map_folders:
+                                        mask_stack_later(os.path.join(classification_product, map_folder), masked_product, filter_ignore_value=0)
+                                        main_logger.info("Final mask applied to Unet mosaic (" + map_folder[:-1] + ")")
                             else:
                                 main_logger.info("Mosaic ignored")
 
@@ -448,7 +572,7 @@ if pre_start_flag == 1:
                     main_logger.info("An error occurred while deleting folders and files: " + str(e))
 
             # Statistics
-            number_found_products = len(urls_list)
+            number_found_products = len(urls_list) + len(urls_duplicated)
             number_excluded_products_old_format = len(excluded_products_old_format)
             number_excluded_products_no_data_sensing_time = len(excluded_products_no_data_sensing_time)
             number_excluded_products_corrupted = len(excluded_products_corrupted)
@@ -474,6 +598,10 @@ if pre_start_flag == 1:
             if number_excluded_products_corrupted != 0:
                 excluded_products_corrupted = "\n".join(excluded_products_corrupted)
                 main_logger.info(excluded_products_corrupted)
+            # Products not classified (valid coverage below minimum, see Triage.txt)
+            main_logger.info("Number of products not classified (triage): " + str(len(triaged_products)))
+            if len(triaged_products) != 0:
+                main_logger.info("\n".join(triaged_products))
 
     else:
         main_logger.info("Processing ignored")